@@ -1,27 +1,39 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import pymongo
 import pydeck as pdk
 from datetime import datetime, timedelta
 import plotly.express as px
 import plotly.graph_objects as go
 from gtfs_client import pobierz_dane_gtfs_rt
+from stan_floty import KlientStanuFloty
+from warstwa_danych import agreguj_opoznienia, agreguj_z_agregatow, NAZWA_KOLEKCJI_AGREGATY
 
 MONGO_CONNECTION_STRING = "mongodb://localhost:27017/"
 NAZWA_BAZY = "ztm_rzeszow_data"
 
+# Mapa na żywo odświeża się sama, bez przeładowania reszty strony
+INTERWAL_MAPY_SEKUND = 10
+
+CZERWONY = [231, 76, 60, 200]
+ZOLTY = [241, 196, 15, 200]
+ZIELONY = [46, 204, 113, 200]
+# Progi prędkości (km/h): postój < 5 <= wolno < 25 <= płynnie
+PROGI_PREDKOSCI = [5, 25]
+KOLORY_PREDKOSCI = np.array([CZERWONY, ZOLTY, ZIELONY])
+# Progi średniego opóźnienia na przystanku (min): <= 1 < ... <= 3 <
+PROGI_OPOZNIENIA = [1, 3]
+KOLORY_OPOZNIENIA = np.array([ZIELONY, ZOLTY, CZERWONY])
+# Do przeglądarki trafiają tylko kolumny potrzebne mapie i podpowiedzi
+KOLUMNY_MAPY = ['id_pojazdu', 'route_id', 'lat', 'lon', 'predkosc_kmh', 'color']
+
 st.set_page_config(
     layout="wide", 
     page_title="Monitoring ZTM Rzeszów",
     page_icon="🚌"
 )
 
-MAPA_DNI = {
-    'Monday': 'Poniedziałek', 'Tuesday': 'Wtorek', 'Wednesday': 'Środa',
-    'Thursday': 'Czwartek', 'Friday': 'Piątek', 'Saturday': 'Sobota', 'Sunday': 'Niedziela'
-}
-KOLEJNOSC_DNI = ['Poniedziałek', 'Wtorek', 'Środa', 'Czwartek', 'Piątek', 'Sobota', 'Niedziela']
-
 @st.cache_resource
 def polacz_mongodb():
     try:
@@ -37,21 +49,64 @@ def zaladuj_opoznienia(dni_wstecz=7):
     client = polacz_mongodb()
     if not client: return None
     db = client[NAZWA_BAZY]
-    collection = db["opoznienia"]
     data_od = datetime.now() - timedelta(days=dni_wstecz)
-    opoznienia = list(collection.find({'timestamp': {'$gte': data_od}}))
-    if not opoznienia: return None
-    df = pd.DataFrame(opoznienia)
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    df['hour'] = df['timestamp'].dt.hour
-    df['day_of_week'] = df['timestamp'].dt.day_name().map(MAPA_DNI)
-    df['date'] = df['timestamp'].dt.date
-    return df
-
-@st.cache_data(ttl=60)
+    # Agregaty godzinowe utrzymuje kalkulator; surowe rekordy tylko gdy ich brak
+    statystyki = agreguj_z_agregatow(db[NAZWA_KOLEKCJI_AGREGATY], data_od)
+    if statystyki is None:
+        statystyki = agreguj_opoznienia(db["opoznienia"], data_od)
+    return statystyki
+
+@st.cache_resource
+def klient_stanu_floty():
+    return KlientStanuFloty()
+
+@st.cache_data(ttl=INTERWAL_MAPY_SEKUND)
 def pobierz_dane_z_cache():
+    """Pozycje pojazdów - ze stanu floty, a gdy serwer nie działa, z GTFS-RT"""
+    _, pojazdy = klient_stanu_floty().migawka()
+    if pojazdy:
+        czasy = [p['timestamp_danych'] for p in pojazdy if p.get('timestamp_danych')]
+        return pojazdy, datetime.fromtimestamp(max(czasy)) if czasy else None
     return pobierz_dane_gtfs_rt()
 
+def kolory_wg_progow(wartosci, progi, kolory, prawostronnie=True):
+    """Zwraca kolory RGBA dla wartości wg przedziałów wyznaczonych progami (brak wartości - zielony)"""
+    wartosci = np.asarray(wartosci, dtype=float)
+    indeksy = np.searchsorted(progi, wartosci, side='right' if prawostronnie else 'left')
+    return np.where(np.isnan(wartosci)[:, None], ZIELONY, kolory[indeksy]).tolist()
+
+@st.fragment(run_every=INTERWAL_MAPY_SEKUND)
+def mapa_na_zywo():
+    dane, timestamp_serwera = pobierz_dane_z_cache()
+    if not dane:
+        st.error("Brak danych GTFS-RT.")
+        return
+
+    df = pd.DataFrame(dane)
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Pojazdy w trasie", f"{len(df)} szt.")
+    m2.metric("Śr. prędkość", f"{df['predkosc_kmh'].mean():.1f} km/h")
+    m3.metric("Aktywne linie", df['route_id'].nunique())
+    m4.metric("Aktualizacja", timestamp_serwera.strftime("%H:%M:%S") if timestamp_serwera else "--:--")
+
+    df['color'] = kolory_wg_progow(df['predkosc_kmh'], PROGI_PREDKOSCI, KOLORY_PREDKOSCI)
+    view_state = pdk.ViewState(latitude=df['lat'].mean(), longitude=df['lon'].mean(), zoom=12, pitch=30)
+
+    st.pydeck_chart(pdk.Deck(
+        layers=[pdk.Layer(
+            "ScatterplotLayer", df[KOLUMNY_MAPY], id="pojazdy", get_position=["lon", "lat"],
+            get_fill_color="color", get_radius=60, pickable=True, auto_highlight=True
+        )],
+        initial_view_state=view_state,
+        tooltip={
+            "html": "<b>Linia: {route_id}</b><br/>Pojazd: {id_pojazdu}<br/>Prędkość: <b>{predkosc_kmh} km/h</b>",
+            "style": {"background": "#1e3a8a", "color": "white", "font-family": "Arial"}
+        }
+    ), key="mapa_na_zywo")
+    st.markdown("""<div style="display: flex; gap: 20px; font-size: 0.8em; justify-content: center;">
+        <span style="color: #e74c3c;">● Postój</span> <span style="color: #f1c40f;">● Wolno</span> <span style="color: #2ecc71;">● Płynnie</span>
+    </div>""", unsafe_allow_html=True)
+
 with st.sidebar:
     st.image("https://upload.wikimedia.org/wikipedia/commons/thumb/2/2d/POL_Rzesz%C3%B3w_COA.svg/960px-POL_Rzesz%C3%B3w_COA.svg.png", width=200)
     st.title("Panel Sterowania")
@@ -68,55 +123,23 @@ st.title("🚌 System Monitoringu Komunikacji Miejskiej - Rzeszów")
 tab1, tab2 = st.tabs(["Mapa na żywo", "Statystyki opóźnień"])
 
 with tab1:
-    dane, timestamp_serwera = pobierz_dane_z_cache()
-    if dane:
-        df = pd.DataFrame(dane)
-        m1, m2, m3, m4 = st.columns(4)
-        m1.metric("Pojazdy w trasie", f"{len(df)} szt.")
-        m2.metric("Śr. prędkość", f"{df['predkosc_kmh'].mean():.1f} km/h")
-        m3.metric("Aktywne linie", df['route_id'].nunique())
-        m4.metric("Aktualizacja", timestamp_serwera.strftime("%H:%M:%S") if timestamp_serwera else "--:--")
-
-        def get_status_color(speed):
-            if speed < 5: return [231, 76, 60, 200]
-            if speed < 25: return [241, 196, 15, 200]
-            return [46, 204, 113, 200]
-
-        df['color'] = df['predkosc_kmh'].apply(get_status_color)
-        view_state = pdk.ViewState(latitude=df['lat'].mean(), longitude=df['lon'].mean(), zoom=12, pitch=30)
-
-        st.pydeck_chart(pdk.Deck(
-            layers=[pdk.Layer(
-                "ScatterplotLayer", df, get_position=["lon", "lat"],
-                get_fill_color="color", get_radius=60, pickable=True, auto_highlight=True
-            )],
-            initial_view_state=view_state,
-            tooltip={
-                "html": "<b>Linia: {route_id}</b><br/>Pojazd: {id_pojazdu}<br/>Prędkość: <b>{predkosc_kmh} km/h</b>",
-                "style": {"background": "#1e3a8a", "color": "white", "font-family": "Arial"}
-            }
-        ))
-        st.markdown("""<div style="display: flex; gap: 20px; font-size: 0.8em; justify-content: center;">
-            <span style="color: #e74c3c;">● Postój</span> <span style="color: #f1c40f;">● Wolno</span> <span style="color: #2ecc71;">● Płynnie</span>
-        </div>""", unsafe_allow_html=True)
-    else:
-        st.error("Brak danych GTFS-RT.")
+    mapa_na_zywo()
 
 with tab2:
     st.header(f"Analiza punktualności ({dni_wstecz} dni)")
-    df_delays = zaladuj_opoznienia(dni_wstecz)
-    if df_delays is not None:
+    statystyki = zaladuj_opoznienia(dni_wstecz)
+    if statystyki is not None:
+        podsumowanie = statystyki['podsumowanie']
         col1, col2, col3, col4 = st.columns(4)
-        col1.metric("Pomiary", f"{len(df_delays):,}")
-        avg_d = df_delays['delay_minutes'].mean()
-        col2.metric("Śr. opóźnienie", f"{avg_d:.2f} min", delta_color="inverse")
-        on_time = (len(df_delays[df_delays['delay_minutes'].abs() <= 2]) / len(df_delays)) * 100
-        col3.metric("Punktualność (±2 min)", f"{on_time:.1f}%")
-        col4.metric("Max opóźnienie", f"{df_delays['delay_minutes'].max():.0f} min")
+        col1.metric("Pomiary", f"{podsumowanie['liczba']:,}")
+        col2.metric("Śr. opóźnienie", f"{podsumowanie['srednia']:.2f} min", delta_color="inverse")
+        col3.metric("Punktualność (±2 min)", f"{podsumowanie['punktualnosc']:.1f}%")
+        col4.metric("Max opóźnienie", f"{podsumowanie['maksimum']:.0f} min")
 
         st.divider()
-        fig_hist = px.histogram(df_delays, x='delay_minutes', nbins=40, title='<b>Rozkład opóźnień</b>',
-                               labels={'delay_minutes': 'Minuty', 'count': 'Liczba'}, color_discrete_sequence=['#3498db'])
+        fig_hist = px.bar(statystyki['histogram'], x='delay_minutes', y='liczba', title='<b>Rozkład opóźnień</b>',
+                          labels={'delay_minutes': 'Minuty', 'liczba': 'Liczba'}, color_discrete_sequence=['#3498db'])
+        fig_hist.update_layout(bargap=0)
         fig_hist.add_vline(x=0, line_dash="dash", line_color="#2ecc71", annotation_text="O czasie")
         st.plotly_chart(fig_hist, use_container_width=True)
 
@@ -124,7 +147,7 @@ with tab2:
         
         with c1:
             st.subheader("Opóźnienia a pora dnia")
-            hourly = df_delays.groupby('hour')['delay_minutes'].mean().reset_index()
+            hourly = statystyki['godziny']
             fig_h = px.line(hourly, x='hour', y='delay_minutes', 
                            labels={'hour': 'Godzina', 'delay_minutes': 'Śr. opóźnienie (min)'},
                            markers=True)
@@ -133,17 +156,16 @@ with tab2:
 
         with c2:
             st.subheader("Opóźnienia a dzień tygodnia")
-            daily = df_delays.groupby('day_of_week')['delay_minutes'].mean().reindex(KOLEJNOSC_DNI).reset_index()
+            daily = statystyki['dni']
             fig_d = px.bar(daily, x='day_of_week', y='delay_minutes',
                           labels={'day_of_week': 'Dzień tygodnia', 'delay_minutes': 'Śr. opóźnienie (min)'},
                           color='delay_minutes', color_continuous_scale='Reds')
             st.plotly_chart(fig_d, use_container_width=True)
 
         st.subheader("Mapa opóźnień na przystankach")
-        map_stops = df_delays.groupby(['stop_name', 'lat', 'lon'])['delay_minutes'].mean().reset_index()
-        map_stops['color'] = map_stops['delay_minutes'].apply(
-            lambda x: [231, 76, 60, 200] if x > 3 else ([241, 196, 15, 200] if x > 1 else [46, 204, 113, 200])
-        )
+        map_stops = statystyki['przystanki']
+        map_stops['color'] = kolory_wg_progow(map_stops['delay_minutes'], PROGI_OPOZNIENIA, KOLORY_OPOZNIENIA,
+                                              prawostronnie=False)
 
         st.pydeck_chart(pdk.Deck(
             layers=[pdk.Layer(
@@ -0,0 +1,250 @@
+import os
+import time
+import zlib
+import struct
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+from gtfs_client import dekoduj_feed
+
+KATALOG_ARCHIWUM = "archiwum_rt"
+# Segment jest zamykany po przekroczeniu rozmiaru lub po upływie czasu
+MAX_ROZMIAR_SEGMENTU_BAJTY = 64 * 1024 * 1024
+MAX_CZAS_SEGMENTU_SEKUND = 3600
+POZIOM_KOMPRESJI = 6
+
+ROZSZERZENIE_SEGMENTU = ".seg"
+ROZSZERZENIE_INDEKSU = ".idx"
+
+# Rekord segmentu: nagłówek (timestamp feedu, długość skompresowanych danych) + dane zlib
+NAGLOWEK_REKORDU = struct.Struct('<qI')
+# Rekord indeksu czasu: (timestamp feedu, przesunięcie rekordu w segmencie)
+REKORD_INDEKSU = struct.Struct('<qQ')
+TYP_INDEKSU = np.dtype([('timestamp', '<i8'), ('przesuniecie', '<u8')])
+
+
+class ArchiwumFeedu:
+    """
+    Archiwum surowych FeedMessage GTFS-RT w rotowanych plikach segmentów
+
+    Każdy payload jest kompresowany zlib i dopisywany z nagłówkiem długości.
+    Obok segmentu powstaje mały indeks czasu (.idx) z przesunięciem każdego
+    rekordu, pozwalający odtwarzać od dowolnej chwili bez czytania całości.
+    Po restarcie zawsze otwierany jest nowy segment - urwany ostatni rekord
+    poprzedniego jest przy odczycie pomijany.
+    """
+
+    def __init__(self, katalog=KATALOG_ARCHIWUM, max_rozmiar=MAX_ROZMIAR_SEGMENTU_BAJTY,
+                 max_czas=MAX_CZAS_SEGMENTU_SEKUND, poziom_kompresji=POZIOM_KOMPRESJI):
+        self.katalog = katalog
+        self.max_rozmiar = max_rozmiar
+        self.max_czas = max_czas
+        self.poziom_kompresji = poziom_kompresji
+
+        self._segment = None
+        self._indeks = None
+        self._start_segmentu = None
+        self._ostatni_payload = None
+
+        os.makedirs(katalog, exist_ok=True)
+
+    def _otworz_segment(self, timestamp):
+        """Zamyka bieżący segment i otwiera nowy nazwany czasem pierwszego rekordu"""
+        self._zamknij_segment()
+
+        nazwa = datetime.fromtimestamp(timestamp).strftime('feed_%Y%m%d_%H%M%S')
+        sciezka = os.path.join(self.katalog, nazwa)
+        numer = 1
+        while os.path.exists(sciezka + ROZSZERZENIE_SEGMENTU):
+            sciezka = os.path.join(self.katalog, f"{nazwa}_{numer}")
+            numer += 1
+
+        self._segment = open(sciezka + ROZSZERZENIE_SEGMENTU, 'ab')
+        self._indeks = open(sciezka + ROZSZERZENIE_INDEKSU, 'ab')
+        self._start_segmentu = timestamp
+
+    def _zamknij_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._indeks.close()
+            self._segment = self._indeks = None
+
+    def dopisz(self, payload, timestamp=None):
+        """
+        Dopisuje surowy payload do archiwum
+
+        Args:
+            payload: Surowe bajty FeedMessage
+            timestamp: Timestamp feedu (epoch); domyślnie bieżący czas
+
+        Returns:
+            bool: False, jeśli payload jest identyczny z poprzednim i go pominięto
+        """
+        if payload == self._ostatni_payload:
+            return False
+
+        timestamp = int(timestamp or time.time())
+
+        if (self._segment is None or
+                self._segment.tell() >= self.max_rozmiar or
+                timestamp - self._start_segmentu >= self.max_czas):
+            self._otworz_segment(timestamp)
+
+        dane = zlib.compress(payload, self.poziom_kompresji)
+        przesuniecie = self._segment.tell()
+
+        self._segment.write(NAGLOWEK_REKORDU.pack(timestamp, len(dane)))
+        self._segment.write(dane)
+        self._segment.flush()
+        # Indeks po danych - wpis w indeksie zawsze wskazuje na pełny rekord
+        self._indeks.write(REKORD_INDEKSU.pack(timestamp, przesuniecie))
+        self._indeks.flush()
+
+        self._ostatni_payload = payload
+        return True
+
+    def zamknij(self):
+        """Zamyka otwarty segment"""
+        self._zamknij_segment()
+
+
+def lista_segmentow(katalog=KATALOG_ARCHIWUM):
+    """Zwraca ścieżki segmentów (bez rozszerzenia) w kolejności czasu"""
+    if not os.path.isdir(katalog):
+        return []
+    return sorted(
+        os.path.join(katalog, nazwa[:-len(ROZSZERZENIE_SEGMENTU)])
+        for nazwa in os.listdir(katalog) if nazwa.endswith(ROZSZERZENIE_SEGMENTU)
+    )
+
+
+def _wczytaj_indeks(sciezka):
+    """Wczytuje indeks czasu segmentu (pomija urwany ostatni wpis)"""
+    try:
+        surowy = np.fromfile(sciezka + ROZSZERZENIE_INDEKSU, dtype=np.uint8)
+    except FileNotFoundError:
+        return np.empty(0, dtype=TYP_INDEKSU)
+    pelne = len(surowy) - len(surowy) % TYP_INDEKSU.itemsize
+    return surowy[:pelne].view(TYP_INDEKSU)
+
+
+def czytaj_archiwum(katalog=KATALOG_ARCHIWUM, data_od=None, data_do=None):
+    """
+    Czyta payloady z archiwum w kolejności zapisu
+
+    Args:
+        katalog: Katalog archiwum
+        data_od: Początek przedziału (datetime, włącznie) lub None
+        data_do: Koniec przedziału (datetime, wyłącznie) lub None
+
+    Yields:
+        tuple: (timestamp feedu jako epoch, surowe bajty FeedMessage)
+    """
+    od = data_od.timestamp() if data_od else None
+    do = data_do.timestamp() if data_do else None
+
+    for sciezka in lista_segmentow(katalog):
+        indeks = _wczytaj_indeks(sciezka)
+
+        przesuniecie = 0
+        if len(indeks):
+            if od is not None and indeks['timestamp'][-1] < od:
+                continue
+            if do is not None and indeks['timestamp'][0] >= do:
+                continue
+            if od is not None:
+                pozycja = np.searchsorted(indeks['timestamp'], od)
+                if pozycja < len(indeks):
+                    przesuniecie = int(indeks['przesuniecie'][pozycja])
+
+        # Segment jest czytany sekwencyjnie od wskazanego rekordu - indeks
+        # może nie obejmować ostatnich rekordów po nagłym zatrzymaniu
+        with open(sciezka + ROZSZERZENIE_SEGMENTU, 'rb') as plik:
+            plik.seek(przesuniecie)
+            while True:
+                naglowek = plik.read(NAGLOWEK_REKORDU.size)
+                if len(naglowek) < NAGLOWEK_REKORDU.size:
+                    break
+                timestamp, dlugosc = NAGLOWEK_REKORDU.unpack(naglowek)
+                dane = plik.read(dlugosc)
+                if len(dane) < dlugosc:
+                    print(f"[UWAGA] Urwany rekord w {sciezka}{ROZSZERZENIE_SEGMENTU} - pominięto")
+                    break
+                if od is not None and timestamp < od:
+                    continue
+                if do is not None and timestamp >= do:
+                    break
+                yield timestamp, zlib.decompress(dane)
+
+
+def odtworz_do_kalkulatora(kalkulator, katalog=KATALOG_ARCHIWUM, data_od=None, data_do=None,
+                           predkosc=None, zapisz=False):
+    """
+    Odtwarza zarchiwizowane feedy przez kalkulator opóźnień
+
+    Nie wymaga sieci; MongoDB jest potrzebne tylko przy zapisz=True.
+
+    Args:
+        kalkulator: DelayCalculator z załadowanym GTFS
+        predkosc: Mnożnik czasu rzeczywistego (np. 60 = minuta feedu w sekundę);
+                  None - bez opóźniania, tak szybko jak się da
+        zapisz: Jeśli True, opóźnienia są zapisywane przez zapisz_opoznienia
+
+    Returns:
+        dict: Liczniki odtworzonych feedów, pojazdów i opóźnień oraz czas trwania
+    """
+    statystyki = {'feedy': 0, 'pojazdy': 0, 'opoznienia': 0, 'zapisane': 0, 'czas_sekund': 0.0}
+    start = time.perf_counter()
+    pierwszy_timestamp = None
+
+    for timestamp, payload in czytaj_archiwum(katalog, data_od, data_do):
+        if predkosc:
+            if pierwszy_timestamp is None:
+                pierwszy_timestamp = timestamp
+            czekaj = (timestamp - pierwszy_timestamp) / predkosc - (time.perf_counter() - start)
+            if czekaj > 0:
+                time.sleep(czekaj)
+
+        dane_pojazdow, timestamp_feed = dekoduj_feed(payload)
+        if timestamp_feed.timestamp() <= 0:
+            # Feed bez timestampu nagłówka - kolektor zapisał go z czasem pobrania
+            timestamp_feed = datetime.fromtimestamp(timestamp)
+        opoznienia = kalkulator.oblicz_opoznienia_dla_odczytu(dane_pojazdow, timestamp_feed)
+
+        statystyki['feedy'] += 1
+        statystyki['pojazdy'] += len(dane_pojazdow)
+        statystyki['opoznienia'] += len(opoznienia)
+        if zapisz and opoznienia:
+            statystyki['zapisane'] += kalkulator.zapisz_opoznienia(opoznienia)
+
+    statystyki['czas_sekund'] = time.perf_counter() - start
+    return statystyki
+
+
+if __name__ == "__main__":
+    from delay_calculator import DelayCalculator
+
+    parser = argparse.ArgumentParser(description="Odtwarzanie archiwum surowych feedów GTFS-RT")
+    parser.add_argument("--katalog", default=KATALOG_ARCHIWUM, help="katalog archiwum")
+    parser.add_argument("--od", type=datetime.fromisoformat, help="początek, np. 2025-11-01T06:00")
+    parser.add_argument("--do", type=datetime.fromisoformat, help="koniec (wyłącznie)")
+    parser.add_argument("--predkosc", type=float,
+                        help="mnożnik czasu rzeczywistego (domyślnie bez opóźniania)")
+    parser.add_argument("--zapisz", action="store_true", help="zapisuj opóźnienia do MongoDB")
+    parser.add_argument("--interpolacja", action="store_true",
+                        help="interpoluj czasy przejazdów między kolejnymi pozycjami pojazdów")
+    args = parser.parse_args()
+
+    kalkulator = DelayCalculator(interpolacja=args.interpolacja)
+    if not kalkulator.zaladuj_gtfs():
+        raise SystemExit(1)
+    if args.zapisz and not kalkulator.polacz_z_mongodb():
+        raise SystemExit(1)
+
+    wynik = odtworz_do_kalkulatora(kalkulator, args.katalog, args.od, args.do, args.predkosc, args.zapisz)
+
+    tempo = wynik['feedy'] / wynik['czas_sekund'] if wynik['czas_sekund'] else 0
+    print(f"✓ Odtworzono feedów: {wynik['feedy']} ({tempo:.1f}/s), pojazdów: {wynik['pojazdy']}, "
+          f"opóźnień: {wynik['opoznienia']}, zapisanych: {wynik['zapisane']}")
@@ -0,0 +1,137 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from delay_calculator import DelayCalculator, ROZMIAR_PARTII_ZAPISU, SCHEMAT_ODCZYTOW, INTERPOLUJ_PRZEJAZDY
+from warstwa_danych import SCHEMAT_DOKUMENT, SCHEMAT_KOMPAKTOWY
+
+# Liczba partycji na proces - drobniejszy podział lepiej wyrównuje obciążenie
+PARTYCJE_NA_PROCES = 4
+MIN_DLUGOSC_PARTYCJI = timedelta(minutes=30)
+
+_kalkulator = None
+
+
+def podziel_zakres(data_od, data_do, liczba_partycji):
+    """Dzieli przedział [data_od, data_do) na równe, przylegające partycje"""
+    dlugosc = max((data_do - data_od) / max(liczba_partycji, 1), MIN_DLUGOSC_PARTYCJI)
+    partycje = []
+    poczatek = data_od
+    while poczatek < data_do:
+        koniec = min(poczatek + dlugosc, data_do)
+        partycje.append((poczatek, koniec))
+        poczatek = koniec
+    return partycje
+
+
+def _inicjalizuj_proces(schemat_odczytow, interpolacja):
+    """
+    Przygotowuje kalkulator w procesie roboczym
+
+    Przy starcie przez fork proces dziedziczy już załadowane indeksy GTFS
+    (strony współdzielone copy-on-write). W przeciwnym razie GTFS jest
+    wczytywany z cache Arrow mapowanego w pamięci. Połączenie z MongoDB jest
+    zawsze tworzone od nowa - klient pymongo nie jest bezpieczny przy fork.
+    """
+    global _kalkulator
+
+    if _kalkulator is None:
+        _kalkulator = DelayCalculator(schemat_odczytow, interpolacja)
+        if not _kalkulator.zaladuj_gtfs():
+            raise RuntimeError("Nie można załadować GTFS w procesie roboczym")
+
+    if not _kalkulator.polacz_z_mongodb():
+        raise RuntimeError("Nie można połączyć z MongoDB w procesie roboczym")
+
+
+def _przetworz_partycje(data_od, data_do, rozmiar_partii):
+    """Przetwarza jedną partycję czasu w procesie roboczym"""
+    return _kalkulator.przetworz_zakres(data_od, data_do, rozmiar_partii)
+
+
+def uruchom_backfill(data_od, data_do, liczba_procesow=None, rozmiar_partii=ROZMIAR_PARTII_ZAPISU,
+                     schemat_odczytow=SCHEMAT_ODCZYTOW, interpolacja=INTERPOLUJ_PRZEJAZDY):
+    """
+    Przelicza opóźnienia dla odczytów z przedziału [data_od, data_do)
+    równolegle w puli procesów
+
+    Każdy proces zapisuje wyniki przez idempotentne bulk_write, więc
+    partycje można bezpiecznie powtarzać. Przy interpolacji przejazdów
+    historia pojazdów zaczyna się od nowa w każdej partycji - przystanki
+    minięte między partycjami są pomijane.
+
+    Returns:
+        int: Liczba nowo zapisanych opóźnień
+    """
+    global _kalkulator
+
+    liczba_procesow = liczba_procesow or os.cpu_count() or 1
+    partycje = podziel_zakres(data_od, data_do, liczba_procesow * PARTYCJE_NA_PROCES)
+
+    print(f"Backfill {data_od} - {data_do}: {len(partycje)} partycji, {liczba_procesow} procesów")
+
+    # Ładowanie w procesie głównym buduje cache Arrow przed startem procesów
+    # roboczych, a przy fork pozwala im odziedziczyć gotowe indeksy
+    _kalkulator = DelayCalculator(schemat_odczytow, interpolacja)
+    if not _kalkulator.zaladuj_gtfs():
+        return 0
+
+    metody = multiprocessing.get_all_start_methods()
+    kontekst = multiprocessing.get_context('fork' if 'fork' in metody else None)
+
+    start = time.monotonic()
+    odczyty = 0
+    opoznienia = 0
+    bledy = 0
+
+    with ProcessPoolExecutor(max_workers=liczba_procesow, mp_context=kontekst,
+                             initializer=_inicjalizuj_proces, initargs=(schemat_odczytow, interpolacja)) as pula:
+        zadania = {
+            pula.submit(_przetworz_partycje, od, do, rozmiar_partii): (od, do)
+            for od, do in partycje
+        }
+
+        for zadanie in as_completed(zadania):
+            od, do = zadania[zadanie]
+            try:
+                p_odczyty, p_opoznienia, p_bledy = zadanie.result()
+            except Exception as e:
+                print(f"[BŁĄD] Partycja {od} - {do}: {e}")
+                continue
+
+            odczyty += p_odczyty
+            opoznienia += p_opoznienia
+            bledy += p_bledy
+            czas = time.monotonic() - start
+            print(f"[{datetime.now()}] Partycja {od} - {do}: {p_odczyty} odczytów, "
+                  f"{p_opoznienia} nowych opóźnień (łącznie {odczyty / czas:.1f} odczytów/s)")
+
+    czas = time.monotonic() - start
+    print(f"✓ Backfill zakończony: {odczyty} odczytów, {opoznienia} nowych opóźnień w {czas:.1f}s")
+    if bledy > 0:
+        print(f"  Błędy: {bledy}")
+
+    return opoznienia
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Równoległe przeliczanie historycznych opóźnień")
+    parser.add_argument("--od", required=True, type=datetime.fromisoformat,
+                        help="początek zakresu (np. 2025-11-01 lub 2025-11-01T06:00)")
+    parser.add_argument("--do", dest="do_", type=datetime.fromisoformat, default=None,
+                        help="koniec zakresu (domyślnie teraz)")
+    parser.add_argument("--procesy", type=int, default=None,
+                        help="liczba procesów (domyślnie liczba rdzeni)")
+    parser.add_argument("--partia", type=int, default=ROZMIAR_PARTII_ZAPISU,
+                        help="rozmiar partii bulk_write")
+    parser.add_argument("--schemat", choices=[SCHEMAT_DOKUMENT, SCHEMAT_KOMPAKTOWY], default=SCHEMAT_ODCZYTOW,
+                        help="schemat odczytów zapisanych przez kolektor")
+    parser.add_argument("--interpolacja", action="store_true", default=INTERPOLUJ_PRZEJAZDY,
+                        help="interpoluj czasy przejazdów między kolejnymi pozycjami pojazdów")
+    args = parser.parse_args()
+
+    uruchom_backfill(args.od, args.do_ or datetime.now(), args.procesy, args.partia, args.schemat,
+                     args.interpolacja)
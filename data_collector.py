@@ -1,8 +1,15 @@
 import pymongo
 import time
+import math
+import asyncio
+import argparse
 from datetime import datetime
 
-from gtfs_client import pobierz_dane_gtfs_rt
+from gtfs_client import KlientGTFSRT
+from archiwum_feedu import ArchiwumFeedu, KATALOG_ARCHIWUM
+from stan_floty import KlientStanuFloty, ADRES_STANU_FLOTY
+from warstwa_danych import (SCHEMAT_DOKUMENT, SCHEMAT_KOMPAKTOWY, NAZWA_KOLEKCJI_KOMPAKTOWEJ,
+                            utworz_kolekcje_kompaktowa, zbuduj_dokumenty_kompaktowe)
 
 MONGO_CONNECTION_STRING = "mongodb://localhost:27017/" 
 
@@ -11,17 +18,143 @@ NAZWA_BAZY = "ztm_rzeszow_data"
 NAZWA_KOLEKCJI = "odczyty_gtfs_rt"
 INTERWAL_SEKUNDY = 30
 
+# Pomija odczyty, w których timestamp nagłówka feedu (lub cała flota) się nie zmienił
+POMIJAJ_NIEZMIENIONE = True
+# Zapisuje tylko pojazdy, których pozycja, kurs lub timestamp się zmieniły
+TYLKO_ZMIENIONE_POJAZDY = False
 
-def uruchom_kolektor():
+# Tryb asyncio: maksymalna liczba odczytów czekających na zapis do MongoDB
+ROZMIAR_KOLEJKI_ZAPISU = 100
+
+# SCHEMAT_DOKUMENT - jeden dokument na odczyt w NAZWA_KOLEKCJI
+# SCHEMAT_KOMPAKTOWY - jeden dokument na pojazd z krótkimi kluczami w kolekcji
+# time-series z retencją (NAZWA_KOLEKCJI_KOMPAKTOWEJ); kalkulator musi używać
+# tego samego schematu
+SCHEMAT_ZAPISU = SCHEMAT_DOKUMENT
+
+# Katalog archiwum surowych feedów (archiwum_feedu.py) lub None - bez archiwum
+ARCHIWUM_FEEDOW = None
+
+# Adres serwera stanu floty (stan_floty.py), do którego trafia każdy odczyt, lub None
+STAN_FLOTY = None
+
+
+class FiltrOdczytow:
+    """Wykrywa powtórzone odczyty GTFS-RT i niezmienione pojazdy"""
+    
+    def __init__(self, tylko_zmienione_pojazdy=False):
+        self.tylko_zmienione_pojazdy = tylko_zmienione_pojazdy
+        self.ostatni_timestamp = None
+        self.odciski = {}
+        
+        self.zapisane_odczyty = 0
+        self.pominiete_odczyty = 0
+        self.zapisane_pojazdy = 0
+        self.pominiete_pojazdy = 0
+    
+    @staticmethod
+    def odcisk_pojazdu(pojazd):
+        """Odcisk pojazdu - zmienia się, gdy zmieni się pozycja, kurs lub timestamp"""
+        return (pojazd.get('trip_id'), pojazd.get('lat'), pojazd.get('lon'), pojazd.get('timestamp_danych'))
+    
+    def filtruj(self, dane_pojazdow, timestamp_serwera):
+        """
+        Zwraca pojazdy do zapisania
+        
+        Returns:
+            list: Pojazdy do zapisania lub None, jeśli cały odczyt jest powtórzeniem
+        """
+        nowe_odciski = {p.get('id_pojazdu'): self.odcisk_pojazdu(p) for p in dane_pojazdow}
+        
+        # Niektóre feedy nie ustawiają timestampu nagłówka (0 -> 1970)
+        timestamp_ustawiony = timestamp_serwera is not None and timestamp_serwera.timestamp() > 0
+        powtorzony = (
+            (timestamp_ustawiony and timestamp_serwera == self.ostatni_timestamp) or
+            nowe_odciski == self.odciski
+        )
+        
+        if powtorzony:
+            self.pominiete_odczyty += 1
+            self.pominiete_pojazdy += len(dane_pojazdow)
+            return None
+        
+        if self.tylko_zmienione_pojazdy:
+            do_zapisu = [
+                p for p in dane_pojazdow
+                if self.odciski.get(p.get('id_pojazdu')) != nowe_odciski[p.get('id_pojazdu')]
+            ]
+        else:
+            do_zapisu = dane_pojazdow
+        
+        self.ostatni_timestamp = timestamp_serwera
+        self.odciski = nowe_odciski
+        
+        self.zapisane_odczyty += 1
+        self.zapisane_pojazdy += len(do_zapisu)
+        self.pominiete_pojazdy += len(dane_pojazdow) - len(do_zapisu)
+        
+        return do_zapisu
+    
+    def podsumowanie(self):
+        """Zwraca tekst z licznikami pominiętych odczytów i pojazdów"""
+        wszystkie_pojazdy = self.zapisane_pojazdy + self.pominiete_pojazdy
+        oszczednosc = self.pominiete_pojazdy / wszystkie_pojazdy * 100 if wszystkie_pojazdy else 0
+        return (f"Pominięto odczytów: {self.pominiete_odczyty}/{self.zapisane_odczyty + self.pominiete_odczyty}, "
+                f"pojazdów: {self.pominiete_pojazdy}/{wszystkie_pojazdy} ({oszczednosc:.1f}%)")
+
+
+def zbuduj_dokument(dane_pojazdow, do_zapisu, timestamp_serwera, tylko_zmienione_pojazdy=False):
+    """Tworzy dokument odczytu do zapisania w kolekcji odczytów"""
+    dokument = {
+        "timestamp_serwera_gtfs": timestamp_serwera,
+        "timestamp_zapisu_db": datetime.now(),
+        "liczba_aktywnych_pojazdow": len(dane_pojazdow),
+        "dane_pojazdow": do_zapisu
+    }
+    if tylko_zmienione_pojazdy:
+        dokument["tylko_zmienione_pojazdy"] = True
+    return dokument
+
+
+def zapisz_odczyt(collection, dane_pojazdow, do_zapisu, timestamp_serwera, tylko_zmienione_pojazdy, schemat):
+    """Zapisuje odczyt w wybranym schemacie i zwraca opis zapisu do logu"""
+    if schemat == SCHEMAT_KOMPAKTOWY:
+        dokumenty = zbuduj_dokumenty_kompaktowe(do_zapisu, timestamp_serwera)
+        if dokumenty:
+            collection.insert_many(dokumenty, ordered=False)
+        return f"Zapisano odczyt. Pojazdów: {len(dokumenty)}/{len(dane_pojazdow)}"
+    
+    dokument = zbuduj_dokument(dane_pojazdow, do_zapisu, timestamp_serwera, tylko_zmienione_pojazdy)
+    result = collection.insert_one(dokument)
+    return f"Zapisano odczyt. ID: {result.inserted_id}. Pojazdów: {len(do_zapisu)}/{len(dane_pojazdow)}"
+
+
+def archiwizuj_feed(archiwum, klient, timestamp_serwera):
+    """Dopisuje surowy payload klienta do archiwum, jeśli feed się zmienił"""
+    if archiwum is None or klient.niezmieniony or klient.ostatni_payload is None:
+        return
+    timestamp = timestamp_serwera.timestamp() if timestamp_serwera else 0
+    try:
+        # Feed bez timestampu nagłówka (0 -> 1970) archiwizujemy z czasem pobrania
+        archiwum.dopisz(klient.ostatni_payload, timestamp if timestamp > 0 else None)
+    except OSError as e:
+        print(f"[{datetime.now()}] Błąd zapisu archiwum feedów: {e}")
+
+
+def uruchom_kolektor(pomijaj_niezmienione=POMIJAJ_NIEZMIENIONE, tylko_zmienione_pojazdy=TYLKO_ZMIENIONE_POJAZDY,
+                     schemat=SCHEMAT_ZAPISU, katalog_archiwum=ARCHIWUM_FEEDOW, adres_stanu=STAN_FLOTY):
     print("Uruchamianie kolektora danych...")
     
     try:
         client = pymongo.MongoClient(MONGO_CONNECTION_STRING)
         db = client[NAZWA_BAZY]
-        collection = db[NAZWA_KOLEKCJI]
 
         client.admin.command('ping')
-        print(f"Połączono z MongoDB. Baza: {NAZWA_BAZY}, Kolekcja: {NAZWA_KOLEKCJI}")
+        if schemat == SCHEMAT_KOMPAKTOWY:
+            collection = utworz_kolekcje_kompaktowa(db)
+        else:
+            collection = db[NAZWA_KOLEKCJI]
+        print(f"Połączono z MongoDB. Baza: {NAZWA_BAZY}, Kolekcja: {collection.name}")
         
     except Exception as e:
         print(f"[BŁĄD KRYTYCZNY] Nie można połączyć z MongoDB: {e}")
@@ -30,20 +163,31 @@ def uruchom_kolektor():
 
     print(f"Rozpoczynam zbieranie danych co {INTERWAL_SEKUNDY} sekund...")
     
+    klient = KlientGTFSRT()
+    filtr = FiltrOdczytow(tylko_zmienione_pojazdy=tylko_zmienione_pojazdy)
+    archiwum = ArchiwumFeedu(katalog_archiwum) if katalog_archiwum else None
+    stan_floty = KlientStanuFloty(adres_stanu) if adres_stanu else None
+    
     while True:
         try:
-            dane_pojazdow, timestamp_serwera = pobierz_dane_gtfs_rt()
+            dane_pojazdow, timestamp_serwera = klient.pobierz()
             
             if dane_pojazdow is not None:
-                dokument = {
-                    "timestamp_serwera_gtfs": timestamp_serwera,
-                    "timestamp_zapisu_db": datetime.now(),
-                    "liczba_aktywnych_pojazdow": len(dane_pojazdow),
-                    "dane_pojazdow": dane_pojazdow
-                }
+                archiwizuj_feed(archiwum, klient, timestamp_serwera)
+                if stan_floty is not None and not klient.niezmieniony:
+                    stan_floty.aktualizuj_pozycje(dane_pojazdow)
+                
+                if pomijaj_niezmienione or tylko_zmienione_pojazdy:
+                    do_zapisu = filtr.filtruj(dane_pojazdow, timestamp_serwera)
+                else:
+                    do_zapisu = dane_pojazdow
                 
-                result = collection.insert_one(dokument)
-                print(f"[{datetime.now()}] Zapisano odczyt. ID: {result.inserted_id}. Pojazdów: {len(dane_pojazdow)}")
+                if do_zapisu is None:
+                    print(f"[{datetime.now()}] Odczyt bez zmian ({timestamp_serwera}) - pominięto. {filtr.podsumowanie()}")
+                else:
+                    opis = zapisz_odczyt(collection, dane_pojazdow, do_zapisu, timestamp_serwera,
+                                         tylko_zmienione_pojazdy, schemat)
+                    print(f"[{datetime.now()}] {opis}")
                 
             else:
                 print(f"[{datetime.now()}] Nie udało się pobrać danych (zwrócono None).")
@@ -53,5 +197,154 @@ def uruchom_kolektor():
 
         time.sleep(INTERWAL_SEKUNDY)
 
+def nastepny_takt(interwal, teraz=None):
+    """Zwraca najbliższą chwilę (epoch) wyrównaną do wielokrotności interwału"""
+    teraz = time.time() if teraz is None else teraz
+    return math.floor(teraz / interwal) * interwal + interwal
+
+
+async def _zapisuj_odczyty(kolejka, collection):
+    """Zapisuje odczyty z kolejki do MongoDB w tle, niezależnie od pobierania"""
+    while True:
+        dokument = await kolejka.get()
+        try:
+            if dokument is None:
+                return
+            if isinstance(dokument, list):
+                # Schemat kompaktowy - dokumenty pojedynczych pojazdów
+                if dokument:
+                    await collection.insert_many(dokument, ordered=False)
+                print(f"[{datetime.now()}] Zapisano odczyt. Pojazdów: {len(dokument)}. "
+                      f"W kolejce: {kolejka.qsize()}")
+                continue
+            result = await collection.insert_one(dokument)
+            print(f"[{datetime.now()}] Zapisano odczyt. ID: {result.inserted_id}. "
+                  f"Pojazdów: {len(dokument['dane_pojazdow'])}/{dokument['liczba_aktywnych_pojazdow']}. "
+                  f"W kolejce: {kolejka.qsize()}")
+        except Exception as e:
+            print(f"[{datetime.now()}] Błąd zapisu do MongoDB: {e}")
+        finally:
+            kolejka.task_done()
+
+
+def _utworz_kolekcje_kompaktowa():
+    """Tworzy kolekcję schematu kompaktowego przez krótko żyjącego klienta synchronicznego"""
+    with pymongo.MongoClient(MONGO_CONNECTION_STRING) as client:
+        utworz_kolekcje_kompaktowa(client[NAZWA_BAZY])
+
+
+async def uruchom_kolektor_async(interwal=INTERWAL_SEKUNDY, pomijaj_niezmienione=POMIJAJ_NIEZMIENIONE,
+                                 tylko_zmienione_pojazdy=TYLKO_ZMIENIONE_POJAZDY, schemat=SCHEMAT_ZAPISU,
+                                 katalog_archiwum=ARCHIWUM_FEEDOW, adres_stanu=STAN_FLOTY):
+    """
+    Kolektor w trybie asyncio
+    
+    Pobieranie odbywa się w stałym rytmie wyrównanym do zegara (np. :00, :30),
+    niezależnie od czasu trwania zapytania i zapisu. Zapis idzie przez
+    ograniczoną kolejkę do zadania w tle - wolne MongoDB nie opóźnia
+    kolejnych pobrań, a przy przepełnieniu odrzucany jest najstarszy odczyt.
+    """
+    print(f"Uruchamianie kolektora danych (asyncio, co {interwal}s)...")
+    
+    try:
+        client = pymongo.AsyncMongoClient(MONGO_CONNECTION_STRING)
+        await client.admin.command('ping')
+        if schemat == SCHEMAT_KOMPAKTOWY:
+            # Jednorazowe utworzenie kolekcji time-series przez klienta synchronicznego
+            await asyncio.to_thread(_utworz_kolekcje_kompaktowa)
+            collection = client[NAZWA_BAZY][NAZWA_KOLEKCJI_KOMPAKTOWEJ]
+        else:
+            collection = client[NAZWA_BAZY][NAZWA_KOLEKCJI]
+        print(f"Połączono z MongoDB. Baza: {NAZWA_BAZY}, Kolekcja: {collection.name}")
+    except Exception as e:
+        print(f"[BŁĄD KRYTYCZNY] Nie można połączyć z MongoDB: {e}")
+        print("Upewnij się, że serwer MongoDB jest uruchomiony, a CONNECTION_STRING jest poprawny.")
+        return
+    
+    klient = KlientGTFSRT()
+    filtr = FiltrOdczytow(tylko_zmienione_pojazdy=tylko_zmienione_pojazdy)
+    archiwum = ArchiwumFeedu(katalog_archiwum) if katalog_archiwum else None
+    stan_floty = KlientStanuFloty(adres_stanu) if adres_stanu else None
+    kolejka = asyncio.Queue(maxsize=ROZMIAR_KOLEJKI_ZAPISU)
+    pisarz = asyncio.create_task(_zapisuj_odczyty(kolejka, collection))
+    
+    takt = nastepny_takt(interwal)
+    pominiete_takty = 0
+    odrzucone_odczyty = 0
+    
+    try:
+        while True:
+            await asyncio.sleep(max(0.0, takt - time.time()))
+            
+            # requests jest blokujące - pobieranie w wątku, przez stałą sesję klienta
+            dane_pojazdow, timestamp_serwera = await asyncio.to_thread(klient.pobierz)
+            
+            if dane_pojazdow is None:
+                print(f"[{datetime.now()}] Nie udało się pobrać danych (zwrócono None).")
+            else:
+                # Zapis na dysk w wątku - nie blokuje pętli zdarzeń
+                await asyncio.to_thread(archiwizuj_feed, archiwum, klient, timestamp_serwera)
+                if stan_floty is not None and not klient.niezmieniony:
+                    # Stan floty dostaje odczyt od razu, przed kolejką zapisu do MongoDB
+                    await asyncio.to_thread(stan_floty.aktualizuj_pozycje, dane_pojazdow)
+                
+                if pomijaj_niezmienione or tylko_zmienione_pojazdy:
+                    do_zapisu = filtr.filtruj(dane_pojazdow, timestamp_serwera)
+                else:
+                    do_zapisu = dane_pojazdow
+                
+                if do_zapisu is not None:
+                    if kolejka.full():
+                        kolejka.get_nowait()
+                        kolejka.task_done()
+                        odrzucone_odczyty += 1
+                        print(f"[{datetime.now()}] Kolejka zapisu pełna - odrzucono najstarszy odczyt "
+                              f"(łącznie {odrzucone_odczyty})")
+                    if schemat == SCHEMAT_KOMPAKTOWY:
+                        kolejka.put_nowait(zbuduj_dokumenty_kompaktowe(do_zapisu, timestamp_serwera))
+                    else:
+                        kolejka.put_nowait(zbuduj_dokument(dane_pojazdow, do_zapisu, timestamp_serwera,
+                                                           tylko_zmienione_pojazdy))
+            
+            takt += interwal
+            teraz = time.time()
+            if teraz >= takt:
+                # Pobranie trwało dłużej niż interwał - przeskakujemy do następnego taktu
+                spoznione = math.floor((teraz - takt) / interwal) + 1
+                takt += spoznione * interwal
+                pominiete_takty += spoznione
+                print(f"[{datetime.now()}] Pominięto taktów: {spoznione} (łącznie {pominiete_takty})")
+    finally:
+        await kolejka.put(None)
+        await pisarz
+        klient.zamknij()
+        if archiwum is not None:
+            archiwum.zamknij()
+        if stan_floty is not None:
+            stan_floty.zamknij()
+        await client.close()
+        print(filtr.podsumowanie())
+
+
 if __name__ == "__main__":
-    uruchom_kolektor()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Kolektor danych GTFS-RT")
+    parser.add_argument("--async", dest="tryb_async", action="store_true",
+                        help="tryb asyncio ze stałym rytmem i zapisem w tle")
+    parser.add_argument("--interwal", type=float, default=INTERWAL_SEKUNDY,
+                        help="interwał pobierania w sekundach (tryb asyncio)")
+    parser.add_argument("--schemat", choices=[SCHEMAT_DOKUMENT, SCHEMAT_KOMPAKTOWY], default=SCHEMAT_ZAPISU,
+                        help="schemat zapisu odczytów")
+    parser.add_argument("--archiwum", nargs="?", const=KATALOG_ARCHIWUM, default=ARCHIWUM_FEEDOW,
+                        help=f"archiwizuj surowe feedy w katalogu (domyślnie {KATALOG_ARCHIWUM})")
+    parser.add_argument("--stan-floty", nargs="?", const=ADRES_STANU_FLOTY, default=STAN_FLOTY,
+                        help=f"wysyłaj odczyty do serwera stanu floty (domyślnie {ADRES_STANU_FLOTY})")
+    args = parser.parse_args()
+    
+    if args.tryb_async:
+        try:
+            asyncio.run(uruchom_kolektor_async(interwal=args.interwal, schemat=args.schemat,
+                                               katalog_archiwum=args.archiwum, adres_stanu=args.stan_floty))
+        except KeyboardInterrupt:
+            print("\nZatrzymano kolektor")
+    else:
+        uruchom_kolektor(schemat=args.schemat, katalog_archiwum=args.archiwum, adres_stanu=args.stan_floty)
\ No newline at end of file
@@ -1,69 +1,364 @@
 import pymongo
+import time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 from scipy.spatial import cKDTree
 
-from gtfs_static_loader import GTFSStaticLoader
+from gtfs_static_loader import GTFSStaticLoader, BRAK_CZASU
+from geometria import ProjekcjaLokalna, KsztaltyTras
+from sledzenie_pojazdow import SledzeniePojazdow
+from stan_floty import KlientStanuFloty
+from warstwa_danych import (NAZWA_KOLEKCJI_AGREGATY, KLUCZ_AGREGATU, operacje_agregatow,
+                            agreguj_z_agregatow, ranking_z_agregatow, znajdz_odczyty,
+                            agreguj_opoznienia, ranking_opoznien, pelna_godzina,
+                            kolumny_pojazdow, liczba_pojazdow,
+                            SCHEMAT_DOKUMENT, SCHEMAT_KOMPAKTOWY, utworz_kolekcje_kompaktowa)
 
 MONGO_CONNECTION_STRING = "mongodb://localhost:27017/"
 NAZWA_BAZY = "ztm_rzeszow_data"
 NAZWA_KOLEKCJI_RT = "odczyty_gtfs_rt"
 NAZWA_KOLEKCJI_OPOZNIENIA = "opoznienia"
+NAZWA_KOLEKCJI_STAN = "stan_przetwarzania"
+ID_CHECKPOINTU = "delay_calculator"
 
 PROMIEN_PRZYSTANKU_METRY = 50
 MAX_OPOZNIENIE_SEKUND = 1800
+ROZMIAR_PARTII_ZAPISU = 1000
+ROZMIAR_PARTII_KURSORA = 50
+KLUCZ_OPOZNIENIA = ['trip_id', 'stop_id', 'timestamp']
+
+# Schemat odczytów GTFS-RT zapisywanych przez kolektor (patrz warstwa_danych)
+SCHEMAT_ODCZYTOW = SCHEMAT_DOKUMENT
+# Schemat kompaktowy: odczyty młodsze niż margines mogą być jeszcze zapisywane
+MARGINES_KOMPLETNOSCI_SEKUND = 60
+
+# Interpolacja przejazdów: czasy minięcia przystanków są interpolowane między
+# kolejnymi pozycjami pojazdu zamiast dopasowania w promieniu przystanku
+INTERPOLUJ_PRZEJAZDY = False
+# Pozycja dalej od trasy kursu (łamanej przez przystanki) jest pomijana
+MAX_ODLEGLOSC_OD_TRASY_METRY = 150
+# Dopuszczalne cofnięcie pozycji na trasie (szum GPS) - dalsze rzuty są odrzucane
+TOLERANCJA_COFNIECIA_METRY = 50
+# Rzut dalej niż pozwala ta prędkość od poprzedniej pozycji jest odrzucany
+MAX_PREDKOSC_POJAZDU_MS = 30
+
+# Ciągła analiza: jak długo strumień zmian czeka na nowy odczyt w jednym
+# wywołaniu (pozwala przerwać pętlę) i co ile odpytywać bazę bez strumienia
+MAX_CZEKANIE_STRUMIENIA_MS = 1000
+INTERWAL_ODPYTYWANIA_SEKUND = 1
 
 class DelayCalculator:
     """Klasa do obliczania opóźnień na podstawie danych GTFS-RT i statycznych"""
     
-    def __init__(self):
+    def __init__(self, schemat_odczytow=SCHEMAT_ODCZYTOW, interpolacja=INTERPOLUJ_PRZEJAZDY):
         self.gtfs_loader = GTFSStaticLoader()
+        self.schemat_odczytow = schemat_odczytow
         self.client = None
         self.db = None
         self.collection_rt = None
         self.collection_delays = None
+        self.collection_stan = None
+        self.collection_agregaty = None
         
         self.stops_kdtree = None
         self.stops_coords = None
+        self.stops_xy = None
         self.stops_ids = None
+        self.projekcja = None
+        self.xy_wzorcow = None
+        self.trasy_przystankow = None
+        self.odleglosci_przystankow = None
+        self._trasy_kursow = {}
+        self.sledzenie = SledzeniePojazdow() if interpolacja else None
         
     def polacz_z_mongodb(self):
         """Łączy się z MongoDB"""
         try:
             self.client = pymongo.MongoClient(MONGO_CONNECTION_STRING)
             self.db = self.client[NAZWA_BAZY]
-            self.collection_rt = self.db[NAZWA_KOLEKCJI_RT]
+            if self.schemat_odczytow == SCHEMAT_KOMPAKTOWY:
+                self.collection_rt = utworz_kolekcje_kompaktowa(self.db)
+            else:
+                self.collection_rt = self.db[NAZWA_KOLEKCJI_RT]
             self.collection_delays = self.db[NAZWA_KOLEKCJI_OPOZNIENIA]
+            self.collection_stan = self.db[NAZWA_KOLEKCJI_STAN]
+            self.collection_agregaty = self.db[NAZWA_KOLEKCJI_AGREGATY]
             
             self.client.admin.command('ping')
             print(f"✓ Połączono z MongoDB")
+            
+            self.utworz_indeksy()
             return True
             
         except Exception as e:
             print(f"[BŁĄD] Nie można połączyć z MongoDB: {e}")
             return False
     
+    def utworz_indeksy(self):
+        """
+        Tworzy unikalny indeks (trip_id, stop_id, timestamp) na kolekcji
+        opóźnień, indeks czasu opóźnień (zapytania dashboardu i raportu),
+        indeks czasu zapisu na kolekcji odczytów oraz unikalny klucz
+        agregatów godzinowych
+        """
+        if self.schemat_odczytow == SCHEMAT_DOKUMENT:
+            self.collection_rt.create_index('timestamp_zapisu_db')
+        self.collection_delays.create_index('timestamp')
+        self.collection_agregaty.create_index(
+            [(pole, pymongo.ASCENDING) for pole in KLUCZ_AGREGATU],
+            unique=True,
+            name='unikalny_agregat'
+        )
+        
+        try:
+            self.collection_delays.create_index(
+                [(pole, pymongo.ASCENDING) for pole in KLUCZ_OPOZNIENIA],
+                unique=True,
+                name='unikalne_opoznienie'
+            )
+        except OperationFailure as e:
+            print(f"[UWAGA] Nie można utworzyć unikalnego indeksu opóźnień "
+                  f"(duplikaty w kolekcji?): {e}")
+    
+    def zapisz_opoznienia(self, opoznienia, rozmiar_partii=ROZMIAR_PARTII_ZAPISU):
+        """
+        Zapisuje opóźnienia partiami przez bulk_write z upsertami
+        
+        Rekord, który już istnieje (ten sam trip_id, stop_id, timestamp),
+        nie jest nadpisywany - dzięki temu ponowne przetwarzanie jest bezpieczne.
+        Nowo wstawione rekordy są doliczane do agregatów godzinowych.
+        
+        Returns:
+            int: Liczba nowo zapisanych opóźnień
+        """
+        nowe = 0
+        
+        for start in range(0, len(opoznienia), rozmiar_partii):
+            partia = opoznienia[start:start + rozmiar_partii]
+            operacje = [
+                UpdateOne(
+                    {pole: opoznienie[pole] for pole in KLUCZ_OPOZNIENIA},
+                    {'$setOnInsert': opoznienie},
+                    upsert=True
+                )
+                for opoznienie in partia
+            ]
+            
+            try:
+                wynik = self.collection_delays.bulk_write(operacje, ordered=False)
+                wstawione = list(wynik.upserted_ids)
+            except BulkWriteError as e:
+                # Równoległe upserty tego samego klucza mogą zgłosić duplikat - to nie błąd
+                bledy = [b for b in e.details.get('writeErrors', []) if b.get('code') != 11000]
+                wstawione = [u['index'] for u in e.details.get('upserted', [])]
+                if bledy:
+                    # Wstawione rekordy muszą trafić do agregatów także przy błędzie
+                    self.aktualizuj_agregaty([partia[i] for i in wstawione])
+                    raise
+            
+            nowe += len(wstawione)
+            self.aktualizuj_agregaty([partia[i] for i in wstawione])
+        
+        return nowe
+    
+    def aktualizuj_agregaty(self, opoznienia):
+        """Dolicza opóźnienia do agregatów godzinowych (linia, przystanek)"""
+        operacje = operacje_agregatow(opoznienia)
+        if operacje:
+            self.collection_agregaty.bulk_write(operacje, ordered=False)
+    
+    def przebuduj_agregaty(self, data_od, data_do=None, rozmiar_partii=ROZMIAR_PARTII_ZAPISU):
+        """
+        Odtwarza agregaty godzinowe z surowych opóźnień w przedziale
+        [data_od, data_do) - np. dla danych zapisanych przed ich wprowadzeniem
+        
+        Returns:
+            int: Liczba zliczonych opóźnień
+        """
+        zakres = {'$gte': pelna_godzina(data_od)}
+        if data_do is not None:
+            zakres['$lt'] = pelna_godzina(data_do)
+        
+        self.collection_agregaty.delete_many({'godzina': zakres})
+        
+        kursor = self.collection_delays.find(
+            {'timestamp': zakres},
+            {'_id': 0, 'timestamp': 1, 'route_short_name': 1, 'stop_id': 1,
+             'stop_name': 1, 'delay_minutes': 1, 'lat': 1, 'lon': 1}
+        ).batch_size(rozmiar_partii)
+        
+        zliczone = 0
+        bufor = []
+        for opoznienie in kursor:
+            bufor.append(opoznienie)
+            if len(bufor) >= rozmiar_partii:
+                self.aktualizuj_agregaty(bufor)
+                zliczone += len(bufor)
+                bufor = []
+        
+        self.aktualizuj_agregaty(bufor)
+        zliczone += len(bufor)
+        
+        print(f"✓ Przebudowano agregaty godzinowe: {zliczone} opóźnień")
+        return zliczone
+    
     def zaladuj_gtfs(self):
         """Ładuje dane GTFS"""
         if not self.gtfs_loader.zaladuj_dane():
             return False
         
-        stops = self.gtfs_loader.stops
+        stops = self.gtfs_loader.stops.dropna(subset=['stop_lat', 'stop_lon'])
         self.stops_coords = stops[['stop_lat', 'stop_lon']].values
         self.stops_ids = stops['stop_id'].values
-        self.stops_kdtree = cKDTree(self.stops_coords)
+        
+        # KD-tree w metrach (lokalna projekcja) - stopnie długości geograficznej
+        # są na tej szerokości ~1.5x krótsze niż stopnie szerokości
+        self.projekcja = ProjekcjaLokalna.dla_punktow(stops['stop_lat'], stops['stop_lon'])
+        self.stops_xy = self.projekcja.na_metry(stops['stop_lat'], stops['stop_lon'])
+        self.stops_kdtree = cKDTree(self.stops_xy)
+        
+        # Współrzędne przystanku dla każdego wiersza wzorców - kursy są
+        # ciągłymi zakresami wierszy wzorca, więc to zarazem tablice
+        # współrzędnych przystanków per kurs
+        stop_id_st = self.gtfs_loader.wzorce['stop_id']
+        pozycje = pd.Index(self.stops_ids).get_indexer(stop_id_st.cat.categories)
+        xy_kategorii = np.full((len(pozycje), 2), np.nan, dtype=np.float32)
+        xy_kategorii[pozycje >= 0] = self.stops_xy[pozycje[pozycje >= 0]]
+        self.xy_wzorcow = xy_kategorii[stop_id_st.cat.codes.to_numpy()]
+        self._zbuduj_trasy(stops, pozycje, stop_id_st.cat.codes.to_numpy())
         
         print(f"✓ Przygotowano indeks przystanków")
         return True
     
+    def _zbuduj_trasy(self, stops, pozycje, kody_przystankow):
+        """
+        Przygotowuje trasy kursów do liczenia postępu wzdłuż trasy
+        
+        Trasą kursu jest jego kształt z shapes.txt, a dla kursów bez kształtu
+        łamana przez przystanki wzorca. Dla każdej pary (wzorzec, kształt)
+        przystanki są rzutowane na kształt po kolei i bez cofania się, więc
+        trasy z pętlą dostają rosnące odległości przystanków.
+        
+        Args:
+            stops: Przystanki ze współrzędnymi (jak w stops_ids)
+            pozycje: Pozycja w stops dla każdej kategorii stop_id wzorców (-1 - brak)
+            kody_przystankow: Kod kategorii stop_id każdego wiersza wzorców
+        """
+        loader = self.gtfs_loader
+        wzorce = loader.wzorce
+        
+        ll_kategorii = np.full((len(pozycje), 2), np.nan)
+        ll_kategorii[pozycje >= 0] = stops[['stop_lat', 'stop_lon']].to_numpy()[pozycje[pozycje >= 0]]
+        ll_wzorcow = ll_kategorii[kody_przystankow]
+        
+        self.trasy_przystankow = KsztaltyTras(ll_wzorcow[:, 0], ll_wzorcow[:, 1], wzorce['wzorzec'].to_numpy(),
+                                              projekcja=self.projekcja)
+        
+        trip_ids = loader.kursy_wzorcow['trip_id'].tolist()
+        numery_wzorcow = loader.kursy_wzorcow['wzorzec'].to_numpy()
+        ksztalty = loader.pobierz_ksztalty_kursow(trip_ids)
+        numery_wierszy = wzorce['wzorzec'].to_numpy()
+        wszystkie_wzorce = np.arange(len(self.trasy_przystankow))
+        zakresy = np.column_stack([np.searchsorted(numery_wierszy, wszystkie_wzorce, side='left'),
+                                   np.searchsorted(numery_wierszy, wszystkie_wzorce, side='right')])
+        
+        # Odległości przystanków: najpierw wzdłuż łamanych przystanków (po wierszach
+        # wzorców), potem kolejne pary (wzorzec, kształt). Odległość wiersza
+        # wzorca kursu to odleglosci_przystankow[przesuniecie kursu + wiersz].
+        odleglosci = [self.trasy_przystankow.odleglosci]
+        przesuniecia_kursow = np.zeros(len(trip_ids), dtype=np.int64)
+        
+        if loader.ksztalty is not None and (ksztalty >= 0).any():
+            z_ksztaltem = ksztalty >= 0
+            pary, numery_par = np.unique(
+                np.column_stack([numery_wzorcow[z_ksztaltem], ksztalty[z_ksztaltem]]), axis=0, return_inverse=True
+            )
+            dlugosci = zakresy[pary[:, 0], 1] - zakresy[pary[:, 0], 0]
+            starty_par = np.cumsum(dlugosci) - dlugosci
+            odleglosci_par = np.full(dlugosci.sum(), np.nan)
+            
+            # Krok k rzutuje k-ty przystanek wszystkich par naraz, z dolnym
+            # ograniczeniem na odległość poprzedniego przystanku
+            poprzednie = np.zeros(len(pary))
+            for k in range(int(dlugosci.max())):
+                aktywne = np.flatnonzero(dlugosci > k)
+                wiersze = zakresy[pary[aktywne, 0], 0] + k
+                wzdluz, _ = loader.ksztalty.przyciagnij(
+                    pary[aktywne, 1], ll_wzorcow[wiersze, 0], ll_wzorcow[wiersze, 1],
+                    min_odleglosc=poprzednie[aktywne]
+                )
+                odleglosci_par[starty_par[aktywne] + k] = wzdluz
+                poprzednie[aktywne] = np.fmax(poprzednie[aktywne], wzdluz)
+            
+            przesuniecia_kursow[z_ksztaltem] = (len(wzorce) + starty_par[numery_par.ravel()] -
+                                                zakresy[numery_wzorcow[z_ksztaltem], 0])
+            odleglosci.append(odleglosci_par)
+        
+        self.odleglosci_przystankow = np.concatenate(odleglosci)
+        self._trasy_kursow = dict(zip(
+            trip_ids, zip(ksztalty.tolist(), numery_wzorcow.tolist(), przesuniecia_kursow.tolist())
+        ))
+    
+    def rzutuj_na_trasy(self, kursy, lat, lon, min_postep=None, max_postep=None):
+        """
+        Rzutuje pozycje pojazdów na trasy ich kursów
+        
+        Args:
+            kursy: trip_id pojazdów
+            lat, lon: Współrzędne pojazdów
+            min_postep, max_postep: Opcjonalne okno postępu dla każdego pojazdu (NaN - brak)
+            
+        Returns:
+            tuple: (postepy, odleglosci_od_trasy) w metrach - NaN i inf, gdy
+                   kurs jest nieznany lub brak rzutu w oknie
+        """
+        n = len(kursy)
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        min_postep = np.full(n, np.nan) if min_postep is None else np.asarray(min_postep, dtype=float)
+        max_postep = np.full(n, np.nan) if max_postep is None else np.asarray(max_postep, dtype=float)
+        
+        trasy = np.array([self._trasy_kursow.get(k, (-1, -1, 0))[:2] for k in kursy], dtype=np.int64).reshape(-1, 2)
+        ksztalty, wzorce = trasy[:, 0], trasy[:, 1]
+        
+        postepy = np.full(n, np.nan)
+        odleglosci = np.full(n, np.inf)
+        
+        z_ksztaltem = ksztalty >= 0
+        if z_ksztaltem.any():
+            postepy[z_ksztaltem], odleglosci[z_ksztaltem] = self.gtfs_loader.ksztalty.przyciagnij(
+                ksztalty[z_ksztaltem], lat[z_ksztaltem], lon[z_ksztaltem],
+                min_postep[z_ksztaltem], max_postep[z_ksztaltem]
+            )
+        bez_ksztaltu = ~z_ksztaltem
+        if bez_ksztaltu.any():
+            postepy[bez_ksztaltu], odleglosci[bez_ksztaltu] = self.trasy_przystankow.przyciagnij(
+                wzorce[bez_ksztaltu], lat[bez_ksztaltu], lon[bez_ksztaltu],
+                min_postep[bez_ksztaltu], max_postep[bez_ksztaltu]
+            )
+        
+        return postepy, odleglosci
+    
+    def odleglosci_wierszy(self, kursy, wiersze, wlasciciele):
+        """
+        Zwraca odległość przystanków wzdłuż trasy kursu dla wierszy wzorców
+        
+        Args:
+            kursy: trip_id przekazane do pobierz_wiersze_kursow
+            wiersze, wlasciciele: Wynik pobierz_wiersze_kursow (lub jego podzbiór)
+        """
+        przesuniecia = np.array([self._trasy_kursow.get(k, (-1, -1, 0))[2] for k in kursy], dtype=np.int64)
+        return self.odleglosci_przystankow[przesuniecia[wlasciciele] + wiersze]
+    
     def znajdz_najblizszy_przystanek(self, lat, lon, max_distance_km=0.1):
         """Znajduje najbliższy przystanek do podanych koordynatów"""
         if self.stops_kdtree is None:
             return None, None
         
-        distance, index = self.stops_kdtree.query([lat, lon])
-        distance_meters = distance * 111000
+        distance_meters, index = self.stops_kdtree.query(self.projekcja.na_metry(lat, lon)[0])
         
         if distance_meters < max_distance_km * 1000:
             stop_id = int(self.stops_ids[index])
@@ -71,6 +366,81 @@ class DelayCalculator:
         
         return None, None
     
+    def dopasuj_przystanki_kursow(self, kursy, lat, lon, promien_metry=PROMIEN_PRZYSTANKU_METRY):
+        """
+        Dla każdego pojazdu znajduje najbliższy przystanek jego własnego kursu
+        
+        Odległości są liczone wektorowo tylko do przystanków kursu pojazdu,
+        więc bliski przystanek innej linii nie zasłania przystanku kursu.
+        Przy remisie (przystanek odwiedzany dwukrotnie) wybierany jest
+        pierwszy wg stop_sequence.
+        
+        Args:
+            kursy: trip_id pojazdów
+            lat, lon: Współrzędne pojazdów
+            promien_metry: Maksymalna odległość od przystanku
+            
+        Returns:
+            tuple: (wlasciciele, wiersze, odleglosci) - pozycja pojazdu, wiersz
+                   wzorca i odległość w metrach, tylko dla dopasowanych pojazdów
+        """
+        wiersze, wlasciciele = self.gtfs_loader.pobierz_wiersze_kursow(kursy)
+        
+        xy_pojazdow = self.projekcja.na_metry(lat, lon)
+        roznice = self.xy_wzorcow[wiersze] - xy_pojazdow[wlasciciele]
+        odleglosci = np.hypot(roznice[:, 0], roznice[:, 1])
+        
+        w_promieniu = odleglosci < promien_metry
+        wiersze = wiersze[w_promieniu]
+        wlasciciele = wlasciciele[w_promieniu]
+        odleglosci = odleglosci[w_promieniu]
+        
+        kolejnosc = np.lexsort((wiersze, odleglosci, wlasciciele))
+        wlasciciele, pierwsze = np.unique(wlasciciele[kolejnosc], return_index=True)
+        
+        return wlasciciele, wiersze[kolejnosc][pierwsze], odleglosci[kolejnosc][pierwsze]
+    
+    def aktywne_kursy_odczytu(self, kursy, timestamp_odczytu):
+        """
+        Zwraca maskę kursów kursujących w dniu odczytu lub dniu poprzednim
+        (kursy po północy należą do dnia kursowania, w którym wyjechały)
+        """
+        dzis = timestamp_odczytu.date()
+        return (self.gtfs_loader.czy_kursy_aktywne(kursy, dzis) |
+                self.gtfs_loader.czy_kursy_aktywne(kursy, dzis - timedelta(days=1)))
+    
+    def oblicz_opoznienia_kursow(self, kursy, czasy_przyjazdu, timestamp_odczytu, czasy_zdarzen=None):
+        """
+        Liczy opóźnienia względem dnia kursowania każdego kursu
+        
+        Kandydatami są dzień odczytu i dzień poprzedni (czasy >= 24:00:00),
+        ale tylko te, w których kurs kursuje wg kalendarza. Wybierany jest
+        dzień dający mniejsze opóźnienie.
+        
+        Args:
+            czasy_zdarzen: Opcjonalne rzeczywiste czasy przyjazdów (epoka) dla
+                           każdego kursu; domyślnie timestamp_odczytu
+        
+        Returns:
+            ndarray: Opóźnienia w sekundach, inf gdy kurs nie kursuje lub brak czasu
+        """
+        czasy = np.asarray(czasy_przyjazdu, dtype=np.int64)
+        opoznienia = np.full(len(czasy), np.inf)
+        dzis = timestamp_odczytu.date()
+        
+        for dzien in (dzis, dzis - timedelta(days=1)):
+            if czasy_zdarzen is None:
+                sekundy = self.gtfs_loader.sekundy_dnia_kursowania(timestamp_odczytu, dzien)
+            else:
+                sekundy = np.round(czasy_zdarzen - self.gtfs_loader.poczatek_dnia_kursowania(dzien))
+            kandydaci = sekundy - czasy
+            lepsze = (self.gtfs_loader.czy_kursy_aktywne(kursy, dzien) &
+                      (czasy != BRAK_CZASU) &
+                      (np.abs(kandydaci) < np.abs(opoznienia)))
+            opoznienia = np.where(lepsze, kandydaci, opoznienia)
+        
+        return opoznienia
+    
     def oblicz_opoznienie_dla_pojazdu(self, dane_pojazdu, timestamp_odczytu):
         """Oblicza opóźnienie dla pojedynczego pojazdu"""
         
@@ -93,42 +463,36 @@ class DelayCalculator:
         if lat is None or lon is None:
             return None
      
-        stop_id, distance = self.znajdz_najblizszy_przystanek(lat, lon, max_distance_km=0.05)
-        
-        if stop_id is None:
+        if self.xy_wzorcow is None:
             return None
         
-        przystanki_kursu = self.gtfs_loader.pobierz_wszystkie_przystanki_kursu(trip_id)
-        
-        if not przystanki_kursu:
+        if not self.aktywne_kursy_odczytu([trip_id], timestamp_odczytu)[0]:
             return None
         
-        przystanek_na_kursie = None
-        for p in przystanki_kursu:
-            if int(p['stop_id']) == int(stop_id):
-                przystanek_na_kursie = p
-                break
+        znalezione, wiersze, odleglosci = self.dopasuj_przystanki_kursow([trip_id], [lat], [lon])
         
-        if przystanek_na_kursie is None:
+        if len(znalezione) == 0:
             return None
         
-        zaplanowany_czas_str = przystanek_na_kursie['arrival_time']
-        zaplanowany_czas_sek = self.gtfs_loader.konwertuj_czas_na_sekundy(zaplanowany_czas_str)
+        wzorce = self.gtfs_loader.wzorce
+        wiersz = int(wiersze[0])
+        stop_id = int(wzorce['stop_id'].array[wiersz])
+        sekwencja = int(wzorce['stop_sequence'].array[wiersz])
+        distance = odleglosci[0]
         
-        if zaplanowany_czas_sek is None:
+        zaplanowany_czas_sek = int(self.gtfs_loader.pobierz_czasy_przyjazdu([trip_id], wiersze, znalezione)[0])
+        if zaplanowany_czas_sek == BRAK_CZASU:
             return None
+        zaplanowany_czas_str = self.gtfs_loader.sekundy_na_czas(zaplanowany_czas_sek)
         
         rzeczywisty_czas = timestamp_odczytu
         sekund_od_polnocy = (rzeczywisty_czas.hour * 3600 + 
                             rzeczywisty_czas.minute * 60 + 
                             rzeczywisty_czas.second)
         
-        if zaplanowany_czas_sek >= 86400:
-            zaplanowany_czas_sek -= 86400
-        
-        opoznienie_sek = sekund_od_polnocy - zaplanowany_czas_sek
+        opoznienie_sek = self.oblicz_opoznienia_kursow([trip_id], [zaplanowany_czas_sek], timestamp_odczytu)[0]
 
-        if abs(opoznienie_sek) > MAX_OPOZNIENIE_SEKUND:
+        if not abs(opoznienie_sek) <= MAX_OPOZNIENIE_SEKUND:
             return None
         
         info_kursu = self.gtfs_loader.pobierz_info_o_kursie(trip_id)
@@ -141,7 +505,7 @@ class DelayCalculator:
             'vehicle_id': str(dane_pojazdu.get('id_pojazdu', '')),
             'stop_id': int(stop_id),
             'stop_name': str(info_przystanku.get('stop_name', '')) if info_przystanku else None,
-            'stop_sequence': int(przystanek_na_kursie['stop_sequence']),
+            'stop_sequence': sekwencja,
             'scheduled_arrival': str(zaplanowany_czas_str),
             'actual_arrival_seconds': int(sekund_od_polnocy),
             'delay_seconds': int(opoznienie_sek),
@@ -153,42 +517,340 @@ class DelayCalculator:
             'lon': float(lon),
         }
     
-    def przetwórz_odczyt_historyczny(self, odczyt_id=None, limit=100):
+    def _pojazdy_na_kursach(self, pojazdy, timestamp_odczytu, maska=None):
+        """
+        Wybiera pojazdy odczytu z poprawnym trip_id i współrzędnymi na kursach
+        kursujących wg kalendarza - wspólne reguły wszystkich metod odczytu
+        
+        Args:
+            pojazdy: Kolumny pojazdów (kolumny_pojazdow)
+            maska: Dodatkowy warunek na pojazdy (tablica bool) lub None
+        
+        Returns:
+            tuple: (indeksy wybranych pojazdów, ich trip_id jako int64)
+        """
+        trip_ids = pojazdy['trip_id']
+        poprawne = (~np.isnan(trip_ids) & (trip_ids % 1 == 0) &
+                    ~np.isnan(pojazdy['lat']) & ~np.isnan(pojazdy['lon']))
+        if maska is not None:
+            poprawne &= maska
+        kandydaci = np.flatnonzero(poprawne)
+        kursy = trip_ids[kandydaci].astype(np.int64)
+        
+        if len(kandydaci):
+            aktywne = self.aktywne_kursy_odczytu(kursy.tolist(), timestamp_odczytu)
+            kandydaci = kandydaci[aktywne]
+            kursy = kursy[aktywne]
+        
+        return kandydaci, kursy
+    
+    def oblicz_opoznienia_dla_odczytu(self, dane_pojazdow, timestamp_odczytu):
+        """
+        Oblicza opóźnienia dla wszystkich pojazdów z jednego odczytu naraz
+        
+        Zamiast pętli po pojazdach liczy naraz odległości wszystkich pojazdów
+        do przystanków ich własnych kursów (dopasuj_przystanki_kursow).
+        
+        Args:
+            dane_pojazdow: Lista słowników pojazdów z odczytu GTFS-RT lub
+                           ich kolumny (znajdz_odczyty(kolumnowo=True))
+            timestamp_odczytu: Czas odczytu (datetime)
+            
+        Returns:
+            list: Rekordy opóźnień w formacie oblicz_opoznienie_dla_pojazdu
+        """
+        if not dane_pojazdow or self.xy_wzorcow is None:
+            return []
+        
+        if self.sledzenie is not None:
+            return self.oblicz_opoznienia_interpolowane(dane_pojazdow, timestamp_odczytu)
+        
+        pojazdy = kolumny_pojazdow(dane_pojazdow)
+        kandydaci, kursy = self._pojazdy_na_kursach(pojazdy, timestamp_odczytu)
+        
+        if len(kandydaci) == 0:
+            return []
+        
+        wlasciciele, wiersze, odleglosci_wierszy = self.dopasuj_przystanki_kursow(
+            kursy.tolist(), pojazdy['lat'][kandydaci], pojazdy['lon'][kandydaci]
+        )
+        
+        if len(wiersze) == 0:
+            return []
+        
+        wzorce = self.gtfs_loader.wzorce
+        stop_ids = wzorce['stop_id'].to_numpy()[wiersze].astype(np.int64)
+        
+        sekund_od_polnocy = (timestamp_odczytu.hour * 3600 +
+                             timestamp_odczytu.minute * 60 +
+                             timestamp_odczytu.second)
+        
+        czasy_przyjazdu = self.gtfs_loader.pobierz_czasy_przyjazdu(
+            kursy.tolist(), wiersze, wlasciciele
+        )
+        opoznienia = self.oblicz_opoznienia_kursow(
+            kursy[wlasciciele].tolist(), czasy_przyjazdu, timestamp_odczytu
+        )
+        sekwencje = wzorce['stop_sequence'].to_numpy()[wiersze].tolist()
+        
+        rekordy = []
+        dopasowane = zip(wlasciciele.tolist(), czasy_przyjazdu.tolist(), opoznienia.tolist(), sekwencje)
+        for i, (wlasciciel, zaplanowany_czas_sek, opoznienie_sek, sekwencja) in enumerate(dopasowane):
+            if not abs(opoznienie_sek) <= MAX_OPOZNIENIE_SEKUND:
+                continue
+            
+            czas_str = self.gtfs_loader.sekundy_na_czas(zaplanowany_czas_sek)
+            
+            j = kandydaci[wlasciciel]
+            trip_id = int(kursy[wlasciciel])
+            stop_id = int(stop_ids[i])
+            info_kursu = self.gtfs_loader.pobierz_info_o_kursie(trip_id)
+            info_przystanku = self.gtfs_loader.pobierz_info_o_przystanku(stop_id)
+            
+            rekordy.append({
+                'timestamp': timestamp_odczytu,
+                'trip_id': trip_id,
+                'route_id': pojazdy['route_id'][j],
+                'vehicle_id': pojazdy['id_pojazdu'][j],
+                'stop_id': stop_id,
+                'stop_name': str(info_przystanku.get('stop_name', '')) if info_przystanku else None,
+                'stop_sequence': int(sekwencja),
+                'scheduled_arrival': str(czas_str),
+                'actual_arrival_seconds': int(sekund_od_polnocy),
+                'delay_seconds': int(opoznienie_sek),
+                'delay_minutes': round(float(opoznienie_sek) / 60, 1),
+                'distance_to_stop_meters': round(float(odleglosci_wierszy[i]), 1),
+                'route_short_name': str(info_kursu.get('route_short_name', '')) if info_kursu else None,
+                'trip_headsign': str(info_kursu.get('trip_headsign', '')) if info_kursu else None,
+                'lat': float(pojazdy['lat'][j]),
+                'lon': float(pojazdy['lon'][j]),
+            })
+        
+        return rekordy
+    
+    def szacuj_opoznienia_pojazdow(self, dane_pojazdow, timestamp_odczytu):
+        """
+        Szacuje bieżące opóźnienie pojazdów w dowolnym miejscu trasy
+        
+        Pozycja jest rzutowana na trasę kursu, a czas rozkładowy w tym punkcie
+        interpolowany liniowo między sąsiednimi przystankami wg odległości
+        wzdłuż trasy. Nie wymaga historii ani zbliżenia do przystanku.
+        
+        Returns:
+            list: Słowniki z vehicle_id, trip_id, route_id, postep_metry,
+                  odleglosc_od_trasy_metry i delay_seconds dla pojazdów na trasie
+        """
+        if not dane_pojazdow or self.trasy_przystankow is None:
+            return []
+        
+        pojazdy = kolumny_pojazdow(dane_pojazdow)
+        kandydaci, kursy = self._pojazdy_na_kursach(pojazdy, timestamp_odczytu)
+        
+        if len(kandydaci) == 0:
+            return []
+        
+        postepy, odleglosci_od_trasy = self.rzutuj_na_trasy(
+            kursy.tolist(), pojazdy['lat'][kandydaci], pojazdy['lon'][kandydaci]
+        )
+        
+        # Przystanki kursów z czasem i położeniem na trasie, posortowane po
+        # (pojazd, odległość) - odległości w obrębie kursu są niemalejące
+        wiersze, wlasciciele = self.gtfs_loader.pobierz_wiersze_kursow(kursy.tolist())
+        odleglosci = self.odleglosci_wierszy(kursy.tolist(), wiersze, wlasciciele)
+        czasy = self.gtfs_loader.pobierz_czasy_przyjazdu(kursy.tolist(), wiersze, wlasciciele)
+        znane = ~np.isnan(odleglosci) & (czasy != BRAK_CZASU)
+        odleglosci, czasy, wlasciciele = odleglosci[znane], czasy[znane], wlasciciele[znane]
+        
+        if len(odleglosci) == 0:
+            return []
+        
+        liczby = np.bincount(wlasciciele, minlength=len(kandydaci))
+        pierwsze = np.cumsum(liczby) - liczby
+        ostatnie = pierwsze + liczby - 1
+        
+        # Pozycja ostatniego przystanku nie dalej niż pojazd, ograniczona do zakresu kursu
+        skala = np.nanmax(np.r_[odleglosci, postepy[np.isfinite(postepy)], 0]) + 1
+        klucze = wlasciciele * skala + odleglosci
+        szukane = np.arange(len(kandydaci)) * skala + np.clip(np.nan_to_num(postepy), 0, None)
+        k = np.clip(np.searchsorted(klucze, szukane, side='right') - 1, pierwsze, np.maximum(ostatnie - 1, pierwsze))
+        nastepny = np.minimum(k + 1, np.maximum(ostatnie, pierwsze))
+        
+        na_trasie = (liczby > 0) & (odleglosci_od_trasy <= MAX_ODLEGLOSC_OD_TRASY_METRY)
+        k, nastepny = np.where(na_trasie, k, 0), np.where(na_trasie, nastepny, 0)
+        
+        dlugosc = odleglosci[nastepny] - odleglosci[k]
+        udzial = np.clip(np.divide(postepy - odleglosci[k], dlugosc, out=np.zeros(len(k)), where=dlugosc > 0), 0, 1)
+        czas_rozkladowy = np.round(czasy[k] + udzial * (czasy[nastepny] - czasy[k])).astype(np.int64)
+        opoznienia = self.oblicz_opoznienia_kursow(kursy.tolist(), czas_rozkladowy, timestamp_odczytu)
+        
+        wyniki = []
+        for i in np.flatnonzero(na_trasie & (np.abs(opoznienia) <= MAX_OPOZNIENIE_SEKUND)).tolist():
+            j = kandydaci[i]
+            wyniki.append({
+                'vehicle_id': pojazdy['id_pojazdu'][j],
+                'trip_id': int(kursy[i]),
+                'route_id': pojazdy['route_id'][j],
+                'postep_metry': round(float(postepy[i]), 1),
+                'odleglosc_od_trasy_metry': round(float(odleglosci_od_trasy[i]), 1),
+                'delay_seconds': int(opoznienia[i]),
+                'lat': float(pojazdy['lat'][j]),
+                'lon': float(pojazdy['lon'][j]),
+            })
+        
+        return wyniki
+    
+    def oblicz_opoznienia_interpolowane(self, dane_pojazdow, timestamp_odczytu):
+        """
+        Oblicza opóźnienia z interpolacji między kolejnymi pozycjami pojazdów
+        
+        Każda pozycja jest rzutowana na trasę kursu (rzutuj_na_trasy), a postęp
+        wzdłuż trasy trafia do historii pojazdu (SledzeniePojazdow). Dla
+        każdego przystanku minionego od poprzedniej pozycji czas przejazdu jest
+        interpolowany liniowo między obiema pozycjami - niezależnie od tego,
+        czy któryś odczyt złapał pojazd w promieniu przystanku. Odczyty muszą
+        być podawane w kolejności czasu.
+        
+        Returns:
+            list: Rekordy opóźnień; timestamp i actual_arrival_seconds to
+                  interpolowany czas przejazdu, distance_to_stop_meters to
+                  odległość wzdłuż trasy do bliższej z dwóch pozycji
+        """
+        kolumny = kolumny_pojazdow(dane_pojazdow)
+        
+        # Pojazd zgłoszony kilka razy w jednym odczycie - liczy się pierwsza pozycja
+        pierwsze = np.zeros(len(kolumny['id_pojazdu']), dtype=bool)
+        pierwsze[np.unique(kolumny['id_pojazdu'], return_index=True)[1]] = True
+        kandydaci, kursy = self._pojazdy_na_kursach(kolumny, timestamp_odczytu, pierwsze)
+        pojazdy = kolumny['id_pojazdu'][kandydaci]
+        
+        if len(kandydaci) == 0:
+            return []
+        
+        # Pozycja bez własnego czasu dostaje czas odczytu
+        czasy = kolumny['timestamp_danych'][kandydaci]
+        czasy = np.where(np.isnan(czasy), timestamp_odczytu.timestamp(), czasy)
+        poprzednie_czasy, poprzednie_postepy = self.sledzenie.ostatnie(pojazdy.tolist(), kursy, czasy)
+        
+        # Na trasach z pętlą lub przecinających się pojazd nie może "wrócić"
+        # na wcześniejszy fragment ani przeskoczyć dalej, niż zdążyłby dojechać
+        zasieg = poprzednie_postepy + MAX_PREDKOSC_POJAZDU_MS * (czasy - poprzednie_czasy)
+        postep, odleglosci_od_trasy = self.rzutuj_na_trasy(
+            kursy.tolist(), kolumny['lat'][kandydaci], kolumny['lon'][kandydaci],
+            poprzednie_postepy - TOLERANCJA_COFNIECIA_METRY, zasieg + TOLERANCJA_COFNIECIA_METRY
+        )
+        dopasowane = np.flatnonzero(odleglosci_od_trasy <= MAX_ODLEGLOSC_OD_TRASY_METRY)
+        postep[odleglosci_od_trasy > MAX_ODLEGLOSC_OD_TRASY_METRY] = np.nan
+        
+        # Drobne cofnięcie to szum - zostaje poprzedni postęp
+        self.sledzenie.dopisz(pojazdy[dopasowane].tolist(), kursy[dopasowane], czasy[dopasowane],
+                              np.fmax(postep[dopasowane], poprzednie_postepy[dopasowane]))
+        
+        ruch = (postep > poprzednie_postepy) & (czasy > poprzednie_czasy)
+        
+        # Przystanki kursu minięte od poprzedniej pozycji
+        wiersze, wlasciciele = self.gtfs_loader.pobierz_wiersze_kursow(kursy.tolist())
+        odleglosci_przystankow = self.odleglosci_wierszy(kursy.tolist(), wiersze, wlasciciele)
+        p0 = poprzednie_postepy[wlasciciele]
+        p1 = postep[wlasciciele]
+        minione = ruch[wlasciciele] & (odleglosci_przystankow > p0) & (odleglosci_przystankow <= p1)
+        wiersze = wiersze[minione]
+        wlasciciele = wlasciciele[minione]
+        
+        if len(wiersze) == 0:
+            return []
+        
+        p0 = p0[minione]
+        p1 = p1[minione]
+        t0 = poprzednie_czasy[wlasciciele]
+        odleglosci_przystankow = odleglosci_przystankow[minione]
+        czasy_przejazdu = t0 + (odleglosci_przystankow - p0) / (p1 - p0) * (czasy[wlasciciele] - t0)
+        odleglosci_do_pozycji = np.minimum(odleglosci_przystankow - p0, p1 - odleglosci_przystankow)
+        
+        czasy_przyjazdu = self.gtfs_loader.pobierz_czasy_przyjazdu(kursy.tolist(), wiersze, wlasciciele)
+        opoznienia = self.oblicz_opoznienia_kursow(
+            kursy[wlasciciele].tolist(), czasy_przyjazdu, timestamp_odczytu, czasy_przejazdu
+        )
+        
+        wzorce = self.gtfs_loader.wzorce
+        stop_ids = wzorce['stop_id'].to_numpy()[wiersze].astype(np.int64)
+        sekwencje = wzorce['stop_sequence'].to_numpy()[wiersze].tolist()
+        
+        rekordy = []
+        zdarzenia = zip(wlasciciele.tolist(), czasy_przyjazdu.tolist(), opoznienia.tolist(),
+                        czasy_przejazdu.tolist(), odleglosci_do_pozycji.tolist(), sekwencje)
+        for i, (wlasciciel, zaplanowany_sek, opoznienie_sek, przejazd_sek, odleglosc, sekwencja) in enumerate(zdarzenia):
+            if not abs(opoznienie_sek) <= MAX_OPOZNIENIE_SEKUND:
+                continue
+            
+            j = kandydaci[wlasciciel]
+            trip_id = int(kursy[wlasciciel])
+            stop_id = int(stop_ids[i])
+            info_kursu = self.gtfs_loader.pobierz_info_o_kursie(trip_id)
+            info_przystanku = self.gtfs_loader.pobierz_info_o_przystanku(stop_id)
+            przejazd = datetime.fromtimestamp(round(przejazd_sek))
+            
+            rekordy.append({
+                'timestamp': przejazd,
+                'trip_id': trip_id,
+                'route_id': kolumny['route_id'][j],
+                'vehicle_id': kolumny['id_pojazdu'][j],
+                'stop_id': stop_id,
+                'stop_name': str(info_przystanku.get('stop_name', '')) if info_przystanku else None,
+                'stop_sequence': int(sekwencja),
+                'scheduled_arrival': str(self.gtfs_loader.sekundy_na_czas(zaplanowany_sek)),
+                'actual_arrival_seconds': przejazd.hour * 3600 + przejazd.minute * 60 + przejazd.second,
+                'delay_seconds': int(opoznienie_sek),
+                'delay_minutes': round(float(opoznienie_sek) / 60, 1),
+                'distance_to_stop_meters': round(float(odleglosc), 1),
+                'route_short_name': str(info_kursu.get('route_short_name', '')) if info_kursu else None,
+                'trip_headsign': str(info_kursu.get('trip_headsign', '')) if info_kursu else None,
+                'lat': float(info_przystanku['stop_lat']) if info_przystanku else float(kolumny['lat'][j]),
+                'lon': float(info_przystanku['stop_lon']) if info_przystanku else float(kolumny['lon'][j]),
+                'interpolowany': True,
+            })
+        
+        return rekordy
+    
+    def przetwórz_odczyt_historyczny(self, odczyt_id=None, limit=100, rozmiar_partii=ROZMIAR_PARTII_ZAPISU):
         """Przetwarza historyczne odczyty i oblicza opóźnienia"""
         if odczyt_id:
-            odczyty = list(self.collection_rt.find({'_id': odczyt_id}))
+            odczyty = list(znajdz_odczyty(self.collection_rt, {'_id': odczyt_id},
+                                          schemat=self.schemat_odczytow, kolumnowo=True))
         else:
-            odczyty = list(self.collection_rt.find().sort('timestamp_zapisu_db', -1).limit(limit))
+            odczyty = list(znajdz_odczyty(
+                self.collection_rt, sortowanie=[('timestamp_zapisu_db', pymongo.DESCENDING)], limit=limit,
+                schemat=self.schemat_odczytow, kolumnowo=True
+            ))
+            # Ostatnie N odczytów przetwarzamy od najstarszego - interpolacja
+            # przejazdów wymaga kolejności czasu
+            odczyty.reverse()
         
         print(f"\nPrzetwarzam {len(odczyty)} odczytów...")
         
         opoznienia_znalezione = 0
         pominiete = 0
         bledy = 0
+        bufor = []
         
         for odczyt in odczyty:
             timestamp = odczyt.get('timestamp_serwera_gtfs') or odczyt.get('timestamp_zapisu_db')
+            dane_pojazdow = odczyt.get('dane_pojazdow', [])
             
-            for dane_pojazdu in odczyt.get('dane_pojazdow', []):
-                try:
-                    opoznienie = self.oblicz_opoznienie_dla_pojazdu(dane_pojazdu, timestamp)
-                    
-                    if opoznienie:
-                        exists = self.collection_delays.find_one({
-                            'trip_id': opoznienie['trip_id'],
-                            'stop_id': opoznienie['stop_id'],
-                            'timestamp': opoznienie['timestamp']
-                        })
-                        
-                        if not exists:
-                            self.collection_delays.insert_one(opoznienie)
-                            opoznienia_znalezione += 1
-                    else:
-                        pominiete += 1
-                        
-                except Exception as e:
-                    bledy += 1
-                    continue
+            try:
+                opoznienia = self.oblicz_opoznienia_dla_odczytu(dane_pojazdow, timestamp)
+            except Exception as e:
+                bledy += 1
+                continue
+            
+            pominiete += liczba_pojazdow(dane_pojazdow) - len(opoznienia)
+            bufor.extend(opoznienia)
+            
+            if len(bufor) >= rozmiar_partii:
+                opoznienia_znalezione += self.zapisz_opoznienia(bufor, rozmiar_partii)
+                bufor = []
+        
+        if bufor:
+            opoznienia_znalezione += self.zapisz_opoznienia(bufor, rozmiar_partii)
         
         print(f"✓ Znaleziono {opoznienia_znalezione} nowych opóźnień")
         print(f"  Pominięto: {pominiete} (brak trip_id, poza przystankiem, itp.)")
@@ -197,59 +859,297 @@ class DelayCalculator:
         
         return opoznienia_znalezione
     
+    def _id_checkpointu(self):
+        """Każdy schemat odczytów ma osobny checkpoint - ich _id są różnych typów"""
+        if self.schemat_odczytow == SCHEMAT_KOMPAKTOWY:
+            return f"{ID_CHECKPOINTU}_{SCHEMAT_KOMPAKTOWY}"
+        return ID_CHECKPOINTU
+    
+    def wczytaj_checkpoint(self):
+        """Zwraca _id ostatniego przetworzonego odczytu lub None"""
+        stan = self.collection_stan.find_one({'_id': self._id_checkpointu()})
+        return stan.get('ostatni_id') if stan else None
+    
+    def zapisz_checkpoint(self, ostatni_id, ostatni_timestamp):
+        """Zapisuje _id i timestamp ostatniego przetworzonego odczytu"""
+        self.collection_stan.update_one(
+            {'_id': self._id_checkpointu()},
+            {'$set': {
+                'ostatni_id': ostatni_id,
+                'ostatni_timestamp': ostatni_timestamp,
+                'zaktualizowano': datetime.now(),
+            }},
+            upsert=True
+        )
+    
+    def przetwarzaj_przyrostowo(self, rozmiar_partii=ROZMIAR_PARTII_ZAPISU, rozmiar_kursora=ROZMIAR_PARTII_KURSORA):
+        """
+        Przetwarza wszystkie odczyty nowsze niż zapisany checkpoint
+        
+        Odczyty są czytane kursorem w kolejności _id. Checkpoint jest
+        przesuwany dopiero po zapisaniu opóźnień z danej partii, a zapis jest
+        idempotentny - po awarii wystarczy uruchomić przetwarzanie ponownie.
+        
+        Returns:
+            int: Liczba nowo zapisanych opóźnień
+        """
+        ostatni_id = self.wczytaj_checkpoint()
+        zapytanie = {'_id': {'$gt': ostatni_id}} if ostatni_id is not None else {}
+        
+        if self.schemat_odczytow == SCHEMAT_KOMPAKTOWY:
+            # _id odczytu to jego czas - pomijamy odczyty, których pojazdy
+            # mogą być jeszcze w trakcie zapisu
+            granica = datetime.now() - timedelta(seconds=MARGINES_KOMPLETNOSCI_SEKUND)
+            zapytanie.setdefault('_id', {})['$lt'] = granica
+        
+        kursor = znajdz_odczyty(
+            self.collection_rt, zapytanie, sortowanie=[('_id', pymongo.ASCENDING)],
+            rozmiar_kursora=rozmiar_kursora, schemat=self.schemat_odczytow, kolumnowo=True
+        )
+        
+        start = time.monotonic()
+        odczyty, opoznienia_znalezione, bledy = self._przetworz_kursor(
+            kursor, rozmiar_partii, rozmiar_kursora, po_zapisie=self.zapisz_checkpoint
+        )
+        
+        czas = time.monotonic() - start
+        if odczyty > 0:
+            print(f"✓ Przetworzono {odczyty} odczytów, {opoznienia_znalezione} nowych opóźnień "
+                  f"w {czas:.1f}s ({odczyty / czas:.1f} odczytów/s, {opoznienia_znalezione / czas:.0f} opóźnień/s)")
+            if bledy > 0:
+                print(f"  Błędy: {bledy}")
+        
+        return opoznienia_znalezione
+    
+    def przetworz_zakres(self, data_od, data_do, rozmiar_partii=ROZMIAR_PARTII_ZAPISU,
+                         rozmiar_kursora=ROZMIAR_PARTII_KURSORA):
+        """
+        Przetwarza odczyty zapisane w przedziale [data_od, data_do) bez checkpointu
+        
+        Returns:
+            tuple: (liczba odczytów, liczba nowych opóźnień, liczba błędów)
+        """
+        kursor = znajdz_odczyty(
+            self.collection_rt, {'timestamp_zapisu_db': {'$gte': data_od, '$lt': data_do}},
+            sortowanie=[('timestamp_zapisu_db', pymongo.ASCENDING)], rozmiar_kursora=rozmiar_kursora,
+            schemat=self.schemat_odczytow, kolumnowo=True
+        )
+        
+        return self._przetworz_kursor(kursor, rozmiar_partii, rozmiar_kursora)
+    
+    def _przetworz_kursor(self, kursor, rozmiar_partii, rozmiar_kursora, po_zapisie=None):
+        """
+        Oblicza opóźnienia dla odczytów z kursora i zapisuje je partiami
+        
+        Args:
+            po_zapisie: Wywoływane z (_id, timestamp) ostatniego odczytu po
+                        każdym zapisie partii, np. do przesunięcia checkpointu
+        
+        Returns:
+            tuple: (liczba odczytów, liczba nowych opóźnień, liczba błędów)
+        """
+        odczyty = 0
+        opoznienia_znalezione = 0
+        bledy = 0
+        bufor = []
+        ostatni_odczyt = None
+        
+        for odczyt in kursor:
+            timestamp = odczyt.get('timestamp_serwera_gtfs') or odczyt.get('timestamp_zapisu_db')
+            
+            try:
+                bufor.extend(self.oblicz_opoznienia_dla_odczytu(odczyt.get('dane_pojazdow', []), timestamp))
+            except Exception as e:
+                print(f"[BŁĄD] Odczyt {odczyt['_id']}: {e}")
+                bledy += 1
+            
+            odczyty += 1
+            ostatni_odczyt = (odczyt['_id'], timestamp)
+            
+            if len(bufor) >= rozmiar_partii or odczyty % rozmiar_kursora == 0:
+                opoznienia_znalezione += self.zapisz_opoznienia(bufor, rozmiar_partii)
+                bufor = []
+                if po_zapisie:
+                    po_zapisie(*ostatni_odczyt)
+        
+        if ostatni_odczyt is not None:
+            opoznienia_znalezione += self.zapisz_opoznienia(bufor, rozmiar_partii)
+            if po_zapisie:
+                po_zapisie(*ostatni_odczyt)
+        
+        return odczyty, opoznienia_znalezione, bledy
+    
     def generuj_raport_opoznien(self, dni_wstecz=7):
-        """Generuje raport opóźnień z ostatnich N dni"""
+        """
+        Generuje raport opóźnień z ostatnich N dni
+
+        Statystyki są liczone z agregatów godzinowych; gdy w oknie nie ma
+        agregatów (dane sprzed ich wprowadzenia), z surowych pomiarów.
+
+        Returns:
+            dict: Statystyki w formacie agreguj_opoznienia lub None, jeśli
+                  brak danych
+        """
         data_od = datetime.now() - timedelta(days=dni_wstecz)
         
-        opoznienia = list(self.collection_delays.find({
-            'timestamp': {'$gte': data_od}
-        }))
+        statystyki = agreguj_z_agregatow(self.collection_agregaty, data_od)
+        if statystyki is not None:
+            ranking, kolekcja = ranking_z_agregatow, self.collection_agregaty
+        else:
+            statystyki = agreguj_opoznienia(self.collection_delays, data_od)
+            ranking, kolekcja = ranking_opoznien, self.collection_delays
+            if statystyki is not None:
+                print("[UWAGA] Brak agregatów godzinowych - liczę z surowych pomiarów "
+                      "(uzupełnij je opcją 5: przebuduj agregaty)")
         
-        if not opoznienia:
+        if statystyki is None:
             print("Brak danych o opóźnieniach")
             return None
         
-        df = pd.DataFrame(opoznienia)
+        p = statystyki['podsumowanie']
         
         print(f"\n=== RAPORT OPÓŹNIEŃ ({dni_wstecz} dni) ===")
-        print(f"Łączna liczba pomiarów: {len(df)}")
+        print(f"Łączna liczba pomiarów: {p['liczba']}")
         print(f"\nStatystyki opóźnień (minuty):")
-        print(df['delay_minutes'].describe())
+        print(f"  średnia:      {p['srednia']:.2f}")
+        print(f"  odch. std.:   {p['odchylenie']:.2f}")
+        print(f"  min / max:    {p['minimum']:.1f} / {p['maksimum']:.1f}")
+        print(f"  punktualność: {p['punktualnosc']:.1f}% (±2 min)")
         
         print(f"\n=== TOP 10 LINII Z NAJWIĘKSZYMI OPÓŹNIENIAMI ===")
-        top_routes = df.groupby('route_short_name')['delay_minutes'].agg(['mean', 'count']).sort_values('mean', ascending=False).head(10)
+        top_routes = ranking(kolekcja, 'route_short_name', data_od)
         print(top_routes)
         
         print(f"\n=== TOP 10 PRZYSTANKÓW Z NAJWIĘKSZYMI OPÓŹNIENIAMI ===")
-        top_stops = df.groupby('stop_name')['delay_minutes'].agg(['mean', 'count']).sort_values('mean', ascending=False).head(10)
+        top_stops = ranking(kolekcja, 'stop_name', data_od)
         print(top_stops)
         
-        return df
+        return statystyki
     
-    def uruchom_ciagla_analize(self, interwal_sekund=300):
-        """Uruchamia ciągłą analizę nowych odczytów"""
-        import time
+    def _otworz_strumien_zmian(self):
+        """
+        Otwiera strumień zmian (change stream) wstawień do kolekcji odczytów
         
-        print(f"Uruchamiam ciągłą analizę (co {interwal_sekund}s)...")
-        ostatni_odczyt = None
+        Returns:
+            Strumień zmian lub None, gdy serwer go nie obsługuje (standalone,
+            kolekcja time-series schematu kompaktowego, lokalny zamiennik)
+        """
+        try:
+            return self.collection_rt.watch(
+                [{'$match': {'operationType': 'insert'}}],
+                max_await_time_ms=MAX_CZEKANIE_STRUMIENIA_MS
+            )
+        except Exception as e:
+            print(f"[UWAGA] Strumień zmian niedostępny ({e}) - "
+                  f"odpytuję bazę co {INTERWAL_ODPYTYWANIA_SEKUND}s")
+            return None
+    
+    def uruchom_ciagla_analize(self, interwal_sekund=INTERWAL_ODPYTYWANIA_SEKUND):
+        """
+        Uruchamia ciągłą analizę wszystkich nowych odczytów (od checkpointu)
+        
+        Nowy odczyt jest sygnalizowany przez strumień zmian MongoDB, a
+        przetwarzany zawsze kursorem od checkpointu - gdy kalkulator nie
+        nadąża, zaległe zdarzenia są pomijane bez zapytań, a kolejna runda
+        obejmuje wszystkie zaległe odczyty. Bez strumienia baza jest
+        odpytywana co interwal_sekund.
+        """
+        strumien = self._otworz_strumien_zmian()
+        if strumien is not None:
+            print("Uruchamiam ciągłą analizę (strumień zmian)...")
+        else:
+            print(f"Uruchamiam ciągłą analizę (co {interwal_sekund}s)...")
+        
+        nadrobiono = False
+        ostatni_id = None
+        try:
+            while True:
+                try:
+                    if strumien is None:
+                        self.przetwarzaj_przyrostowo()
+                        time.sleep(interwal_sekund)
+                        continue
+                    
+                    if not nadrobiono:
+                        # Strumień jest już otwarty - odczyty zapisane od
+                        # checkpointu do teraz nie zostaną pominięte
+                        self.przetwarzaj_przyrostowo()
+                        ostatni_id = self.wczytaj_checkpoint()
+                        nadrobiono = True
+                    
+                    zmiana = strumien.try_next()
+                    if zmiana is None:
+                        continue
+                    if ostatni_id is not None and zmiana['documentKey']['_id'] <= ostatni_id:
+                        continue
+                    
+                    self.przetwarzaj_przyrostowo()
+                    ostatni_id = self.wczytaj_checkpoint()
+                    
+                except Exception as e:
+                    print(f"[BŁĄD] {e}")
+                    time.sleep(interwal_sekund)
+                    if strumien is not None and not strumien.alive:
+                        strumien = self._otworz_strumien_zmian()
+                        nadrobiono = False
+        except KeyboardInterrupt:
+            print("\nZatrzymano analizę")
+        finally:
+            if strumien is not None:
+                strumien.close()
+    
+    def uruchom_na_zywo(self, stan=None, interwal_ponowienia=5):
+        """
+        Liczy bieżące opóźnienia pojazdów zaraz po każdej zmianie pozycji
+        w stanie floty (bez odpytywania MongoDB)
+        
+        Pozycje przysyła do stanu kolektor (--stan-floty), a opóźnienia
+        z szacuj_opoznienia_pojazdow trafiają z powrotem do stanu, skąd
+        odczytuje je dashboard.
+        
+        Args:
+            stan: StanFloty z tego samego procesu lub KlientStanuFloty;
+                  domyślnie klient lokalnego serwera stanu floty
+        """
+        if stan is None:
+            stan = KlientStanuFloty()
+        print("Uruchamiam obliczanie opóźnień na żywo (stan floty)...")
         
         while True:
             try:
-                najnowszy = self.collection_rt.find_one(sort=[('timestamp_zapisu_db', -1)])
-                
-                if najnowszy and (ostatni_odczyt is None or najnowszy['_id'] != ostatni_odczyt):
-                    print(f"\n[{datetime.now()}] Nowy odczyt: {najnowszy['_id']}")
-                    self.przetwórz_odczyt_historyczny(odczyt_id=najnowszy['_id'])
-                    ostatni_odczyt = najnowszy['_id']
-                
-                time.sleep(interwal_sekund)
+                for zdarzenie in stan.zdarzenia():
+                    if zdarzenie['typ'] not in ('migawka', 'pozycje') or not zdarzenie['pojazdy']:
+                        continue
+                    
+                    start = time.perf_counter()
+                    dane_pojazdow = [
+                        dict(p, timestamp_danych=datetime.fromtimestamp(p['timestamp_danych'])
+                             if p.get('timestamp_danych') else None)
+                        for p in zdarzenie['pojazdy']
+                    ]
+                    czasy = [p['timestamp_danych'] for p in dane_pojazdow if p['timestamp_danych']]
+                    timestamp = max(czasy) if czasy else datetime.now()
+                    
+                    szacunki = self.szacuj_opoznienia_pojazdow(dane_pojazdow, timestamp)
+                    for szacunek in szacunki:
+                        szacunek['czas_opoznienia'] = timestamp
+                    stan.aktualizuj_opoznienia(szacunki)
+                    
+                    print(f"[{datetime.now()}] Pozycji: {len(dane_pojazdow)}, opóźnień: {len(szacunki)} "
+                          f"({(time.perf_counter() - start) * 1000:.0f} ms)")
                 
+                print(f"[UWAGA] Utracono połączenie ze stanem floty - ponawiam za {interwal_ponowienia}s")
             except KeyboardInterrupt:
-                print("\nZatrzymano analizę")
+                print("\nZatrzymano analizę na żywo")
+                break
+            except OSError as e:
+                print(f"[BŁĄD] Stan floty niedostępny: {e} - ponawiam za {interwal_ponowienia}s")
+            
+            try:
+                time.sleep(interwal_ponowienia)
+            except KeyboardInterrupt:
+                print("\nZatrzymano analizę na żywo")
                 break
-            except Exception as e:
-                print(f"[BŁĄD] {e}")
-                time.sleep(interwal_sekund)
 
 
 def main():
@@ -266,7 +1166,10 @@ def main():
     print("1. Przetwórz ostatnie 100 odczytów")
     print("2. Generuj raport z ostatnich 7 dni")
     print("3. Uruchom ciągłą analizę")
-    print("4. Wyjście")
+    print("4. Przetwórz wszystkie nowe odczyty (od checkpointu)")
+    print("5. Przebuduj agregaty godzinowe z ostatnich 30 dni")
+    print("6. Opóźnienia na żywo (serwer stanu floty)")
+    print("0. Wyjście")
     
     wybor = input("\nWybór: ")
     
@@ -276,6 +1179,12 @@ def main():
         calculator.generuj_raport_opoznien(dni_wstecz=7)
     elif wybor == "3":
         calculator.uruchom_ciagla_analize()
+    elif wybor == "4":
+        calculator.przetwarzaj_przyrostowo()
+    elif wybor == "5":
+        calculator.przebuduj_agregaty(datetime.now() - timedelta(days=30))
+    elif wybor == "6":
+        calculator.uruchom_na_zywo()
     
 
 if __name__ == "__main__":
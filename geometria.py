@@ -0,0 +1,179 @@
+import numpy as np
+
+PROMIEN_ZIEMI_METRY = 6371008.8
+
+
+class ProjekcjaLokalna:
+    """
+    Lokalne odwzorowanie równoodległościowe (lat, lon) -> (x, y) w metrach
+
+    Skala długości geograficznej jest liczona dla szerokości środka obszaru,
+    więc odległości euklidesowe w (x, y) są poprawne w obu kierunkach.
+    Dla obszaru miasta (kilkanaście km) błąd jest rzędu ułamka procenta.
+    """
+
+    def __init__(self, lat0, lon0):
+        self.lat0 = float(lat0)
+        self.lon0 = float(lon0)
+        self.metry_na_stopien_lat = np.radians(1.0) * PROMIEN_ZIEMI_METRY
+        self.metry_na_stopien_lon = self.metry_na_stopien_lat * np.cos(np.radians(self.lat0))
+
+    @classmethod
+    def dla_punktow(cls, lat, lon):
+        """Tworzy projekcję wyśrodkowaną na podanych punktach"""
+        return cls(np.nanmean(lat), np.nanmean(lon))
+
+    def na_metry(self, lat, lon):
+        """
+        Zamienia współrzędne geograficzne na metry względem środka projekcji
+
+        Returns:
+            ndarray: Tablica (n, 2) z kolumnami x (wschód) i y (północ)
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        x = (lon - self.lon0) * self.metry_na_stopien_lon
+        y = (lat - self.lat0) * self.metry_na_stopien_lat
+        return np.column_stack([x, y])
+
+
+def odleglosci_wzdluz(xy, grupy):
+    """
+    Skumulowana odległość wzdłuż łamanych zapisanych kolejno w jednej tablicy
+
+    Args:
+        xy: Tablica (n, 2) punktów w metrach
+        grupy: Etykieta łamanej dla każdego punktu (punkty łamanej są ciągłe)
+
+    Returns:
+        ndarray: Odległość od pierwszego punktu łamanej, NaN dla punktów bez współrzędnych
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    grupy = np.asarray(grupy)
+    if len(xy) == 0:
+        return np.empty(0)
+
+    odcinki = np.hypot(*np.diff(xy, axis=0).T)
+    odcinki[grupy[1:] != grupy[:-1]] = 0
+    skumulowane = np.concatenate([[0.0], np.cumsum(np.nan_to_num(odcinki))])
+
+    poczatki = np.r_[True, grupy[1:] != grupy[:-1]]
+    skumulowane -= skumulowane[np.flatnonzero(poczatki)][np.cumsum(poczatki) - 1]
+    skumulowane[np.isnan(xy).any(axis=1)] = np.nan
+    return skumulowane
+
+
+def rzutuj_na_odcinki(poczatki, konce, punkty):
+    """
+    Rzutuje punkty na odcinki - i-ty punkt na i-ty odcinek (tablice (n, 2))
+
+    Returns:
+        tuple: (t, odleglosci) - położenie rzutu na odcinku (0..1) i odległość
+               punktu od rzutu; NaN dla odcinków bez współrzędnych
+    """
+    ab = konce - poczatki
+    ap = punkty - poczatki
+    dlugosci2 = (ab * ab).sum(axis=1)
+    t = np.divide((ap * ab).sum(axis=1), dlugosci2, out=np.zeros(len(ab)), where=dlugosci2 > 0)
+    t = np.clip(t, 0.0, 1.0)
+    roznice = poczatki + t[:, None] * ab - punkty
+    return t, np.hypot(roznice[:, 0], roznice[:, 1])
+
+
+# Przyciąganie punktów jest liczone partiami, by ograniczyć pamięć tablic
+# (punkt, odcinek) przy długich łamanych
+MAX_ODCINKOW_W_PARTII = 1 << 20
+
+
+class KsztaltyTras:
+    """
+    Zbiór łamanych (np. shapes.txt) w spakowanych tablicach NumPy
+
+    Punkty wszystkich łamanych leżą kolejno w jednej tablicy xy (metry
+    w lokalnej projekcji), łamana i zajmuje wiersze [poczatki[i], konce[i]).
+    Dla każdego punktu przechowywana jest odległość od początku jego łamanej.
+    """
+
+    def __init__(self, lat, lon, grupy, projekcja=None):
+        """
+        Args:
+            lat, lon: Współrzędne punktów, posortowane tak, by punkty łamanej były ciągłe
+            grupy: Etykieta łamanej dla każdego punktu
+            projekcja: ProjekcjaLokalna; domyślnie wyśrodkowana na punktach
+        """
+        grupy = np.asarray(grupy)
+        self.projekcja = projekcja or ProjekcjaLokalna.dla_punktow(lat, lon)
+        self.xy = self.projekcja.na_metry(lat, lon)
+        self.odleglosci = odleglosci_wzdluz(self.xy, grupy)
+
+        granice = np.r_[True, grupy[1:] != grupy[:-1]] if len(grupy) else np.zeros(0, dtype=bool)
+        self.poczatki = np.flatnonzero(granice)
+        self.konce = np.r_[self.poczatki[1:], len(grupy)].astype(np.int64)
+
+    def __len__(self):
+        return len(self.poczatki)
+
+    def dlugosci(self):
+        """Zwraca długość każdej łamanej w metrach"""
+        return np.nanmax(np.c_[self.odleglosci[self.konce - 1], np.zeros(len(self))], axis=1)
+
+    def przyciagnij(self, ksztalty, lat, lon, min_odleglosc=None, max_odleglosc=None):
+        """
+        Rzutuje wiele punktów naraz na ich łamane
+
+        Args:
+            ksztalty: Numer łamanej dla każdego punktu (-1 - brak)
+            lat, lon: Współrzędne punktów
+            min_odleglosc, max_odleglosc: Opcjonalne okno odległości wzdłuż
+                łamanej, w którym szukany jest rzut (NaN - bez ograniczenia);
+                pozwala np. nie cofać pojazdu na trasie z pętlą
+
+        Returns:
+            tuple: (odleglosci_wzdluz, odleglosci_od_trasy) - NaN i inf dla
+                   punktów bez łamanej lub bez rzutu w oknie
+        """
+        ksztalty = np.asarray(ksztalty, dtype=np.int64)
+        n = len(ksztalty)
+        punkty = self.projekcja.na_metry(lat, lon).reshape(-1, 2)
+        min_odleglosc = np.full(n, np.nan) if min_odleglosc is None else np.asarray(min_odleglosc, dtype=float)
+        max_odleglosc = np.full(n, np.nan) if max_odleglosc is None else np.asarray(max_odleglosc, dtype=float)
+
+        wzdluz = np.full(n, np.nan)
+        od_trasy = np.full(n, np.inf)
+
+        znane = ksztalty >= 0
+        liczby_odcinkow = np.zeros(n, dtype=np.int64)
+        liczby_odcinkow[znane] = np.maximum(self.konce[ksztalty[znane]] - self.poczatki[ksztalty[znane]] - 1, 0)
+
+        # Partie punktów o łącznej liczbie odcinków nie większej niż limit
+        skumulowane = np.cumsum(liczby_odcinkow)
+        granice = np.searchsorted(skumulowane, np.arange(MAX_ODCINKOW_W_PARTII, skumulowane[-1] if n else 0,
+                                                         MAX_ODCINKOW_W_PARTII), side='right')
+        for start, koniec in zip(np.r_[0, granice], np.r_[granice, n]):
+            if koniec <= start:
+                continue
+            wybrane = np.arange(start, koniec)
+            dlugosci = liczby_odcinkow[wybrane]
+            wlasciciele = np.repeat(wybrane, dlugosci)
+            if len(wlasciciele) == 0:
+                continue
+            przesuniecia = np.cumsum(dlugosci) - dlugosci
+            odcinki = (np.arange(dlugosci.sum()) - np.repeat(przesuniecia, dlugosci) +
+                       self.poczatki[ksztalty[wlasciciele]])
+
+            t, odleglosci = rzutuj_na_odcinki(self.xy[odcinki], self.xy[odcinki + 1], punkty[wlasciciele])
+            postepy = self.odleglosci[odcinki] + t * (self.odleglosci[odcinki + 1] - self.odleglosci[odcinki])
+
+            poza_oknem = ((postepy < min_odleglosc[wlasciciele]) | (postepy > max_odleglosc[wlasciciele]) |
+                          np.isnan(odleglosci))
+            odleglosci = np.where(poza_oknem, np.inf, odleglosci)
+
+            # Przy remisie wygrywa wcześniejszy odcinek łamanej
+            kolejnosc = np.lexsort((odcinki, odleglosci, wlasciciele))
+            dopasowane, pierwsze = np.unique(wlasciciele[kolejnosc], return_index=True)
+            najlepsze = kolejnosc[pierwsze]
+            trafione = np.isfinite(odleglosci[najlepsze])
+            wzdluz[dopasowane[trafione]] = postepy[najlepsze[trafione]]
+            od_trasy[dopasowane[trafione]] = odleglosci[najlepsze[trafione]]
+
+        return wzdluz, od_trasy
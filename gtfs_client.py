@@ -1,48 +1,197 @@
 import requests
+import numpy as np
 import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.transit import gtfs_realtime_pb2
 from datetime import datetime
 
-GTFS_RT_URL = "https://www.mpkrzeszow.pl/gtfs/rt/gtfsrt.pb" 
+GTFS_RT_URL = "https://www.mpkrzeszow.pl/gtfs/rt/gtfsrt.pb"
+TIMEOUT_POLACZENIA_SEKUND = 3.05
+TIMEOUT_ODCZYTU_SEKUND = 10
+LICZBA_PROB = 3
+BACKOFF_SEKUND = 0.5
 
-def pobierz_dane_gtfs_rt():
-    
+
+class KlientGTFSRT:
+    """
+    Klient GTFS-RT ze stałą sesją HTTP (pula połączeń keep-alive),
+    timeoutami, ponawianiem z backoffem i zapytaniami warunkowymi.
+
+    Jeśli serwer odpowie 304 Not Modified, zwracany jest ostatni wynik bez
+    ponownego dekodowania, a atrybut `niezmieniony` jest ustawiany na True.
+    """
+
+    def __init__(self, url=GTFS_RT_URL, timeout=(TIMEOUT_POLACZENIA_SEKUND, TIMEOUT_ODCZYTU_SEKUND),
+                 liczba_prob=LICZBA_PROB, backoff=BACKOFF_SEKUND):
+        self.url = url
+        self.timeout = timeout
+        self.niezmieniony = False
+
+        self._etag = None
+        self._last_modified = None
+        self._ostatni_payload = None
+        self._ostatnie_wyniki = {}
+
+        retry = Retry(
+            total=liczba_prob,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def pobierz_surowe(self):
+        """
+        Pobiera surowy FeedMessage
+
+        Returns:
+            bytes: Zawartość feedu lub None, jeśli nie zmienił się od
+                   poprzedniego pobrania (304 Not Modified)
+        """
+        naglowki = {}
+        if self._etag:
+            naglowki['If-None-Match'] = self._etag
+        if self._last_modified:
+            naglowki['If-Modified-Since'] = self._last_modified
+
+        response = self.session.get(self.url, headers=naglowki, timeout=self.timeout)
+
+        if response.status_code == 304 and self._ostatni_payload is not None:
+            self.niezmieniony = True
+            return None
+
+        response.raise_for_status()
+
+        self.niezmieniony = False
+        self._etag = response.headers.get('ETag')
+        self._last_modified = response.headers.get('Last-Modified')
+        self._ostatni_payload = response.content
+        self._ostatnie_wyniki = {}
+
+        return response.content
+
+    @property
+    def ostatni_payload(self):
+        """Surowe bajty ostatnio pobranego feedu (np. do archiwizacji)"""
+        return self._ostatni_payload
+
+    def pobierz(self, kolumnowo=False):
+        """
+        Pobiera i dekoduje dane pojazdów
+
+        Args:
+            kolumnowo: Jeśli True, zwraca słownik tablic NumPy zamiast listy słowników
+
+        Returns:
+            tuple: (dane_pojazdow, timestamp_feed) lub (None, None) przy błędzie
+        """
+        try:
+            self.pobierz_surowe()
+
+            if kolumnowo not in self._ostatnie_wyniki:
+                self._ostatnie_wyniki[kolumnowo] = dekoduj_feed(self._ostatni_payload, kolumnowo)
+
+            return self._ostatnie_wyniki[kolumnowo]
+
+        except requests.exceptions.RequestException as e:
+            print(f"[BŁĄD KLIENTA] Błąd pobierania danych: {e}")
+            return None, None
+        except Exception as e:
+            print(f"[BŁĄD KLIENTA] Błąd parsowania danych: {e}")
+            return None, None
+
+    def zamknij(self):
+        """Zamyka sesję HTTP i jej połączenia"""
+        self.session.close()
+
+
+def dekoduj_feed(payload, kolumnowo=False):
+    """
+    Dekoduje FeedMessage GTFS-RT
+
+    Args:
+        payload: Surowe bajty FeedMessage
+        kolumnowo: Jeśli True, pola pojazdów są zwracane jako tablice NumPy
+                   (timestamp_danych jako sekundy epoki, 0 = brak)
+
+    Returns:
+        tuple: (dane_pojazdow, timestamp_feed)
+    """
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(payload)
+
+    timestamp_feed = datetime.fromtimestamp(feed.header.timestamp)
+    pojazdy = [entity.vehicle for entity in feed.entity if entity.HasField('vehicle')]
+
+    if kolumnowo:
+        return _dekoduj_kolumnowo(pojazdy), timestamp_feed
+
+    # Wiele pojazdów raportuje ten sam timestamp - konwertujemy każdy tylko raz
+    czasy = {}
     dane_pojazdow = []
 
-    try:
-        response = requests.get(GTFS_RT_URL)
-        response.raise_for_status() 
-
-        feed = gtfs_realtime_pb2.FeedMessage()
-        feed.ParseFromString(response.content)
-        
-        timestamp_feed = datetime.fromtimestamp(feed.header.timestamp)
-
-        for entity in feed.entity:
-            if entity.HasField('vehicle'):
-                vehicle = entity.vehicle
-                position = vehicle.position
-                trip = vehicle.trip
-                
-                timestamp_vehicle = "Brak"
-                if vehicle.HasField('timestamp'):
-                     timestamp_vehicle = datetime.fromtimestamp(vehicle.timestamp)
-
-                dane_pojazdow.append({
-                    'id_pojazdu': vehicle.vehicle.id,
-                    'trip_id': trip.trip_id,
-                    'route_id': trip.route_id,
-                    'lat': position.latitude,
-                    'lon': position.longitude,
-                    'predkosc_kmh': round(position.speed * 3.6, 2),
-                    'timestamp_danych': timestamp_vehicle,
-                })
-        
-        return dane_pojazdow, timestamp_feed
-
-    except requests.exceptions.RequestException as e:
-        print(f"[BŁĄD KLIENTA] Błąd pobierania danych: {e}")
-        return None, None
-    except Exception as e:
-        print(f"[BŁĄD KLIENTA] Błąd parsowania danych: {e}")
-        return None, None
\ No newline at end of file
+    for vehicle in pojazdy:
+        position = vehicle.position
+        trip = vehicle.trip
+
+        timestamp_vehicle = "Brak"
+        if vehicle.HasField('timestamp'):
+            timestamp_vehicle = czasy.get(vehicle.timestamp)
+            if timestamp_vehicle is None:
+                timestamp_vehicle = czasy[vehicle.timestamp] = datetime.fromtimestamp(vehicle.timestamp)
+
+        dane_pojazdow.append({
+            'id_pojazdu': vehicle.vehicle.id,
+            'trip_id': trip.trip_id,
+            'route_id': trip.route_id,
+            'lat': position.latitude,
+            'lon': position.longitude,
+            'predkosc_kmh': round(position.speed * 3.6, 2),
+            'timestamp_danych': timestamp_vehicle,
+        })
+
+    return dane_pojazdow, timestamp_feed
+
+
+def _dekoduj_kolumnowo(pojazdy):
+    """Zwraca pola pojazdów jako słownik tablic NumPy"""
+    n = len(pojazdy)
+    lat = np.empty(n, dtype=np.float64)
+    lon = np.empty(n, dtype=np.float64)
+    predkosc = np.empty(n, dtype=np.float64)
+    timestamp = np.empty(n, dtype=np.int64)
+
+    for i, vehicle in enumerate(pojazdy):
+        position = vehicle.position
+        lat[i] = position.latitude
+        lon[i] = position.longitude
+        predkosc[i] = position.speed
+        timestamp[i] = vehicle.timestamp
+
+    return {
+        'id_pojazdu': np.array([v.vehicle.id for v in pojazdy], dtype=object),
+        'trip_id': np.array([v.trip.trip_id for v in pojazdy], dtype=object),
+        'route_id': np.array([v.trip.route_id for v in pojazdy], dtype=object),
+        'lat': lat,
+        'lon': lon,
+        'predkosc_kmh': np.round(predkosc * 3.6, 2),
+        'timestamp_danych': timestamp,
+    }
+
+
+_domyslny_klient = None
+
+
+def pobierz_dane_gtfs_rt(kolumnowo=False):
+    """Pobiera dane pojazdów przez współdzielonego klienta GTFS-RT"""
+    global _domyslny_klient
+
+    if _domyslny_klient is None:
+        _domyslny_klient = KlientGTFSRT()
+
+    return _domyslny_klient.pobierz(kolumnowo=kolumnowo)
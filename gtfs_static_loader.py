@@ -1,30 +1,141 @@
 import requests
 import zipfile
 import io
+import os
+import hashlib
+import shutil
+import numpy as np
 import pandas as pd
+import pyarrow.feather as feather
 from pathlib import Path
 import json
+import time
 from datetime import datetime, timedelta
 
+from geometria import KsztaltyTras
+
 GTFS_STATIC_URL = "https://otwartedane.erzeszow.pl/media/resources/gtfs-27-10-2025-31-12-2025-21-10-2025-08-58-31.zip"
 GTFS_CACHE_DIR = Path("gtfs_cache")
 GTFS_CACHE_FILE = GTFS_CACHE_DIR / "gtfs_static.zip"
-GTFS_EXTRACTED_DIR = GTFS_CACHE_DIR / "extracted"
+GTFS_META_FILE = GTFS_CACHE_DIR / "gtfs_static.json"
 GTFS_CACHE_VALIDITY_HOURS = 24
+GTFS_ARROW_DIR = GTFS_CACHE_DIR / "arrow"
+# Zmiana formatu tabel w cache wymusza jego przebudowę
+WERSJA_CACHE = 3
+
+# Jawne, kompaktowe typy kolumn wymaganych przez specyfikację GTFS.
+# W stop_times stop_id staje się kategorią, a czasy sekundami (int32) -
+# patrz _normalizuj_stop_times.
+SCHEMAT_GTFS = {
+    'trips': {'route_id': 'int32', 'service_id': 'int32', 'trip_id': 'int32', 'shape_id': 'string'},
+    'stop_times': {
+        'trip_id': 'int32', 'stop_id': 'int32', 'stop_sequence': 'int16',
+        'arrival_time': 'string', 'departure_time': 'string',
+    },
+    'stops': {'stop_id': 'int32', 'stop_lat': 'float64', 'stop_lon': 'float64'},
+    'routes': {'route_id': 'int32', 'route_short_name': 'string'},
+    'calendar': {
+        'service_id': 'int32', 'monday': 'int8', 'tuesday': 'int8', 'wednesday': 'int8',
+        'thursday': 'int8', 'friday': 'int8', 'saturday': 'int8', 'sunday': 'int8',
+        'start_date': 'int32', 'end_date': 'int32',
+    },
+    'calendar_dates': {'service_id': 'int32', 'date': 'int32', 'exception_type': 'int8'},
+    'shapes': {
+        'shape_id': 'string', 'shape_pt_lat': 'float64', 'shape_pt_lon': 'float64',
+        'shape_pt_sequence': 'int32',
+    },
+}
+# Identyfikatory (w GTFS formalnie napisy) są liczbowe w feedzie MPK i tak
+# adresuje je kalkulator - wiersze z nienumerycznym ID są pomijane
+KOLUMNY_ID = ['trip_id', 'route_id', 'service_id', 'stop_id']
+TABELE_WYMAGANE = ['trips', 'stop_times', 'stops', 'routes']
+TABELE_OPCJONALNE = ['calendar', 'calendar_dates', 'shapes']
+# stop_times trafia do cache w postaci skompresowanej do wzorców
+TABELE_CACHE = ['trips', 'stops', 'routes', 'wzorce', 'kursy_wzorcow']
+BRAK_CZASU = -1
+DNI_TYGODNIA = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+def czasy_gtfs_na_sekundy(czasy):
+    """
+    Wektorowo konwertuje czasy GTFS (H:MM:SS, także powyżej 24:00:00)
+    na sekundy od początku dnia kursowania
+    
+    Różnych czasów jest najwyżej kilka tysięcy, więc każdy unikalny napis
+    jest parsowany tylko raz. Brakujące i niepoprawne wartości dają BRAK_CZASU.
+    
+    Returns:
+        ndarray: Sekundy jako int32
+    """
+    kody, unikalne = pd.factorize(pd.Series(czasy, dtype='string'))
+    if len(unikalne) == 0:
+        return np.full(len(kody), BRAK_CZASU, dtype=np.int32)
+    
+    czesci = (
+        pd.Series(unikalne, dtype='string').str.strip()
+        .str.split(':', n=2, expand=True).reindex(columns=range(3))
+    )
+    godziny, minuty, sekundy = (pd.to_numeric(czesci[i], errors='coerce') for i in range(3))
+    poprawne = (godziny >= 0) & minuty.between(0, 59) & sekundy.between(0, 59)
+    
+    wynik = (godziny * 3600 + minuty * 60 + sekundy).where(poprawne)
+    wynik = wynik.fillna(BRAK_CZASU).to_numpy(dtype=np.int32)
+    return np.where(kody >= 0, wynik[kody], BRAK_CZASU).astype(np.int32)
+
+
+def sekundy_na_czasy_gtfs(sekundy):
+    """
+    Wektorowo konwertuje sekundy od początku dnia kursowania na czasy GTFS
+    (HH:MM:SS) - odwrotność czasy_gtfs_na_sekundy
+
+    Returns:
+        Series: Napisy (dtype string), BRAK_CZASU daje <NA>
+    """
+    kody, unikalne = pd.factorize(np.asarray(sekundy))
+    napisy = pd.Series([
+        None if s == BRAK_CZASU else f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}"
+        for s in unikalne.tolist()
+    ], dtype='string')
+    return pd.Series(napisy.to_numpy()[kody], dtype='string')
+
 
 class GTFSStaticLoader:
     """Klasa do pobierania i ładowania statycznych danych GTFS (rozkłady jazdy)"""
     
     def __init__(self):
         self.trips = None
-        self.stop_times = None
+        self.wzorce = None
+        self.kursy_wzorcow = None
         self.stops = None
         self.routes = None
         self.calendar = None
         self.calendar_dates = None
+        self.shapes = None
+        self.ksztalty = None
+        self.hash_gtfs = None
+        
+        self._stop_times = None
+        self._indeks_kursow = {}
+        self._starty_kursow = {}
+        self._rekordy_kursow = {}
+        self._uslugi_po_dacie = None
+        self._kursy_uslug = {}
+        self._uslugi_kursow = {}
+        self._aktywne_kursy = {}
+        self._poczatki_dni = {}
+        self._kursy_po_id = {}
+        self._linie_po_id = {}
+        self._przystanki_po_id = {}
+        self._ksztalty_kursow = {}
         
     def pobierz_i_zapisz_gtfs(self):
-        """Pobiera plik GTFS i zapisuje lokalnie"""
+        """
+        Pobiera plik GTFS i zapisuje lokalnie
+        
+        Po wygaśnięciu cache wysyła zapytanie warunkowe (ETag/Last-Modified).
+        Nowa wersja jest pobierana strumieniowo do pliku tymczasowego i
+        podmieniana atomowo, a jej hash trafia do metadanych - jeśli bajty
+        się nie zmieniły, plik i zależne od niego cache zostają bez zmian.
+        """
         print("Pobieranie statycznego GTFS...")
         
         GTFS_CACHE_DIR.mkdir(exist_ok=True)
@@ -35,23 +146,89 @@ class GTFSStaticLoader:
                 print(f"Używam cache (wiek: {file_age.seconds // 3600}h)")
                 return GTFS_CACHE_FILE
         
+        metadane = self._wczytaj_metadane() if GTFS_CACHE_FILE.exists() else {}
+        naglowki = {}
+        if metadane.get('etag'):
+            naglowki['If-None-Match'] = metadane['etag']
+        if metadane.get('last_modified'):
+            naglowki['If-Modified-Since'] = metadane['last_modified']
+        
+        tymczasowy = GTFS_CACHE_FILE.with_suffix('.zip.tmp')
+        
         try:
-            response = requests.get(GTFS_STATIC_URL, timeout=30)
-            response.raise_for_status()
+            with requests.get(GTFS_STATIC_URL, headers=naglowki, timeout=30, stream=True) as response:
+                if response.status_code == 304:
+                    print("GTFS bez zmian (304 Not Modified)")
+                    os.utime(GTFS_CACHE_FILE)
+                    self._zapisz_metadane(metadane)
+                    return GTFS_CACHE_FILE
+                
+                response.raise_for_status()
+                
+                h = hashlib.sha256()
+                rozmiar = 0
+                with open(tymczasowy, 'wb') as f:
+                    for blok in response.iter_content(chunk_size=64 * 1024):
+                        f.write(blok)
+                        h.update(blok)
+                        rozmiar += len(blok)
+                
+                nowe_metadane = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'sha256': h.hexdigest(),
+                }
             
-            with open(GTFS_CACHE_FILE, 'wb') as f:
-                f.write(response.content)
+            if GTFS_CACHE_FILE.exists() and metadane.get('sha256') == nowe_metadane['sha256']:
+                tymczasowy.unlink()
+                os.utime(GTFS_CACHE_FILE)
+                print("GTFS bez zmian (identyczny hash)")
+            else:
+                os.replace(tymczasowy, GTFS_CACHE_FILE)
+                print(f"Pobrano GTFS ({rozmiar // 1024} KB)")
             
-            print(f"Pobrano GTFS ({len(response.content) // 1024} KB)")
+            self._zapisz_metadane(nowe_metadane)
             return GTFS_CACHE_FILE
             
         except Exception as e:
             print(f"[BŁĄD] Nie można pobrać GTFS: {e}")
+            tymczasowy.unlink(missing_ok=True)
             if GTFS_CACHE_FILE.exists():
                 print("Używam starego cache")
                 return GTFS_CACHE_FILE
             return None
     
+    def _wczytaj_metadane(self):
+        """Wczytuje metadane pobranego pliku GTFS (ETag, Last-Modified, hash)"""
+        try:
+            with open(GTFS_META_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _zapisz_metadane(self, metadane):
+        """Zapisuje metadane razem z rozmiarem i czasem modyfikacji pliku GTFS"""
+        stat = GTFS_CACHE_FILE.stat()
+        metadane = dict(metadane, rozmiar=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        with open(GTFS_META_FILE, 'w', encoding='utf-8') as f:
+            json.dump(metadane, f)
+    
+    def _hash_gtfs(self, gtfs_file):
+        """
+        Zwraca hash pliku GTFS - z metadanych, jeśli plik nie zmienił się
+        od ostatniego zapisu, w przeciwnym razie liczy go od nowa
+        """
+        metadane = self._wczytaj_metadane()
+        stat = Path(gtfs_file).stat()
+        if (metadane.get('sha256') and metadane.get('rozmiar') == stat.st_size
+                and metadane.get('mtime_ns') == stat.st_mtime_ns):
+            return metadane['sha256']
+        
+        hash_gtfs = self._hash_pliku(gtfs_file)
+        if Path(gtfs_file) == GTFS_CACHE_FILE:
+            self._zapisz_metadane(dict(metadane, sha256=hash_gtfs))
+        return hash_gtfs
+    
     def zaladuj_dane(self):
         """Ładuje wszystkie wymagane pliki GTFS do pamięci"""
         gtfs_file = self.pobierz_i_zapisz_gtfs()
@@ -61,32 +238,427 @@ class GTFSStaticLoader:
         print("Ładowanie danych GTFS...")
         
         try:
-            with zipfile.ZipFile(gtfs_file, 'r') as zip_ref:
-                GTFS_EXTRACTED_DIR.mkdir(exist_ok=True, parents=True)
-                zip_ref.extractall(GTFS_EXTRACTED_DIR)
-
-                self.trips = pd.read_csv(GTFS_EXTRACTED_DIR / "trips.txt")
-                self.stop_times = pd.read_csv(GTFS_EXTRACTED_DIR / "stop_times.txt")
-                self.stops = pd.read_csv(GTFS_EXTRACTED_DIR / "stops.txt")
-                self.routes = pd.read_csv(GTFS_EXTRACTED_DIR / "routes.txt")
-
-                if (GTFS_EXTRACTED_DIR / "calendar.txt").exists():
-                    self.calendar = pd.read_csv(GTFS_EXTRACTED_DIR / "calendar.txt")
-                if (GTFS_EXTRACTED_DIR / "calendar_dates.txt").exists():
-                    self.calendar_dates = pd.read_csv(GTFS_EXTRACTED_DIR / "calendar_dates.txt")
-                
-                print(f"✓ Załadowano:")
-                print(f"  - {len(self.trips)} kursów")
-                print(f"  - {len(self.stop_times)} przystanków na kursach")
-                print(f"  - {len(self.stops)} przystanków")
-                print(f"  - {len(self.routes)} linii")
-                
+            hash_gtfs = self._hash_gtfs(gtfs_file)
+            if hash_gtfs == self.hash_gtfs and self.trips is not None:
+                print("GTFS bez zmian - pomijam ponowne ładowanie")
                 return True
+            
+            katalog_cache = GTFS_ARROW_DIR / f"{hash_gtfs}-v{WERSJA_CACHE}"
+            
+            if katalog_cache.exists():
+                self._wczytaj_z_cache(katalog_cache)
+                print(f"Używam cache Arrow ({hash_gtfs[:12]})")
+            else:
+                self._wczytaj_z_zip(gtfs_file)
+                self._zapisz_cache(katalog_cache)
+            
+            self._zbuduj_indeksy()
+            self.hash_gtfs = hash_gtfs
+            
+            print(f"✓ Załadowano:")
+            print(f"  - {len(self.trips)} kursów")
+            print(f"  - {self.liczba_przystankow_na_kursach()} przystanków na kursach "
+                  f"({len(self.wzorce)} w {len(self._zakresy_wzorcow)} unikalnych wzorcach)")
+            print(f"  - {len(self.stops)} przystanków")
+            print(f"  - {len(self.routes)} linii")
+            if self.ksztalty is not None:
+                print(f"  - {len(self.ksztalty)} kształtów tras")
+            
+            return True
                 
         except Exception as e:
             print(f"[BŁĄD] Nie można załadować GTFS: {e}")
             return False
     
+    def _hash_pliku(self, sciezka):
+        """Zwraca SHA-256 zawartości pliku"""
+        h = hashlib.sha256()
+        with open(sciezka, 'rb') as f:
+            for blok in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(blok)
+        return h.hexdigest()
+    
+    def _wczytaj_z_zip(self, gtfs_file):
+        """Parsuje pliki txt bezpośrednio z archiwum GTFS (bez rozpakowywania)"""
+        with zipfile.ZipFile(gtfs_file, 'r') as zip_ref:
+            nazwy = set(zip_ref.namelist())
+            
+            for tabela in TABELE_WYMAGANE + TABELE_OPCJONALNE:
+                plik = f"{tabela}.txt"
+                if plik not in nazwy:
+                    if tabela in TABELE_WYMAGANE:
+                        raise FileNotFoundError(f"Brak {plik} w archiwum GTFS")
+                    setattr(self, tabela, None)
+                    continue
+                
+                df = self._wczytaj_tabele(zip_ref, plik, tabela)
+                
+                if tabela == 'stop_times':
+                    stop_times = self._normalizuj_stop_times(df)
+                    self.wzorce, self.kursy_wzorcow = self._kompresuj_stop_times(stop_times)
+                elif tabela == 'shapes':
+                    self.shapes = self._normalizuj_shapes(df)
+                else:
+                    setattr(self, tabela, df)
+    
+    def _wczytaj_tabele(self, zip_ref, plik, tabela):
+        """
+        Wczytuje tabelę z archiwum w typach SCHEMAT_GTFS
+        
+        Gdy identyfikator nie daje się zamienić na liczbę, tabela jest
+        wczytywana ponownie z ID jako napisami, a wiersze z nienumerycznym
+        (lub pustym) ID są pomijane z ostrzeżeniem - zamiast przerywać
+        ładowanie całego GTFS.
+        """
+        schemat = SCHEMAT_GTFS[tabela]
+        try:
+            with zip_ref.open(plik) as f:
+                return pd.read_csv(f, dtype=schemat)
+        except ValueError:
+            kolumny_id = [k for k in KOLUMNY_ID if k in schemat]
+            with zip_ref.open(plik) as f:
+                df = pd.read_csv(f, dtype=dict(schemat, **dict.fromkeys(kolumny_id, 'string')))
+        
+        for kolumna in kolumny_id:
+            if kolumna not in df.columns:
+                continue
+            liczby = pd.to_numeric(df[kolumna], errors='coerce')
+            bledne = liczby.isna() | (liczby % 1 != 0)
+            if bledne.any():
+                przyklad = df.loc[bledne, kolumna].iloc[0]
+                print(f"[UWAGA] {plik}: pominięto {int(bledne.sum())} wierszy z nienumerycznym "
+                      f"{kolumna} (np. {przyklad!r})")
+                df = df[~bledne]
+                liczby = liczby[~bledne]
+            df[kolumna] = liczby.astype(schemat[kolumna])
+        
+        return df.reset_index(drop=True)
+    
+    def _normalizuj_stop_times(self, stop_times):
+        """
+        Zamienia czasy HH:MM:SS na sekundy (int32), stop_id na kategorię
+        i sortuje po (trip_id, stop_sequence). Brakujące czasy oznaczane są
+        BRAK_CZASU.
+        """
+        for kolumna, nowa in [('arrival_time', 'arrival_sec'), ('departure_time', 'departure_sec')]:
+            if kolumna not in stop_times.columns:
+                continue
+            stop_times[nowa] = czasy_gtfs_na_sekundy(stop_times[kolumna])
+            stop_times = stop_times.drop(columns=kolumna)
+        
+        stop_times['stop_id'] = stop_times['stop_id'].astype('category')
+        
+        return stop_times.sort_values(
+            ['trip_id', 'stop_sequence'], kind='mergesort'
+        ).reset_index(drop=True)
+    
+    def _normalizuj_shapes(self, shapes):
+        """
+        Zostawia współrzędne punktów kształtów posortowane po
+        (shape_id, shape_pt_sequence) - każdy kształt to ciągły zakres wierszy
+        
+        shape_dist_traveled jest pomijane - jednostki zależą od przewoźnika,
+        a odległości wzdłuż kształtu liczy KsztaltyTras.
+        """
+        shapes = shapes.dropna(subset=['shape_id', 'shape_pt_lat', 'shape_pt_lon'])
+        shapes = shapes.sort_values(['shape_id', 'shape_pt_sequence'], kind='mergesort')
+        return shapes[['shape_id', 'shape_pt_lat', 'shape_pt_lon']].reset_index(drop=True)
+    
+    def _kompresuj_stop_times(self, stop_times):
+        """
+        Kompresuje stop_times do unikalnych wzorców przystanków
+        
+        Kursy jednej linii zwykle różnią się tylko godziną odjazdu. Wzorzec to
+        ciąg przystanków z czasami względem startu kursu (arrival_off,
+        departure_off), a każdy kurs przechowuje tylko numer wzorca i czas
+        startu.
+        
+        Returns:
+            tuple: (wzorce, kursy_wzorcow) - wiersze wzorców posortowane po
+                   (wzorzec, stop_sequence) oraz tabela (trip_id, wzorzec, czas_startu)
+        """
+        trip_ids = stop_times['trip_id'].to_numpy()
+        if len(trip_ids) == 0:
+            wzorce = stop_times.drop(columns='trip_id').rename(
+                columns={'arrival_sec': 'arrival_off', 'departure_sec': 'departure_off'}
+            )
+            wzorce['wzorzec'] = np.zeros(0, dtype=np.int32)
+            return wzorce, pd.DataFrame({
+                'trip_id': np.zeros(0, dtype=np.int32),
+                'wzorzec': np.zeros(0, dtype=np.int32),
+                'czas_startu': np.zeros(0, dtype=np.int32),
+            })
+        
+        poczatki = np.flatnonzero(np.r_[True, trip_ids[1:] != trip_ids[:-1]])
+        konce = np.r_[poczatki[1:], len(trip_ids)]
+        
+        # Czas startu = najwcześniejszy znany czas kursu
+        kolumny_czasu = [k for k in ('arrival_sec', 'departure_sec') if k in stop_times.columns]
+        czasy = stop_times[kolumny_czasu].to_numpy()
+        znane = np.where(czasy == BRAK_CZASU, np.iinfo(np.int32).max, czasy).min(axis=1)
+        czas_startu = np.minimum.reduceat(znane, poczatki)
+        czas_startu = np.where(czas_startu == np.iinfo(np.int32).max, 0, czas_startu).astype(np.int32)
+        
+        start_wiersza = np.repeat(czas_startu, konce - poczatki)
+        for kolumna in kolumny_czasu:
+            wartosci = stop_times[kolumna].to_numpy()
+            nowa = kolumna.replace('_sec', '_off')
+            stop_times[nowa] = np.where(
+                wartosci == BRAK_CZASU, BRAK_CZASU, wartosci - start_wiersza
+            ).astype(np.int32)
+        stop_times = stop_times.drop(columns=['trip_id'] + kolumny_czasu)
+        
+        # Klucz wzorca: bajty kodów wszystkich kolumn wierszy kursu
+        kody = np.column_stack([
+            pd.factorize(stop_times[kolumna])[0] for kolumna in stop_times.columns
+        ]).astype(np.int32)
+        
+        numery_wzorcow = {}
+        wzorzec_kursu = np.empty(len(poczatki), dtype=np.int32)
+        for i, (start, koniec) in enumerate(zip(poczatki.tolist(), konce.tolist())):
+            klucz = kody[start:koniec].tobytes()
+            wzorzec_kursu[i] = numery_wzorcow.setdefault(klucz, len(numery_wzorcow))
+        
+        # Wiersze pierwszego kursu każdego wzorca tworzą tabelę wzorców
+        _, pierwsze_kursy = np.unique(wzorzec_kursu, return_index=True)
+        dlugosci = konce[pierwsze_kursy] - poczatki[pierwsze_kursy]
+        wlasciciele = np.repeat(np.arange(len(pierwsze_kursy)), dlugosci)
+        przesuniecia = np.cumsum(dlugosci) - dlugosci
+        wiersze = np.arange(dlugosci.sum()) - przesuniecia[wlasciciele] + poczatki[pierwsze_kursy][wlasciciele]
+        
+        wzorce = stop_times.iloc[wiersze].reset_index(drop=True)
+        wzorce['wzorzec'] = wlasciciele.astype(np.int32)
+        
+        kursy_wzorcow = pd.DataFrame({
+            'trip_id': trip_ids[poczatki],
+            'wzorzec': wzorzec_kursu,
+            'czas_startu': czas_startu,
+        })
+        
+        return wzorce, kursy_wzorcow
+    
+    def _zapisz_cache(self, katalog_cache):
+        """Zapisuje tabele jako nieskompresowane pliki Arrow IPC (mmap przy odczycie)"""
+        tymczasowy = katalog_cache.with_name(katalog_cache.name + ".tmp")
+        shutil.rmtree(tymczasowy, ignore_errors=True)
+        tymczasowy.mkdir(parents=True)
+        
+        for tabela in TABELE_CACHE + TABELE_OPCJONALNE:
+            df = getattr(self, tabela)
+            if df is not None:
+                feather.write_feather(df, tymczasowy / f"{tabela}.arrow", compression='uncompressed')
+        
+        # Stare wersje cache nie będą już potrzebne
+        if GTFS_ARROW_DIR.exists():
+            for stary in GTFS_ARROW_DIR.iterdir():
+                if stary != tymczasowy:
+                    shutil.rmtree(stary, ignore_errors=True)
+        
+        tymczasowy.rename(katalog_cache)
+    
+    def _wczytaj_z_cache(self, katalog_cache):
+        """Wczytuje tabele z cache Arrow przez mapowanie pliku w pamięci"""
+        for tabela in TABELE_CACHE + TABELE_OPCJONALNE:
+            plik = katalog_cache / f"{tabela}.arrow"
+            if plik.exists():
+                df = feather.read_table(plik, memory_map=True).to_pandas()
+            elif tabela in TABELE_CACHE:
+                raise FileNotFoundError(f"Niekompletny cache Arrow: brak {plik.name}")
+            else:
+                df = None
+            setattr(self, tabela, df)
+    
+    def _zbuduj_indeksy(self):
+        """
+        Buduje jednorazowo indeksy do szybkiego wyszukiwania.
+        
+        Wzorce są posortowane po (wzorzec, stop_sequence), dzięki czemu
+        przystanki każdego wzorca zajmują ciągły zakres wierszy. Indeks kursów
+        wskazuje zakres wierszy wzorca kursu, a osobno przechowywany jest czas
+        startu kursu. Kursy, linie i przystanki trafiają do słowników po ID.
+        """
+        numery = self.wzorce['wzorzec'].to_numpy()
+        poczatki = np.flatnonzero(np.r_[True, numery[1:] != numery[:-1]]) if len(numery) else numery
+        konce = np.r_[poczatki[1:], len(numery)]
+        self._zakresy_wzorcow = np.column_stack([poczatki, konce])
+        
+        kursy = self.kursy_wzorcow
+        zakresy = self._zakresy_wzorcow[kursy['wzorzec'].to_numpy()]
+        self._indeks_kursow = dict(zip(
+            kursy['trip_id'].tolist(),
+            zip(zakresy[:, 0].tolist(), zakresy[:, 1].tolist())
+        ))
+        self._starty_kursow = dict(zip(kursy['trip_id'].tolist(), kursy['czas_startu'].tolist()))
+        self._rekordy_kursow = {}
+        self._stop_times = None
+        
+        self._linie_po_id = {
+            r['route_id']: r for r in self.routes.drop_duplicates('route_id').to_dict('records')
+        }
+        self._przystanki_po_id = {
+            r['stop_id']: r for r in self.stops.drop_duplicates('stop_id').to_dict('records')
+        }
+        self._kursy_po_id = {
+            r['trip_id']: r for r in self.trips.drop_duplicates('trip_id').to_dict('records')
+        }
+        
+        self._zbuduj_ksztalty()
+        self._zbuduj_kalendarz()
+    
+    def _zbuduj_ksztalty(self):
+        """Pakuje shapes.txt do KsztaltyTras i przypisuje kursom numery kształtów"""
+        self.ksztalty = None
+        self._ksztalty_kursow = {}
+        
+        if self.shapes is None or len(self.shapes) == 0:
+            return
+        
+        kody, shape_ids = pd.factorize(self.shapes['shape_id'])
+        self.ksztalty = KsztaltyTras(self.shapes['shape_pt_lat'], self.shapes['shape_pt_lon'], kody)
+        
+        if 'shape_id' in self.trips.columns:
+            numery = pd.Index(shape_ids).get_indexer(self.trips['shape_id'].astype('string'))
+            znane = numery >= 0
+            self._ksztalty_kursow = dict(zip(
+                self.trips['trip_id'].to_numpy()[znane].tolist(), numery[znane].tolist()
+            ))
+    
+    def _zbuduj_kalendarz(self):
+        """
+        Buduje indeks data -> aktywne service_id z calendar i calendar_dates
+        oraz service_id -> kursy. Bez obu plików wszystkie kursy są aktywne.
+        """
+        self._aktywne_kursy = {}
+        self._poczatki_dni = {}
+        self._uslugi_kursow = dict(zip(self.trips['trip_id'].tolist(), self.trips['service_id'].tolist()))
+        self._kursy_uslug = {
+            usluga: frozenset(kursy.tolist())
+            for usluga, kursy in self.trips.groupby('service_id')['trip_id']
+        }
+        
+        if self.calendar is None and self.calendar_dates is None:
+            self._uslugi_po_dacie = None
+            return
+        
+        uslugi_po_dacie = {}
+        
+        if self.calendar is not None:
+            for wiersz in self.calendar.itertuples(index=False):
+                daty = pd.date_range(str(wiersz.start_date), str(wiersz.end_date))
+                dni = np.array([getattr(wiersz, dzien) for dzien in DNI_TYGODNIA], dtype=bool)
+                for data in daty[dni[daty.weekday]].date:
+                    uslugi_po_dacie.setdefault(data, set()).add(wiersz.service_id)
+        
+        if self.calendar_dates is not None:
+            for wiersz in self.calendar_dates.itertuples(index=False):
+                data = datetime.strptime(str(wiersz.date), '%Y%m%d').date()
+                if wiersz.exception_type == 1:
+                    uslugi_po_dacie.setdefault(data, set()).add(wiersz.service_id)
+                elif wiersz.exception_type == 2:
+                    uslugi_po_dacie.get(data, set()).discard(wiersz.service_id)
+        
+        self._uslugi_po_dacie = {data: frozenset(u) for data, u in uslugi_po_dacie.items()}
+    
+    def aktywne_uslugi(self, data):
+        """
+        Zwraca service_id kursujące w danym dniu
+        
+        Returns:
+            frozenset: ID usług lub None, jeśli feed nie ma kalendarza
+        """
+        if self._uslugi_po_dacie is None:
+            return None
+        return self._uslugi_po_dacie.get(data, frozenset())
+    
+    def aktywne_kursy(self, data):
+        """
+        Zwraca zbiór trip_id kursujących w danym dniu (wynik jest zapamiętywany)
+        
+        Returns:
+            frozenset: ID kursów lub None, jeśli feed nie ma kalendarza
+        """
+        uslugi = self.aktywne_uslugi(data)
+        if uslugi is None:
+            return None
+        
+        kursy = self._aktywne_kursy.get(data)
+        if kursy is None:
+            kursy = frozenset().union(*(self._kursy_uslug.get(u, ()) for u in uslugi))
+            self._aktywne_kursy[data] = kursy
+        return kursy
+    
+    def czy_kurs_aktywny(self, trip_id, data):
+        """Sprawdza, czy kurs kursuje w danym dniu (bez kalendarza - zawsze True)"""
+        uslugi = self.aktywne_uslugi(data)
+        if uslugi is None:
+            return trip_id in self._uslugi_kursow
+        return self._uslugi_kursow.get(trip_id) in uslugi
+    
+    def czy_kursy_aktywne(self, trip_ids, data):
+        """Wersja czy_kurs_aktywny dla wielu kursów - zwraca tablicę bool"""
+        kursy = self.aktywne_kursy(data)
+        if kursy is None:
+            kursy = self._uslugi_kursow
+        return np.fromiter((t in kursy for t in trip_ids), dtype=bool, count=len(trip_ids))
+    
+    def poczatek_dnia_kursowania(self, data):
+        """
+        Zwraca punkt odniesienia czasów rozkładu dla dnia kursowania (epoka)
+        
+        Zgodnie z GTFS jest to "południe minus 12h" czasu lokalnego - w dni
+        zmiany czasu różni się od północy o godzinę.
+        """
+        poczatek = self._poczatki_dni.get(data)
+        if poczatek is None:
+            poludnie = datetime(data.year, data.month, data.day, 12)
+            poczatek = self._poczatki_dni[data] = time.mktime(poludnie.timetuple()) - 12 * 3600
+        return poczatek
+    
+    def sekundy_dnia_kursowania(self, timestamp, data):
+        """Zwraca liczbę sekund od początku dnia kursowania `data` do `timestamp`"""
+        return int(round(timestamp.timestamp() - self.poczatek_dnia_kursowania(data)))
+    
+    @property
+    def stop_times(self):
+        """
+        Pełna tabela stop_times odtworzona ze wzorców
+        
+        Materializowana przy pierwszym odwołaniu i zapamiętywana do
+        ponownego załadowania GTFS - do wyszukiwania służą metody pobierz_*,
+        które korzystają bezpośrednio ze wzorców. Obok sekund (arrival_sec,
+        departure_sec) zawiera czasy GTFS arrival_time i departure_time.
+        """
+        if self.kursy_wzorcow is None:
+            return None
+        if self._stop_times is not None:
+            return self._stop_times
+        
+        trip_ids = self.kursy_wzorcow['trip_id'].tolist()
+        wiersze, wlasciciele = self.pobierz_wiersze_kursow(trip_ids)
+        
+        stop_times = self.wzorce.iloc[wiersze].drop(columns='wzorzec').reset_index(drop=True)
+        stop_times.insert(0, 'trip_id', self.kursy_wzorcow['trip_id'].to_numpy()[wlasciciele])
+        for kolumna in ('arrival_off', 'departure_off'):
+            if kolumna in stop_times.columns:
+                sekundy = self.pobierz_czasy_przyjazdu(trip_ids, wiersze, wlasciciele, kolumna)
+                stop_times[kolumna.replace('_off', '_sec')] = sekundy
+                stop_times[kolumna.replace('_off', '_time')] = sekundy_na_czasy_gtfs(sekundy)
+                stop_times = stop_times.drop(columns=kolumna)
+        
+        self._stop_times = stop_times
+        return stop_times
+    
+    def liczba_przystankow_na_kursach(self):
+        """Zwraca liczbę wierszy stop_times (bez ich materializowania)"""
+        if self.kursy_wzorcow is None:
+            return 0
+        dlugosci = self._zakresy_wzorcow[:, 1] - self._zakresy_wzorcow[:, 0]
+        return int(dlugosci[self.kursy_wzorcow['wzorzec'].to_numpy()].sum())
+    
+    def _zakres_kursu(self, trip_id):
+        """Zwraca zakres wierszy wzorca (start, koniec) dla kursu lub None"""
+        return self._indeks_kursow.get(trip_id)
+    
     def pobierz_zaplanowany_czas_przyjazdu(self, trip_id, stop_sequence):
         """
         Zwraca zaplanowany czas przyjazdu dla danego kursu i przystanku
@@ -98,16 +670,22 @@ class GTFSStaticLoader:
         Returns:
             str: Czas w formacie HH:MM:SS lub None
         """
-        if self.stop_times is None:
+        if self.wzorce is None:
             return None
         
-        mask = (self.stop_times['trip_id'] == trip_id) & \
-               (self.stop_times['stop_sequence'] == stop_sequence)
+        zakres = self._zakres_kursu(trip_id)
+        if zakres is None:
+            return None
         
-        result = self.stop_times[mask]
+        start, koniec = zakres
+        sekwencje = self.wzorce['stop_sequence'].to_numpy()[start:koniec]
+        pozycja = np.searchsorted(sekwencje, stop_sequence)
         
-        if len(result) > 0:
-            return result.iloc[0]['arrival_time']
+        if pozycja < len(sekwencje) and sekwencje[pozycja] == stop_sequence:
+            przesuniecie = self.wzorce['arrival_off'].iat[start + pozycja]
+            if przesuniecie == BRAK_CZASU:
+                return None
+            return self.sekundy_na_czas(self._starty_kursow[trip_id] + przesuniecie)
         return None
     
     def pobierz_info_o_kursie(self, trip_id):
@@ -115,18 +693,17 @@ class GTFSStaticLoader:
         if self.trips is None:
             return None
         
-        trip = self.trips[self.trips['trip_id'] == trip_id]
+        trip = self._kursy_po_id.get(trip_id)
         
-        if len(trip) == 0:
+        if trip is None:
             return None
         
-        trip_data = trip.iloc[0].to_dict()
+        trip_data = dict(trip)
         
-        if self.routes is not None:
-            route = self.routes[self.routes['route_id'] == trip_data['route_id']]
-            if len(route) > 0:
-                trip_data['route_short_name'] = route.iloc[0]['route_short_name']
-                trip_data['route_long_name'] = route.iloc[0].get('route_long_name', '')
+        route = self._linie_po_id.get(trip_data['route_id'])
+        if route is not None:
+            trip_data['route_short_name'] = route['route_short_name']
+            trip_data['route_long_name'] = route.get('route_long_name', '')
         
         return trip_data
     
@@ -135,25 +712,102 @@ class GTFSStaticLoader:
         if self.stops is None:
             return None
         
-        stop = self.stops[self.stops['stop_id'] == stop_id]
+        stop = self._przystanki_po_id.get(stop_id)
         
-        if len(stop) == 0:
+        if stop is None:
             return None
         
-        return stop.iloc[0].to_dict()
+        return dict(stop)
     
     def pobierz_wszystkie_przystanki_kursu(self, trip_id):
         """Zwraca wszystkie przystanki dla danego kursu w kolejności"""
-        if self.stop_times is None:
+        if self.wzorce is None:
+            return []
+        
+        zakres = self._zakres_kursu(trip_id)
+        if zakres is None:
             return []
         
-        stops = self.stop_times[self.stop_times['trip_id'] == trip_id].sort_values('stop_sequence')
-        return stops.to_dict('records')
+        rekordy = self._rekordy_kursow.get(trip_id)
+        if rekordy is None:
+            start, koniec = zakres
+            czas_startu = self._starty_kursow[trip_id]
+            rekordy = self.wzorce.iloc[start:koniec].drop(columns='wzorzec').to_dict('records')
+            for r in rekordy:
+                r['trip_id'] = trip_id
+                for typ in ('arrival', 'departure'):
+                    przesuniecie = r.pop(f'{typ}_off', BRAK_CZASU)
+                    sekundy = BRAK_CZASU if przesuniecie == BRAK_CZASU else czas_startu + przesuniecie
+                    r[f'{typ}_sec'] = sekundy
+                    r[f'{typ}_time'] = self.sekundy_na_czas(sekundy)
+            self._rekordy_kursow[trip_id] = rekordy
+        
+        return [dict(r) for r in rekordy]
+    
+    def pobierz_wiersze_kursow(self, trip_ids):
+        """
+        Zwraca numery wierszy wzorców dla wielu kursów naraz
+        
+        Args:
+            trip_ids: Sekwencja ID kursów
+            
+        Returns:
+            tuple: (wiersze, wlasciciele) - numery wierszy tabeli wzorce oraz
+                   pozycja kursu w trip_ids, do którego należy każdy wiersz
+        """
+        n = len(trip_ids)
+        starty = np.zeros(n, dtype=np.int64)
+        dlugosci = np.zeros(n, dtype=np.int64)
+        
+        for i, trip_id in enumerate(trip_ids):
+            zakres = self._indeks_kursow.get(trip_id)
+            if zakres is not None:
+                starty[i] = zakres[0]
+                dlugosci[i] = zakres[1] - zakres[0]
+        
+        przesuniecia = np.cumsum(dlugosci) - dlugosci
+        wlasciciele = np.repeat(np.arange(n), dlugosci)
+        wiersze = np.arange(dlugosci.sum()) - przesuniecia[wlasciciele] + starty[wlasciciele]
+        
+        return wiersze, wlasciciele
+    
+    def pobierz_ksztalty_kursow(self, trip_ids):
+        """Zwraca numery kształtów (w self.ksztalty) kursów, -1 dla kursów bez kształtu"""
+        return np.array([self._ksztalty_kursow.get(t, -1) for t in trip_ids], dtype=np.int64)
+    
+    def pobierz_czasy_przyjazdu(self, trip_ids, wiersze, wlasciciele, kolumna='arrival_off'):
+        """
+        Zwraca bezwzględne czasy (sekundy od północy) dla wierszy wzorców
+        
+        Args:
+            trip_ids: Sekwencja ID kursów przekazana do pobierz_wiersze_kursow
+            wiersze, wlasciciele: Wynik pobierz_wiersze_kursow (lub jego podzbiór)
+            kolumna: 'arrival_off' lub 'departure_off'
+            
+        Returns:
+            ndarray: Czasy int32, BRAK_CZASU dla brakujących
+        """
+        starty = np.array([self._starty_kursow.get(t, 0) for t in trip_ids], dtype=np.int32)
+        przesuniecia = self.wzorce[kolumna].to_numpy()[wiersze]
+        return np.where(
+            przesuniecia == BRAK_CZASU, BRAK_CZASU, przesuniecia + starty[wlasciciele]
+        ).astype(np.int32)
+    
+    def sekundy_na_czas(self, sekundy):
+        """Konwertuje sekundy od północy na czas GTFS (HH:MM:SS), np. do wyświetlenia"""
+        if sekundy is None or pd.isna(sekundy) or sekundy == BRAK_CZASU:
+            return None
+        
+        sekundy = int(sekundy)
+        return f"{sekundy // 3600:02d}:{sekundy % 3600 // 60:02d}:{sekundy % 60:02d}"
     
     def konwertuj_czas_na_sekundy(self, time_str):
         """
         Konwertuje czas GTFS (HH:MM:SS) na sekundy od północy
         Uwaga: GTFS może mieć godziny >24 dla kursów po północy
+        
+        Do pojedynczych wartości - kolumny stop_times są konwertowane przy
+        ładowaniu przez czasy_gtfs_na_sekundy.
         """
         if pd.isna(time_str) or time_str is None:
             return None
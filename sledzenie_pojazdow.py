@@ -0,0 +1,128 @@
+import numpy as np
+
+DLUGOSC_HISTORII = 4
+# Dłuższa przerwa między pozycjami nie jest interpolowana
+MAX_PRZERWA_SEKUND = 300
+POCZATKOWA_POJEMNOSC = 256
+
+
+class SledzeniePojazdow:
+    """
+    Ostatnie pozycje pojazdów na trasie kursu w buforach cyklicznych
+
+    Dla każdego pojazdu przechowywane jest DLUGOSC_HISTORII par (czas,
+    postęp wzdłuż trasy w metrach) w jednej wspólnej tablicy - bez obiektów
+    na pojazd. Zmiana kursu pojazdu czyści jego historię.
+    """
+
+    def __init__(self, dlugosc_historii=DLUGOSC_HISTORII, max_przerwa=MAX_PRZERWA_SEKUND,
+                 pojemnosc=POCZATKOWA_POJEMNOSC):
+        self.dlugosc_historii = dlugosc_historii
+        self.max_przerwa = max_przerwa
+
+        self._sloty = {}
+        self._kursy = np.full(pojemnosc, -1, dtype=np.int64)
+        self._czasy = np.zeros((pojemnosc, dlugosc_historii), dtype=np.float64)
+        self._postepy = np.zeros((pojemnosc, dlugosc_historii), dtype=np.float32)
+        self._glowy = np.zeros(pojemnosc, dtype=np.int32)
+        self._liczby = np.zeros(pojemnosc, dtype=np.int32)
+
+    def __len__(self):
+        return len(self._sloty)
+
+    def _pobierz_sloty(self, pojazdy, utworz):
+        """Zwraca sloty pojazdów (-1 dla nieznanych, gdy utworz=False)"""
+        if utworz:
+            for pojazd in pojazdy:
+                if pojazd not in self._sloty:
+                    self._sloty[pojazd] = len(self._sloty)
+            if len(self._sloty) > len(self._kursy):
+                self._powieksz(len(self._sloty))
+        return np.array([self._sloty.get(p, -1) for p in pojazdy], dtype=np.int64)
+
+    def _powieksz(self, minimum):
+        pojemnosc = max(minimum, 2 * len(self._kursy))
+        dodatkowe = pojemnosc - len(self._kursy)
+        self._kursy = np.concatenate([self._kursy, np.full(dodatkowe, -1, dtype=np.int64)])
+        self._czasy = np.vstack([self._czasy, np.zeros((dodatkowe, self.dlugosc_historii))])
+        self._postepy = np.vstack([self._postepy,
+                                   np.zeros((dodatkowe, self.dlugosc_historii), dtype=np.float32)])
+        self._glowy = np.concatenate([self._glowy, np.zeros(dodatkowe, dtype=np.int32)])
+        self._liczby = np.concatenate([self._liczby, np.zeros(dodatkowe, dtype=np.int32)])
+
+    def ostatnie(self, pojazdy, kursy, czasy):
+        """
+        Zwraca ostatnią zapamiętaną pozycję pojazdów na tym samym kursie
+
+        Args:
+            pojazdy: ID pojazdów (unikalne)
+            kursy: trip_id pojazdów (int)
+            czasy: Czasy bieżących pozycji (epoka) - do sprawdzenia przerwy
+
+        Returns:
+            tuple: (czasy, postepy) - NaN, gdy brak historii, inny kurs
+                   lub przerwa dłuższa niż max_przerwa
+        """
+        sloty = self._pobierz_sloty(pojazdy, utworz=False)
+        ostatnie_czasy = np.full(len(sloty), np.nan)
+        ostatnie_postepy = np.full(len(sloty), np.nan)
+
+        znane = sloty >= 0
+        s = sloty[znane]
+        indeks = (self._glowy[s] - 1) % self.dlugosc_historii
+        czas = self._czasy[s, indeks]
+        poprawne = (
+            (self._liczby[s] > 0) &
+            (self._kursy[s] == np.asarray(kursy)[znane]) &
+            (np.asarray(czasy)[znane] - czas <= self.max_przerwa)
+        )
+        pozycje = np.flatnonzero(znane)[poprawne]
+        ostatnie_czasy[pozycje] = czas[poprawne]
+        ostatnie_postepy[pozycje] = self._postepy[s, indeks][poprawne]
+
+        return ostatnie_czasy, ostatnie_postepy
+
+    def dopisz(self, pojazdy, kursy, czasy, postepy):
+        """
+        Dopisuje pozycje pojazdów (nowsze niż ostatnia zapamiętana)
+
+        Args:
+            pojazdy: ID pojazdów (unikalne)
+            kursy, czasy, postepy: trip_id, czas (epoka) i postęp wzdłuż trasy
+        """
+        sloty = self._pobierz_sloty(pojazdy, utworz=True)
+        kursy = np.asarray(kursy, dtype=np.int64)
+        czasy = np.asarray(czasy, dtype=np.float64)
+
+        nowy_kurs = self._kursy[sloty] != kursy
+        self._liczby[sloty[nowy_kurs]] = 0
+        self._kursy[sloty] = kursy
+
+        ostatni_czas = self._czasy[sloty, (self._glowy[sloty] - 1) % self.dlugosc_historii]
+        nowsze = (self._liczby[sloty] == 0) | (czasy > ostatni_czas)
+
+        s = sloty[nowsze]
+        glowy = self._glowy[s]
+        self._czasy[s, glowy] = czasy[nowsze]
+        self._postepy[s, glowy] = np.asarray(postepy)[nowsze]
+        self._glowy[s] = (glowy + 1) % self.dlugosc_historii
+        self._liczby[s] = np.minimum(self._liczby[s] + 1, self.dlugosc_historii)
+
+    def historia(self, pojazd):
+        """
+        Zwraca zapamiętane pozycje pojazdu od najstarszej
+
+        Returns:
+            tuple: (trip_id, czasy, postepy) lub None dla nieznanego pojazdu
+        """
+        slot = self._sloty.get(pojazd)
+        if slot is None or self._liczby[slot] == 0:
+            return None
+        liczba = self._liczby[slot]
+        indeksy = (self._glowy[slot] - liczba + np.arange(liczba)) % self.dlugosc_historii
+        return int(self._kursy[slot]), self._czasy[slot, indeksy], self._postepy[slot, indeksy]
+
+    def wyczysc(self):
+        """Usuwa historię wszystkich pojazdów"""
+        self._liczby[:] = 0
+        self._kursy[:] = -1
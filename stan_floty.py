@@ -0,0 +1,400 @@
+import os
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+from datetime import datetime
+
+# Gniazdo Unix, a na systemach bez AF_UNIX - lokalny port TCP
+ADRES_STANU_FLOTY = "/tmp/ztm_stan_floty.sock" if hasattr(socket, 'AF_UNIX') else ("127.0.0.1", 8766)
+# Pojazd bez nowej pozycji przez ten czas jest usuwany ze stanu
+MAX_WIEK_POJAZDU_SEKUND = 300
+# Subskrybent, który nie nadąża, traci najstarsze zdarzenia
+ROZMIAR_KOLEJKI_SUBSKRYBENTA = 100
+TIMEOUT_KLIENTA_SEKUND = 2.0
+# Serwer wysyła subskrybentom puls, gdy nie ma zmian - wykrywa zerwane połączenia
+INTERWAL_PULSU_SEKUND = 1.0
+
+POLA_POZYCJI = ['trip_id', 'route_id', 'lat', 'lon', 'predkosc_kmh', 'timestamp_danych']
+POLA_OPOZNIENIA = ['delay_seconds', 'postep_metry', 'odleglosc_od_trasy_metry', 'czas_opoznienia']
+
+
+def _na_json(wartosc):
+    """Zamienia wartość pola pojazdu na typ JSON (datetime -> epoka, "Brak" -> None)"""
+    if isinstance(wartosc, datetime):
+        return wartosc.timestamp()
+    if wartosc == "Brak":
+        return None
+    if hasattr(wartosc, 'item'):
+        return wartosc.item()
+    return wartosc
+
+
+class StanFloty:
+    """
+    Bieżący stan floty w pamięci: ostatnia pozycja, kurs i opóźnienie
+    każdego pojazdu (klucz - id_pojazdu)
+
+    Każda zmiana pojazdu dostaje kolejny numer wersji, a subskrybenci
+    (zdarzenia()) otrzymują tylko zmienione rekordy - w zdarzeniach typu
+    'pozycje' (z kolektora) lub 'opoznienia' (z kalkulatora). Subskrybent,
+    który nie nadąża, traci najstarsze zdarzenia; pełny stan daje migawka().
+    Bezpieczny dla wątków.
+    """
+
+    def __init__(self, max_wiek=MAX_WIEK_POJAZDU_SEKUND, rozmiar_kolejki=ROZMIAR_KOLEJKI_SUBSKRYBENTA):
+        self.max_wiek = max_wiek
+        self.rozmiar_kolejki = rozmiar_kolejki
+        self.wersja = 0
+
+        self._pojazdy = {}
+        self._usuniete = {}
+        self._subskrybenci = []
+        self._blokada = threading.Lock()
+
+    def __len__(self):
+        return len(self._pojazdy)
+
+    def aktualizuj_pozycje(self, dane_pojazdow):
+        """
+        Zapisuje pozycje pojazdów z odczytu GTFS-RT
+
+        Zmiana kursu usuwa opóźnienie pojazdu - dotyczyło poprzedniego kursu.
+
+        Returns:
+            int: Liczba zmienionych pojazdów
+        """
+        teraz = time.time()
+        zmienione = []
+
+        with self._blokada:
+            for pojazd in dane_pojazdow:
+                id_pojazdu = str(pojazd.get('id_pojazdu') or '')
+                if not id_pojazdu:
+                    continue
+
+                nowe = {pole: _na_json(pojazd.get(pole)) for pole in POLA_POZYCJI}
+                rekord = self._pojazdy.get(id_pojazdu)
+
+                if rekord is not None and all(rekord[pole] == nowe[pole] for pole in POLA_POZYCJI):
+                    rekord['aktualizacja'] = teraz
+                    continue
+
+                if rekord is None or rekord['trip_id'] != nowe['trip_id']:
+                    rekord = dict.fromkeys(POLA_OPOZNIENIA)
+                rekord.update(nowe, id_pojazdu=id_pojazdu, aktualizacja=teraz)
+                zmienione.append(self._zapisz(id_pojazdu, rekord))
+
+            usuniete = self._usun_nieaktualne(teraz)
+            wersja = self.wersja
+
+        self._powiadom('pozycje', wersja, zmienione, usuniete)
+        return len(zmienione)
+
+    def aktualizuj_opoznienia(self, szacunki):
+        """
+        Zapisuje opóźnienia pojazdów (np. z DelayCalculator.szacuj_opoznienia_pojazdow)
+
+        Opóźnienie jest pomijane, jeśli pojazd w międzyczasie zmienił kurs.
+
+        Returns:
+            int: Liczba zmienionych pojazdów
+        """
+        zmienione = []
+
+        with self._blokada:
+            for szacunek in szacunki:
+                id_pojazdu = str(szacunek.get('vehicle_id') or '')
+                rekord = self._pojazdy.get(id_pojazdu)
+                if rekord is None or str(rekord['trip_id']) != str(szacunek.get('trip_id')):
+                    continue
+
+                nowe = {pole: _na_json(szacunek.get(pole)) for pole in POLA_OPOZNIENIA}
+                if all(rekord[pole] == nowe[pole] for pole in POLA_OPOZNIENIA):
+                    continue
+
+                rekord = dict(rekord, **nowe)
+                zmienione.append(self._zapisz(id_pojazdu, rekord))
+            wersja = self.wersja
+
+        self._powiadom('opoznienia', wersja, zmienione, [])
+        return len(zmienione)
+
+    def _zapisz(self, id_pojazdu, rekord):
+        self.wersja += 1
+        rekord['wersja'] = self.wersja
+        self._pojazdy[id_pojazdu] = rekord
+        self._usuniete.pop(id_pojazdu, None)
+        return dict(rekord)
+
+    def _usun_nieaktualne(self, teraz):
+        """Usuwa pojazdy bez pozycji dłużej niż max_wiek (wywoływane pod blokadą)"""
+        nieaktualne = [i for i, r in self._pojazdy.items() if teraz - r['aktualizacja'] > self.max_wiek]
+        for id_pojazdu in nieaktualne:
+            del self._pojazdy[id_pojazdu]
+            self.wersja += 1
+            self._usuniete[id_pojazdu] = (self.wersja, teraz)
+
+        # Znaczniki usunięcia są potrzebne tylko przez chwilę (zmiany_od)
+        for id_pojazdu in [i for i, (_, czas) in self._usuniete.items() if teraz - czas > self.max_wiek]:
+            del self._usuniete[id_pojazdu]
+
+        return nieaktualne
+
+    def migawka(self):
+        """
+        Returns:
+            tuple: (wersja, lista kopii rekordów wszystkich pojazdów)
+        """
+        with self._blokada:
+            return self.wersja, [dict(r) for r in self._pojazdy.values()]
+
+    def zmiany_od(self, wersja):
+        """
+        Zwraca zmiany stanu po podanej wersji
+
+        Returns:
+            tuple: (bieżąca wersja, zmienione rekordy, ID usuniętych pojazdów)
+        """
+        with self._blokada:
+            zmienione = [dict(r) for r in self._pojazdy.values() if r['wersja'] > wersja]
+            usuniete = [i for i, (w, _) in self._usuniete.items() if w > wersja]
+            return self.wersja, zmienione, usuniete
+
+    def _powiadom(self, typ, wersja, zmienione, usuniete):
+        if not zmienione and not usuniete:
+            return
+
+        zdarzenie = {'typ': typ, 'wersja': wersja, 'pojazdy': zmienione, 'usuniete': usuniete}
+        with self._blokada:
+            subskrybenci = list(self._subskrybenci)
+
+        for kolejka in subskrybenci:
+            while True:
+                try:
+                    kolejka.put_nowait(zdarzenie)
+                    break
+                except queue.Full:
+                    try:
+                        kolejka.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def subskrybuj(self):
+        """Rejestruje kolejkę zdarzeń zmian (zwolnić przez odsubskrybuj)"""
+        kolejka = queue.Queue(maxsize=self.rozmiar_kolejki)
+        with self._blokada:
+            self._subskrybenci.append(kolejka)
+        return kolejka
+
+    def odsubskrybuj(self, kolejka):
+        with self._blokada:
+            if kolejka in self._subskrybenci:
+                self._subskrybenci.remove(kolejka)
+
+    def zdarzenia(self, timeout=None):
+        """
+        Generator zdarzeń zmian stanu - pierwszym jest migawka całej floty
+
+        Args:
+            timeout: Co ile sekund bez zmian zwracać None (np. by sprawdzić
+                     warunek zakończenia); None - czekaj bez końca
+        """
+        kolejka = self.subskrybuj()
+        try:
+            wersja, pojazdy = self.migawka()
+            yield {'typ': 'migawka', 'wersja': wersja, 'pojazdy': pojazdy, 'usuniete': []}
+            while True:
+                try:
+                    yield kolejka.get(timeout=timeout)
+                except queue.Empty:
+                    yield None
+        finally:
+            self.odsubskrybuj(kolejka)
+
+
+class _ObslugaPolaczenia(socketserver.StreamRequestHandler):
+    """Protokół: jeden obiekt JSON na linię w obu kierunkach"""
+
+    def handle(self):
+        stan = self.server.stan
+        for linia in self.rfile:
+            try:
+                wiadomosc = json.loads(linia)
+            except ValueError:
+                continue
+
+            typ = wiadomosc.get('typ')
+            if typ == 'pozycje':
+                stan.aktualizuj_pozycje(wiadomosc.get('pojazdy', []))
+            elif typ == 'opoznienia':
+                stan.aktualizuj_opoznienia(wiadomosc.get('szacunki', []))
+            elif typ == 'migawka':
+                wersja, pojazdy = stan.migawka()
+                self._wyslij({'typ': 'migawka', 'wersja': wersja, 'pojazdy': pojazdy, 'usuniete': []})
+            elif typ == 'subskrybuj':
+                # Połączenie staje się strumieniem zdarzeń do rozłączenia klienta
+                for zdarzenie in stan.zdarzenia(timeout=INTERWAL_PULSU_SEKUND):
+                    if self.server.zatrzymany:
+                        return
+                    try:
+                        self._wyslij(zdarzenie if zdarzenie is not None else {'typ': 'puls'})
+                    except OSError:
+                        return
+                return
+
+    def _wyslij(self, wiadomosc):
+        self.wfile.write(json.dumps(wiadomosc).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+def uruchom_serwer(stan=None, adres=ADRES_STANU_FLOTY):
+    """
+    Udostępnia stan floty przez lokalne gniazdo w wątku w tle
+
+    Returns:
+        socketserver.BaseServer: Serwer (zatrzymanie: zatrzymaj_serwer)
+    """
+    if isinstance(adres, str):
+        klasa = socketserver.ThreadingUnixStreamServer
+        try:
+            # Gniazdo po poprzednim, nieczysto zakończonym procesie
+            os.unlink(adres)
+        except FileNotFoundError:
+            pass
+    else:
+        klasa = socketserver.ThreadingTCPServer
+        klasa.allow_reuse_address = True
+
+    serwer = klasa(adres, _ObslugaPolaczenia)
+    serwer.daemon_threads = True
+    serwer.stan = stan if stan is not None else StanFloty()
+    serwer.zatrzymany = False
+    threading.Thread(target=serwer.serve_forever, daemon=True).start()
+    return serwer
+
+
+def zatrzymaj_serwer(serwer):
+    serwer.zatrzymany = True
+    serwer.shutdown()
+    serwer.server_close()
+
+
+class KlientStanuFloty:
+    """
+    Klient serwera stanu floty o tym samym interfejsie co StanFloty
+
+    Niedostępny serwer nie przerywa pracy - aktualizacje są wtedy pomijane,
+    a migawka jest pusta. Połączenie jest odnawiane przy kolejnym wywołaniu.
+    Bezpieczny dla wątków - żądanie i odpowiedź na wspólnym połączeniu nie
+    przeplatają się (zdarzenia() ma własne połączenie).
+    """
+
+    def __init__(self, adres=ADRES_STANU_FLOTY, timeout=TIMEOUT_KLIENTA_SEKUND):
+        self.adres = adres
+        self.timeout = timeout
+        self._gniazdo = None
+        self._plik = None
+        self._zgloszono_blad = False
+        self._blokada = threading.RLock()
+
+    def _polacz(self):
+        rodzina = socket.AF_UNIX if isinstance(self.adres, str) else socket.AF_INET
+        gniazdo = socket.socket(rodzina, socket.SOCK_STREAM)
+        gniazdo.settimeout(self.timeout)
+        gniazdo.connect(self.adres)
+        return gniazdo
+
+    def _wyslij(self, wiadomosc, odpowiedz=False):
+        dane = json.dumps(wiadomosc).encode('utf-8') + b'\n'
+        with self._blokada:
+            try:
+                if self._gniazdo is None:
+                    self._gniazdo = self._polacz()
+                    self._plik = self._gniazdo.makefile('rb')
+                self._gniazdo.sendall(dane)
+                wynik = json.loads(self._plik.readline()) if odpowiedz else True
+                self._zgloszono_blad = False
+                return wynik
+            except (OSError, ValueError) as e:
+                if not self._zgloszono_blad:
+                    print(f"[UWAGA] Serwer stanu floty niedostępny ({self.adres}): {e}")
+                    self._zgloszono_blad = True
+                self.zamknij()
+                return None
+
+    def aktualizuj_pozycje(self, dane_pojazdow):
+        pojazdy = [
+            {'id_pojazdu': p.get('id_pojazdu'), **{pole: _na_json(p.get(pole)) for pole in POLA_POZYCJI}}
+            for p in dane_pojazdow
+        ]
+        return self._wyslij({'typ': 'pozycje', 'pojazdy': pojazdy}) is not None
+
+    def aktualizuj_opoznienia(self, szacunki):
+        szacunki = [{k: _na_json(v) for k, v in s.items()} for s in szacunki]
+        return self._wyslij({'typ': 'opoznienia', 'szacunki': szacunki}) is not None
+
+    def migawka(self):
+        wynik = self._wyslij({'typ': 'migawka'}, odpowiedz=True)
+        if wynik is None:
+            return None, []
+        return wynik['wersja'], wynik['pojazdy']
+
+    def zdarzenia(self, timeout=None):
+        """
+        Generator zdarzeń z serwera (osobne połączenie)
+
+        Puls serwera jest zwracany jako None, gdy podano timeout. Po zerwaniu
+        połączenia (także braku pulsu) generator się kończy - wywołujący
+        decyduje o ponownej subskrypcji.
+        """
+        gniazdo = self._polacz()
+        gniazdo.settimeout(max(self.timeout, 3 * INTERWAL_PULSU_SEKUND))
+        try:
+            gniazdo.sendall(b'{"typ": "subskrybuj"}\n')
+            plik = gniazdo.makefile('rb')
+            while True:
+                try:
+                    linia = plik.readline()
+                except OSError:
+                    return
+                if not linia:
+                    return
+                zdarzenie = json.loads(linia)
+                if zdarzenie['typ'] != 'puls':
+                    yield zdarzenie
+                elif timeout is not None:
+                    yield None
+        finally:
+            gniazdo.close()
+
+    def zamknij(self):
+        with self._blokada:
+            if self._gniazdo is not None:
+                try:
+                    self._plik.close()
+                    self._gniazdo.close()
+                except OSError:
+                    pass
+            self._gniazdo = None
+            self._plik = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serwer bieżącego stanu floty")
+    parser.add_argument("--adres", default=ADRES_STANU_FLOTY,
+                        help="ścieżka gniazda Unix (domyślnie %(default)s)")
+    args = parser.parse_args()
+
+    serwer = uruchom_serwer(adres=args.adres)
+    print(f"✓ Serwer stanu floty nasłuchuje: {args.adres}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"[{datetime.now()}] Pojazdów: {len(serwer.stan)}, wersja: {serwer.stan.wersja}")
+    except KeyboardInterrupt:
+        zatrzymaj_serwer(serwer)
+        print("\nZatrzymano serwer stanu floty")
@@ -0,0 +1,602 @@
+import math
+import itertools
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+NAZWA_KOLEKCJI_AGREGATY = "opoznienia_godzinowe"
+KLUCZ_AGREGATU = ['godzina', 'route_short_name', 'stop_id']
+
+# Pola pojazdu, z których korzysta kalkulator opóźnień - czas pozycji jest
+# potrzebny interpolacji przejazdów, prędkość nie jest pobierana
+POLA_POJAZDU_KALKULATORA = ['id_pojazdu', 'trip_id', 'route_id', 'lat', 'lon', 'timestamp_danych']
+PROJEKCJA_ODCZYTU = {
+    'timestamp_serwera_gtfs': 1,
+    'timestamp_zapisu_db': 1,
+    **{f'dane_pojazdow.{pole}': 1 for pole in POLA_POJAZDU_KALKULATORA},
+}
+# Odczyt kolumnowo: każde pole pojazdów jako jedna tablica w dokumencie
+# odczytu (null dla brakującego pola - tablice pozostają równej długości)
+PROJEKCJA_ODCZYTU_KOLUMNOWO = {
+    'timestamp_serwera_gtfs': 1,
+    'timestamp_zapisu_db': 1,
+    **{pole: {'$map': {
+        'input': {'$ifNull': ['$dane_pojazdow', []]},
+        'in': {'$ifNull': [f'$$this.{pole}', None]},
+    }} for pole in POLA_POJAZDU_KALKULATORA},
+}
+
+# Schemat kompaktowy: jeden dokument na pojazd w kolekcji time-series
+# (lub zwykłej z indeksem TTL), z krótkimi kluczami
+SCHEMAT_DOKUMENT = "dokument"
+SCHEMAT_KOMPAKTOWY = "kompaktowy"
+NAZWA_KOLEKCJI_KOMPAKTOWEJ = "pozycje_pojazdow"
+RETENCJA_KOMPAKTOWA_DNI = 90
+KLUCZE_KOMPAKTOWE = {
+    'id_pojazdu': 'm', 'trip_id': 'k', 'route_id': 'r',
+    'lat': 'la', 'lon': 'lo', 'predkosc_kmh': 's', 'timestamp_danych': 'tp',
+}
+# W schemacie kompaktowym odczyt to grupa dokumentów o tym samym t i czasie
+# zapisu z (odpytania feedu o niezmienionym nagłówku mają wspólne t)
+POLA_ODCZYTU_KOMPAKTOWEGO = {'_id': 't', 'timestamp_serwera_gtfs': 't', 'timestamp_zapisu_db': 't'}
+# Szacunkowa liczba pojazdów w odczycie - partia kursora schematu
+# kompaktowego jest liczona w dokumentach pojedynczych pojazdów
+POJAZDOW_NA_ODCZYT = 200
+
+PROG_PUNKTUALNOSCI_MIN = 2
+ZAKRES_HISTOGRAMU_MIN = 30
+SZEROKOSC_PRZEDZIALU_MIN = 1
+
+KOLEJNOSC_DNI = ['Poniedziałek', 'Wtorek', 'Środa', 'Czwartek', 'Piątek', 'Sobota', 'Niedziela']
+
+# Granice przedziałów histogramu - opóźnienia są ograniczone przez
+# MAX_OPOZNIENIE_SEKUND kalkulatora, wartości spoza zakresu trafiają do 'poza'
+GRANICE_HISTOGRAMU = list(range(
+    -ZAKRES_HISTOGRAMU_MIN, ZAKRES_HISTOGRAMU_MIN + 2 * SZEROKOSC_PRZEDZIALU_MIN, SZEROKOSC_PRZEDZIALU_MIN
+))
+
+
+def _czas_epoki(wartosc):
+    """Czas pozycji pojazdu jako sekundy epoki (datetime lub liczba; 0 i brak - NaN)"""
+    if isinstance(wartosc, datetime):
+        return wartosc.timestamp()
+    if isinstance(wartosc, (int, float, np.number)) and wartosc:
+        return float(wartosc)
+    return np.nan
+
+
+def _napisy(wartosci):
+    return np.array(['' if w is None else str(w) for w in wartosci], dtype=object)
+
+
+def kolumny_pojazdow(dane_pojazdow):
+    """
+    Zamienia pojazdy odczytu na kolumny NumPy pól używanych przez kalkulator
+
+    Args:
+        dane_pojazdow: Lista słowników pojazdów albo słownik pole -> wartości
+                       (np. z znajdz_odczyty(kolumnowo=True) lub
+                       dekoduj_feed(kolumnowo=True))
+
+    Returns:
+        dict: id_pojazdu i route_id (napisy), trip_id (float, NaN gdy brak
+              lub nieliczbowy), lat, lon oraz timestamp_danych (sekundy
+              epoki, NaN gdy brak)
+    """
+    if not isinstance(dane_pojazdow, dict):
+        dane_pojazdow = {pole: [p.get(pole) for p in dane_pojazdow] for pole in POLA_POJAZDU_KALKULATORA}
+
+    n = len(dane_pojazdow.get('lat', ()))
+    brak = [None] * n
+    return {
+        'id_pojazdu': _napisy(dane_pojazdow.get('id_pojazdu', brak)),
+        'route_id': _napisy(dane_pojazdow.get('route_id', brak)),
+        'trip_id': pd.to_numeric(
+            pd.Series([t or None for t in dane_pojazdow.get('trip_id', brak)], dtype=object), errors='coerce'
+        ).to_numpy(dtype=float),
+        'lat': np.asarray(dane_pojazdow.get('lat', brak), dtype=float),
+        'lon': np.asarray(dane_pojazdow.get('lon', brak), dtype=float),
+        'timestamp_danych': np.array([_czas_epoki(t) for t in dane_pojazdow.get('timestamp_danych', brak)],
+                                     dtype=float),
+    }
+
+
+def liczba_pojazdow(dane_pojazdow):
+    """Liczba pojazdów odczytu w formacie listy lub kolumn"""
+    if isinstance(dane_pojazdow, dict):
+        return len(dane_pojazdow.get('lat', ()))
+    return len(dane_pojazdow)
+
+
+def znajdz_odczyty(collection_rt, filtr=None, sortowanie=None, limit=0, rozmiar_kursora=None,
+                   schemat=SCHEMAT_DOKUMENT, kolumnowo=False):
+    """
+    Zwraca kursor odczytów GTFS-RT z projekcją na pola potrzebne do
+    obliczania opóźnień
+
+    Dla schematu kompaktowego zwraca iterator odczytów złożonych w ten sam
+    format; filtr i sortowanie po _id lub timestamp_zapisu_db dotyczą
+    wtedy czasu odczytu 't', a odczyty o wspólnym 't' rozdziela czas
+    zapisu 'z'.
+
+    Args:
+        filtr: Warunek find (domyślnie wszystkie odczyty)
+        sortowanie: Lista par (pole, kierunek)
+        limit: Maksymalna liczba odczytów (0 = bez limitu)
+        rozmiar_kursora: Liczba odczytów w jednej partii kursora
+        schemat: SCHEMAT_DOKUMENT lub SCHEMAT_KOMPAKTOWY
+        kolumnowo: Jeśli True, dane_pojazdow odczytu to kolumny NumPy
+                   (kolumny_pojazdow) - serwer zwraca pola pojazdów jako
+                   tablice, bez dokumentu na pojazd
+    """
+    if schemat == SCHEMAT_KOMPAKTOWY:
+        return _znajdz_odczyty_kompaktowe(collection_rt, filtr, sortowanie, limit, rozmiar_kursora, kolumnowo)
+
+    if kolumnowo:
+        return _znajdz_odczyty_kolumnowo(collection_rt, filtr, sortowanie, limit, rozmiar_kursora)
+
+    kursor = collection_rt.find(filtr or {}, PROJEKCJA_ODCZYTU)
+    if sortowanie:
+        kursor = kursor.sort(sortowanie)
+    if limit:
+        kursor = kursor.limit(limit)
+    if rozmiar_kursora:
+        kursor = kursor.batch_size(rozmiar_kursora)
+    return kursor
+
+
+def utworz_kolekcje_kompaktowa(db, retencja_dni=RETENCJA_KOMPAKTOWA_DNI):
+    """
+    Tworzy kolekcję schematu kompaktowego, jeśli jeszcze nie istnieje
+
+    Na MongoDB 5.0+ jest to kolekcja time-series (czas 't', seria =
+    pojazd 'm') z automatycznym wygasaniem. Starsze serwery dostają zwykłą
+    kolekcję z indeksem TTL na 't'.
+    """
+    if NAZWA_KOLEKCJI_KOMPAKTOWEJ in db.list_collection_names():
+        return db[NAZWA_KOLEKCJI_KOMPAKTOWEJ]
+
+    retencja_sekund = int(retencja_dni * 86400)
+    try:
+        db.create_collection(
+            NAZWA_KOLEKCJI_KOMPAKTOWEJ,
+            timeseries={'timeField': 't', 'metaField': 'm', 'granularity': 'seconds'},
+            expireAfterSeconds=retencja_sekund,
+        )
+        collection = db[NAZWA_KOLEKCJI_KOMPAKTOWEJ]
+    except OperationFailure as e:
+        print(f"[UWAGA] Kolekcja time-series niedostępna ({e}) - używam indeksu TTL")
+        collection = db[NAZWA_KOLEKCJI_KOMPAKTOWEJ]
+        collection.create_index('t', expireAfterSeconds=retencja_sekund)
+
+    return collection
+
+
+def zbuduj_dokumenty_kompaktowe(do_zapisu, timestamp_serwera):
+    """
+    Zamienia pojazdy odczytu na dokumenty schematu kompaktowego
+
+    Czas pojazdu jest zapisywany jako sekundy epoki. Wszystkie dokumenty
+    odczytu dostają wspólny czas zapisu 'z', który odróżnia odczyty o tym
+    samym czasie nagłówka. Odczyt bez czasu nagłówka dostaje jako 't' czas
+    zapisu - inaczej od razu wygasłby przez TTL.
+    """
+    czas_zapisu = datetime.now()
+    if timestamp_serwera is None or timestamp_serwera.timestamp() <= 0:
+        timestamp_serwera = czas_zapisu
+
+    dokumenty = []
+    for pojazd in do_zapisu:
+        dokument = {'t': timestamp_serwera, 'z': czas_zapisu}
+        for pole, klucz in KLUCZE_KOMPAKTOWE.items():
+            wartosc = pojazd.get(pole)
+            if isinstance(wartosc, datetime):
+                wartosc = int(wartosc.timestamp())
+            elif pole == 'timestamp_danych' and not isinstance(wartosc, int):
+                continue
+            dokument[klucz] = wartosc
+        dokumenty.append(dokument)
+    return dokumenty
+
+
+def _filtr_kompaktowy(filtr):
+    """Tłumaczy warunek na polach odczytu na pola schematu kompaktowego"""
+    return {POLA_ODCZYTU_KOMPAKTOWEGO.get(pole, pole): warunek for pole, warunek in (filtr or {}).items()}
+
+
+def _znajdz_odczyty_kolumnowo(collection_rt, filtr, sortowanie, limit, rozmiar_kursora):
+    """Odczyty schematu dokumentowego z polami pojazdów przepisanymi przez serwer na tablice"""
+    potok = [{'$match': filtr or {}}]
+    if sortowanie:
+        potok.append({'$sort': dict(sortowanie)})
+    if limit:
+        potok.append({'$limit': limit})
+    potok.append({'$project': PROJEKCJA_ODCZYTU_KOLUMNOWO})
+
+    opcje = {'batchSize': rozmiar_kursora} if rozmiar_kursora else {}
+    return ({
+        '_id': odczyt['_id'],
+        'timestamp_serwera_gtfs': odczyt.get('timestamp_serwera_gtfs'),
+        'timestamp_zapisu_db': odczyt.get('timestamp_zapisu_db'),
+        'dane_pojazdow': kolumny_pojazdow({pole: odczyt[pole] for pole in POLA_POJAZDU_KALKULATORA}),
+    } for odczyt in collection_rt.aggregate(potok, **opcje))
+
+
+def _pojazd_kompaktowy(dokument):
+    """Odtwarza pola pojazdu z dokumentu kompaktowego (czas pozycji z epoki na datetime)"""
+    pojazd = {pole: dokument.get(KLUCZE_KOMPAKTOWE[pole]) for pole in POLA_POJAZDU_KALKULATORA}
+    if pojazd['timestamp_danych'] is not None:
+        pojazd['timestamp_danych'] = datetime.fromtimestamp(pojazd['timestamp_danych'])
+    return pojazd
+
+
+def _znajdz_odczyty_kompaktowe(collection, filtr, sortowanie, limit, rozmiar_kursora, kolumnowo=False):
+    """Składa odczyty w formacie dokumentowym z dokumentów pojedynczych pojazdów"""
+    kierunek = sortowanie[0][1] if sortowanie else 1
+    projekcja = {'_id': 0, 't': 1, 'z': 1, **{KLUCZE_KOMPAKTOWE[p]: 1 for p in POLA_POJAZDU_KALKULATORA}}
+
+    kursor = collection.find(_filtr_kompaktowy(filtr), projekcja).sort('t', kierunek)
+    if rozmiar_kursora:
+        # Partia kursora liczona w odczytach - dokumentów jest tyle, ile pojazdów
+        kursor = kursor.batch_size(rozmiar_kursora * POJAZDOW_NA_ODCZYT)
+
+    def pojazdy(dokumenty):
+        if kolumnowo:
+            return kolumny_pojazdow({
+                pole: [d.get(KLUCZE_KOMPAKTOWE[pole]) for d in dokumenty] for pole in POLA_POJAZDU_KALKULATORA
+            })
+        return [_pojazd_kompaktowy(d) for d in dokumenty]
+
+    def rozdziel_odczyty(dokumenty):
+        # Dokumenty o wspólnym t należą do odczytów o różnym czasie zapisu z
+        odczyty = {}
+        for d in dokumenty:
+            odczyty.setdefault(d.get('z'), []).append(d)
+        for z in sorted(odczyty, key=lambda z: (z is not None, z), reverse=kierunek < 0):
+            if z is None:
+                # Dokumenty sprzed zapisu 'z' - zostaje najnowsza pozycja pojazdu
+                najnowsze = sorted(odczyty[z], key=lambda d: d.get(KLUCZE_KOMPAKTOWE['timestamp_danych']) or 0)
+                yield list({d.get(KLUCZE_KOMPAKTOWE['id_pojazdu']): d for d in najnowsze}.values())
+            else:
+                yield odczyty[z]
+
+    odczyty = ({
+        '_id': t,
+        'timestamp_serwera_gtfs': t,
+        'timestamp_zapisu_db': t,
+        'dane_pojazdow': pojazdy(odczyt),
+    } for t, dokumenty in itertools.groupby(kursor, key=lambda d: d['t'])
+      for odczyt in rozdziel_odczyty(dokumenty))
+
+    return itertools.islice(odczyty, limit) if limit else odczyty
+
+
+def _etapy_statystyk():
+    """Zwraca podpotoki $facet liczące statystyki dashboardu"""
+    return {
+        'podsumowanie': [
+            {'$group': {
+                '_id': None,
+                'liczba': {'$sum': 1},
+                'srednia': {'$avg': '$delay_minutes'},
+                'suma_kwadratow': {'$sum': {'$multiply': ['$delay_minutes', '$delay_minutes']}},
+                'minimum': {'$min': '$delay_minutes'},
+                'maksimum': {'$max': '$delay_minutes'},
+                'o_czasie': {'$sum': {'$cond': [
+                    {'$lte': [{'$abs': '$delay_minutes'}, PROG_PUNKTUALNOSCI_MIN]}, 1, 0
+                ]}},
+            }},
+        ],
+        'histogram': [
+            {'$bucket': {
+                'groupBy': '$delay_minutes',
+                'boundaries': GRANICE_HISTOGRAMU,
+                'default': 'poza',
+                'output': {'liczba': {'$sum': 1}},
+            }},
+        ],
+        'godziny': [
+            {'$group': {'_id': {'$hour': '$timestamp'}, 'delay_minutes': {'$avg': '$delay_minutes'}}},
+            {'$sort': {'_id': 1}},
+        ],
+        'dni': [
+            {'$group': {'_id': {'$dayOfWeek': '$timestamp'}, 'delay_minutes': {'$avg': '$delay_minutes'}}},
+            {'$sort': {'_id': 1}},
+        ],
+        'przystanki': [
+            {'$group': {
+                '_id': '$stop_id',
+                'stop_name': {'$first': '$stop_name'},
+                'lat': {'$avg': '$lat'},
+                'lon': {'$avg': '$lon'},
+                'delay_minutes': {'$avg': '$delay_minutes'},
+                'liczba': {'$sum': 1},
+            }},
+        ],
+    }
+
+
+def agreguj_opoznienia(collection, data_od):
+    """
+    Liczy statystyki opóźnień dashboardu po stronie MongoDB
+
+    Jeden potok z $facet skanuje dokumenty od `data_od` (indeks na
+    timestamp) raz i zwraca tylko agregaty - zamiast wszystkich rekordów.
+
+    Args:
+        collection: Kolekcja opóźnień
+        data_od: Początek okresu (datetime), zaokrąglany w dół do pełnej
+                 godziny - jak okno agregatów godzinowych
+
+    Returns:
+        dict: 'podsumowanie' (dict) oraz DataFrame'y 'histogram', 'godziny',
+              'dni' i 'przystanki' lub None, jeśli brak danych
+    """
+    pipeline = [
+        {'$match': {'timestamp': {'$gte': pelna_godzina(data_od)}}},
+        {'$project': {
+            '_id': 0, 'timestamp': 1, 'delay_minutes': 1,
+            'stop_id': 1, 'stop_name': 1, 'lat': 1, 'lon': 1,
+        }},
+        {'$facet': _etapy_statystyk()},
+    ]
+
+    wynik = next(collection.aggregate(pipeline), None)
+    if not wynik or not wynik['podsumowanie'] or not wynik['podsumowanie'][0]['liczba']:
+        return None
+
+    podsumowanie = wynik['podsumowanie'][0]
+    podsumowanie.pop('_id', None)
+    suma_kwadratow = podsumowanie.pop('suma_kwadratow')
+    podsumowanie['odchylenie'] = math.sqrt(
+        max(suma_kwadratow / podsumowanie['liczba'] - podsumowanie['srednia'] ** 2, 0.0))
+    podsumowanie['punktualnosc'] = 100 * podsumowanie['o_czasie'] / podsumowanie['liczba']
+
+    histogram = pd.DataFrame(
+        [p for p in wynik['histogram'] if p['_id'] != 'poza'], columns=['_id', 'liczba']
+    ).rename(columns={'_id': 'od'})
+    histogram['delay_minutes'] = histogram['od'] + SZEROKOSC_PRZEDZIALU_MIN / 2
+
+    godziny = pd.DataFrame(wynik['godziny'], columns=['_id', 'delay_minutes']).rename(columns={'_id': 'hour'})
+
+    dni = pd.DataFrame(wynik['dni'], columns=['_id', 'delay_minutes'])
+    # $dayOfWeek: 1 = niedziela, 7 = sobota
+    dni['day_of_week'] = [KOLEJNOSC_DNI[(d + 5) % 7] for d in dni['_id']]
+    dni = dni.set_index('day_of_week')['delay_minutes'].reindex(KOLEJNOSC_DNI).reset_index()
+
+    przystanki = pd.DataFrame(
+        wynik['przystanki'], columns=['_id', 'stop_name', 'lat', 'lon', 'delay_minutes', 'liczba']
+    ).rename(columns={'_id': 'stop_id'})
+
+    return {
+        'podsumowanie': podsumowanie,
+        'histogram': histogram,
+        'godziny': godziny,
+        'dni': dni,
+        'przystanki': przystanki,
+    }
+
+
+def _przedzial_histogramu(opoznienie_min):
+    """Zwraca klucz przedziału histogramu (dolna granica w minutach)"""
+    przedzial = math.floor(opoznienie_min / SZEROKOSC_PRZEDZIALU_MIN) * SZEROKOSC_PRZEDZIALU_MIN
+    return str(min(max(przedzial, -ZAKRES_HISTOGRAMU_MIN), ZAKRES_HISTOGRAMU_MIN))
+
+
+def pelna_godzina(czas):
+    """Zaokrągla czas w dół do pełnej godziny (granica agregatów godzinowych)"""
+    return czas.replace(minute=0, second=0, microsecond=0)
+
+
+def operacje_agregatow(opoznienia):
+    """
+    Buduje upserty agregatów godzinowych dla nowo zapisanych opóźnień
+
+    Agregat (godzina, linia, przystanek) przechowuje liczbę, sumę, sumę
+    kwadratów, minimum, maksimum, liczbę punktualnych pomiarów, sumy
+    współrzędnych i histogram - wszystko addytywne, więc dowolne okno
+    czasowe da się złożyć z agregatów godzinowych.
+
+    Args:
+        opoznienia: Rekordy opóźnień (tylko nowe - ponowne zliczenie
+                    tego samego rekordu zawyżyłoby agregaty)
+
+    Returns:
+        list: Operacje UpdateOne dla bulk_write
+    """
+    grupy = {}
+
+    for o in opoznienia:
+        klucz = (pelna_godzina(o['timestamp']),
+                 o.get('route_short_name'), o['stop_id'])
+        opoznienie = o['delay_minutes']
+
+        g = grupy.get(klucz)
+        if g is None:
+            g = grupy[klucz] = {
+                'inc': {'liczba': 0, 'suma': 0.0, 'suma_kwadratow': 0.0, 'o_czasie': 0,
+                        'suma_lat': 0.0, 'suma_lon': 0.0},
+                'min': opoznienie, 'max': opoznienie, 'stop_name': o.get('stop_name'),
+            }
+
+        inc = g['inc']
+        inc['liczba'] += 1
+        inc['suma'] += opoznienie
+        inc['suma_kwadratow'] += opoznienie * opoznienie
+        inc['o_czasie'] += abs(opoznienie) <= PROG_PUNKTUALNOSCI_MIN
+        inc['suma_lat'] += o['lat']
+        inc['suma_lon'] += o['lon']
+        pole = f"histogram.{_przedzial_histogramu(opoznienie)}"
+        inc[pole] = inc.get(pole, 0) + 1
+        g['min'] = min(g['min'], opoznienie)
+        g['max'] = max(g['max'], opoznienie)
+
+    return [
+        UpdateOne(
+            dict(zip(KLUCZ_AGREGATU, klucz)),
+            {
+                '$inc': g['inc'],
+                '$min': {'min': g['min']},
+                '$max': {'max': g['max']},
+                '$setOnInsert': {'stop_name': g['stop_name']},
+            },
+            upsert=True
+        )
+        for klucz, g in grupy.items()
+    ]
+
+
+def _zakres_godzin(data_od, data_do):
+    """
+    Warunek $match na godziny agregatów w przedziale [data_od, data_do)
+
+    Agregat obejmuje całą godzinę, więc obie granice są zaokrąglane w dół
+    do pełnej godziny - tak samo jak w agreguj_opoznienia i
+    ranking_opoznien, żeby oba źródła liczyły to samo okno.
+    """
+    warunek = {'$gte': pelna_godzina(data_od)}
+    if data_do is not None:
+        warunek['$lt'] = pelna_godzina(data_do)
+    return {'godzina': warunek}
+
+
+def agreguj_z_agregatow(collection_agregaty, data_od, data_do=None):
+    """
+    Liczy statystyki dashboardu z agregatów godzinowych
+
+    Zwraca ten sam format co agreguj_opoznienia; okno jest wyrównane do
+    pełnych godzin. Koszt zależy od liczby agregatów, nie pomiarów.
+
+    Returns:
+        dict: Statystyki lub None, jeśli w oknie nie ma agregatów
+    """
+    sumy = {'liczba': {'$sum': '$liczba'}, 'suma': {'$sum': '$suma'}}
+    pipeline = [
+        {'$match': _zakres_godzin(data_od, data_do)},
+        {'$facet': {
+            'podsumowanie': [
+                {'$group': {
+                    '_id': None, **sumy,
+                    'suma_kwadratow': {'$sum': '$suma_kwadratow'},
+                    'o_czasie': {'$sum': '$o_czasie'},
+                    'minimum': {'$min': '$min'},
+                    'maksimum': {'$max': '$max'},
+                }},
+            ],
+            'histogram': [
+                {'$project': {'histogram': {'$objectToArray': '$histogram'}}},
+                {'$unwind': '$histogram'},
+                {'$group': {'_id': '$histogram.k', 'liczba': {'$sum': '$histogram.v'}}},
+            ],
+            'godziny': [
+                {'$group': {'_id': {'$hour': '$godzina'}, **sumy}},
+                {'$sort': {'_id': 1}},
+            ],
+            'dni': [
+                {'$group': {'_id': {'$dayOfWeek': '$godzina'}, **sumy}},
+                {'$sort': {'_id': 1}},
+            ],
+            'przystanki': [
+                {'$group': {
+                    '_id': '$stop_id', **sumy,
+                    'stop_name': {'$first': '$stop_name'},
+                    'suma_lat': {'$sum': '$suma_lat'},
+                    'suma_lon': {'$sum': '$suma_lon'},
+                }},
+            ],
+        }},
+    ]
+
+    wynik = next(collection_agregaty.aggregate(pipeline), None)
+    if not wynik or not wynik['podsumowanie'] or not wynik['podsumowanie'][0]['liczba']:
+        return None
+
+    p = wynik['podsumowanie'][0]
+    liczba = p['liczba']
+    srednia = p['suma'] / liczba
+    podsumowanie = {
+        'liczba': liczba,
+        'srednia': srednia,
+        'odchylenie': math.sqrt(max(p['suma_kwadratow'] / liczba - srednia ** 2, 0.0)),
+        'minimum': p['minimum'],
+        'maksimum': p['maksimum'],
+        'o_czasie': p['o_czasie'],
+        'punktualnosc': 100 * p['o_czasie'] / liczba,
+    }
+
+    histogram = pd.DataFrame(wynik['histogram'], columns=['_id', 'liczba'])
+    histogram['od'] = histogram.pop('_id').astype(int)
+    histogram = histogram.sort_values('od').reset_index(drop=True)[['od', 'liczba']]
+    histogram['delay_minutes'] = histogram['od'] + SZEROKOSC_PRZEDZIALU_MIN / 2
+
+    def srednie(grupy):
+        df = pd.DataFrame(grupy, columns=['_id', 'liczba', 'suma'])
+        df['delay_minutes'] = df['suma'] / df['liczba']
+        return df
+
+    godziny = srednie(wynik['godziny']).rename(columns={'_id': 'hour'})[['hour', 'delay_minutes']]
+
+    dni = srednie(wynik['dni'])
+    dni['day_of_week'] = [KOLEJNOSC_DNI[(d + 5) % 7] for d in dni['_id']]
+    dni = dni.set_index('day_of_week')['delay_minutes'].reindex(KOLEJNOSC_DNI).reset_index()
+
+    przystanki = pd.DataFrame(
+        wynik['przystanki'], columns=['_id', 'liczba', 'suma', 'stop_name', 'suma_lat', 'suma_lon']
+    ).rename(columns={'_id': 'stop_id'})
+    przystanki['delay_minutes'] = przystanki['suma'] / przystanki['liczba']
+    przystanki['lat'] = przystanki['suma_lat'] / przystanki['liczba']
+    przystanki['lon'] = przystanki['suma_lon'] / przystanki['liczba']
+    przystanki = przystanki[['stop_id', 'stop_name', 'lat', 'lon', 'delay_minutes', 'liczba']]
+
+    return {
+        'podsumowanie': podsumowanie,
+        'histogram': histogram,
+        'godziny': godziny,
+        'dni': dni,
+        'przystanki': przystanki,
+    }
+
+
+def ranking_z_agregatow(collection_agregaty, pole, data_od, data_do=None, limit=10):
+    """
+    Zwraca średnie opóźnienie i liczbę pomiarów wg linii lub przystanku
+
+    Args:
+        pole: 'route_short_name' lub 'stop_name'
+
+    Returns:
+        DataFrame: Kolumny mean i count, posortowane malejąco po mean
+    """
+    pipeline = [
+        {'$match': _zakres_godzin(data_od, data_do)},
+        {'$group': {'_id': f'${pole}', 'suma': {'$sum': '$suma'}, 'count': {'$sum': '$liczba'}}},
+        {'$project': {'count': 1, 'mean': {'$divide': ['$suma', '$count']}}},
+        {'$sort': {'mean': -1}},
+        {'$limit': limit},
+    ]
+    wiersze = list(collection_agregaty.aggregate(pipeline))
+    return pd.DataFrame(wiersze, columns=['_id', 'mean', 'count']).rename(columns={'_id': pole}).set_index(pole)
+
+
+def ranking_opoznien(collection, pole, data_od, limit=10):
+    """
+    Zwraca ranking jak ranking_z_agregatow, licząc go z surowych pomiarów
+
+    Args:
+        collection: Kolekcja opóźnień
+        pole: 'route_short_name' lub 'stop_name'
+
+    Returns:
+        DataFrame: Kolumny mean i count, posortowane malejąco po mean
+    """
+    pipeline = [
+        {'$match': {'timestamp': {'$gte': pelna_godzina(data_od)}}},
+        {'$group': {'_id': f'${pole}', 'mean': {'$avg': '$delay_minutes'}, 'count': {'$sum': 1}}},
+        {'$sort': {'mean': -1}},
+        {'$limit': limit},
+    ]
+    wiersze = list(collection.aggregate(pipeline))
+    return pd.DataFrame(wiersze, columns=['_id', 'mean', 'count']).rename(columns={'_id': pole}).set_index(pole)